@@ -161,6 +161,45 @@ IMPORTER_QUBIT_DBNAME = "icaatom"
 IMPORTER_QUBUT_DBUSER = "icaatom"
 IMPORTER_QUBIT_DBPASS = "changeme"
 IMPORTER_QUBIT_USER = "mikeb"
+# Rows to import between commits, or None to commit once at the end
+IMPORTER_BATCH_SIZE = None
+# Min seconds and rows between import progress updates
+IMPORTER_PROGRESS_INTERVAL = 1.0
+IMPORTER_PROGRESS_ROWS = 1000
+# Seconds an import's progress is cached for between pollers, and
+# the longest a long-poll for progress is held open
+IMPORTER_PROGRESS_TTL = 1
+IMPORTER_LONGPOLL_TIMEOUT = 20
+# Number of chunk tasks to fan each import out to, or 1 to run
+# it as a single task
+IMPORTER_CHUNKS = 1
+# Whether imports read and transform rows in threads of their own
+# while writing to the DB
+IMPORTER_PIPELINED = False
+# Whether import tasks run alongside each other, queueing for one
+# of the Qubit DB's slots, which needs the tables made by
+# "manage.py create_importer_tables"
+IMPORTER_CONCURRENT = False
+# Max imports running against the Qubit DB at once, seconds a
+# queued import waits before trying again, and seconds to wait for
+# one of the locks imports share before giving up
+IMPORTER_CONCURRENCY = 2
+IMPORTER_QUEUE_DELAY = 10
+IMPORTER_LOCK_TIMEOUT = 300
+# Whether import tasks journal the rows they commit, so they can be
+# resumed if they fail, which needs the tables made by
+# "manage.py create_importer_tables"
+IMPORTER_JOURNAL = False
+# Times a failed journalled import task is retried, resuming from
+# the rows it committed, and seconds to wait before each retry
+IMPORTER_RESUME_RETRIES = 3
+IMPORTER_RESUME_DELAY = 60
+# Where validation results for uploaded files are cached, and how
+# many files' worth to keep
+IMPORTER_CACHE_DIR = os.path.join(PROJECT_ROOT, "cache", "validation")
+IMPORTER_CACHE_ENTRIES = 20
+# Files of extra "name = code" country aliases for the sheets
+IMPORTER_COUNTRY_ALIASES = []
 
 try:
     from production_settings import *
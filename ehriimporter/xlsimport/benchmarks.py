@@ -0,0 +1,455 @@
+"""Synthetic spreadsheets built from the sheet definitions, and
+benchmarks for validating and importing them, so the time, queries
+and memory an import takes can be compared with a stored baseline.
+The same seed always gives the same sheet."""
+
+import os
+import json
+import time
+import random
+import resource
+import tempfile
+import traceback
+import multiprocessing
+
+from xlsimport import cells, validators
+
+try:
+    import xlwt
+except ImportError:
+    xlwt = None
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+# proportion of rows with a deliberate error in them
+BAD_RATE = 0.05
+
+# most rows an .xls sheet can hold
+XLS_MAX_ROWS = 65536
+
+SURNAMES = [u"Kowalski", u"Cohen", u"Schmidt", u"Levi", u"Nowak", u"Weiss",
+        u"Horvath", u"Dupont", u"Novak", u"Friedman", u"Rosen", u"Klein",
+        u"Goldberg", u"Meyer", u"Wisniewski", u"Kaplan"]
+GIVEN_NAMES = [u"Jan", u"Sara", u"Moshe", u"Anna", u"Erich", u"Miriam",
+        u"Pierre", u"Eva", u"Jakob", u"Helena"]
+ORGANISATIONS = [u"Joint Distribution Committee", u"Judenrat",
+        u"International Red Cross", u"Central Committee of Polish Jews",
+        u"World Jewish Congress", u"UNRRA"]
+SUBJECTS = [u"Deportations", u"Ghettos", u"Camps", u"Children", u"Hiding",
+        u"Resistance", u"Emigration", u"Restitution", u"Trials", u"Property",
+        u"Refugees", u"Liberation", u"Displaced persons", u"Forced labour",
+        u"Testimonies", u"Kindertransport", u"Rescue", u"Antisemitism"]
+PLACES = [u"Warsaw", u"Amsterdam", u"Berlin", u"Prague", u"Budapest",
+        u"Vilnius", u"Lodz", u"Theresienstadt", u"Paris", u"Vienna",
+        u"Krakow", u"Riga", u"Westerbork", u"Drancy", u"Bergen-Belsen"]
+COUNTRIES = [u"Germany", u"Poland", u"Netherlands", u"France", u"Israel",
+        u"United States", u"United Kingdom", u"Czech Republic", u"Hungary",
+        u"Belgium", u"Austria", u"Lithuania"]
+LANGUAGES = [u"en", u"de", u"pl", u"fr", u"nl", u"he", u"yi", u"cs", u"hu"]
+SCRIPTS = [u"Latn", u"Hebr", u"Cyrl"]
+WORDS = (u"lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+        u"eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+# metric -> whether bigger is better, for comparing with a baseline
+METRICS = (
+    ("rows_per_sec", True),
+    ("queries_per_row", False),
+    ("peak_kb", False),
+)
+
+
+class BenchmarkError(Exception):
+    """A benchmark couldn't be run."""
+
+
+class SheetGenerator(object):
+    """Makes up rows for a validator's sheet definitions.  Values
+    are drawn from skewed pools, so a few creators, subjects and
+    places turn up over and over as they do in real sheets, and
+    roughly `bad_rate` of the rows get one deliberate error.  The
+    row numbers of those are kept in `bad`.  Collection rows refer
+    to the given repository ids."""
+    # field name -> method making a value for it, for fields whose
+    # definitions don't say enough to make up a sensible value
+    FIELDS = dict(
+        country="country",
+        repository_code="repository",
+        language="languages",
+        language_of_description="languages",
+        script="scripts",
+        script_of_description="scripts",
+        subject_access="subjects",
+        place_access="places",
+        telephone="phone",
+        fax="phone",
+        email="email",
+        website="website",
+        ehri_priority="priority",
+        ehri_copyright="copyright",
+        level_of_description="level",
+    )
+
+    def __init__(self, klass, seed=0, bad_rate=BAD_RATE, repositories=(1,)):
+        self.klass = klass
+        self.fielddef = klass().fielddef
+        self.plan = self.fielddef.compile()
+        self.seed = seed
+        self.bad_rate = bad_rate
+        self.repositories = list(repositories)
+        self.rand = random.Random(seed)
+        self.people = [u"%s, %s" % (s, g) for s in SURNAMES for g in GIVEN_NAMES]
+        self.rand.shuffle(self.people)
+        self.faults = self.possible_faults()
+        self.bad = []
+
+    @property
+    def headings(self):
+        return self.plan.headings
+
+    def possible_faults(self):
+        """(field, value) pairs which are each an error in any row
+        for these definitions."""
+        plan = self.plan
+        faults = [(name, u"") for name in plan.required]
+        faults.extend((name, u"x" * (validators.MAX_CHARFIELD_LENGTH + 1)) \
+                for name in plan.chars)
+        faults.extend((name, u"one,,two") for name in plan.singles \
+                if name not in plan.uniques)
+        faults.extend((name, cells.SEPARATOR.join([u"1940"] * (limit + 1))) \
+                for name, limit in plan.limits)
+        faults.extend((name, u"Nobody") for name in plan.personnames)
+        faults.extend((name, u"sometime") for name in plan.dates)
+        faults.extend((name, u"bad") for name, _, _ in plan.choices)
+        return faults
+
+    def skewed(self, pool):
+        """Pick a value, favouring those at the start of the pool."""
+        return pool[int(len(pool) * self.rand.random() ** 3)]
+
+    def some(self, func, most):
+        """Between none and `most` values, joined as a multiple."""
+        return cells.SEPARATOR.join(func() for _ in range(self.rand.randint(0, most)))
+
+    def words(self, most):
+        return u" ".join(self.rand.choice(WORDS) \
+                for _ in range(self.rand.randint(1, most)))
+
+    def text(self):
+        # plenty of cells are just left empty
+        if self.rand.random() < 0.3:
+            return u""
+        return self.words(40).capitalize() + u"."
+
+    def person(self):
+        if self.rand.random() < 0.1:
+            return u"[org] " + self.skewed(ORGANISATIONS)
+        return self.skewed(self.people)
+
+    def date(self):
+        year = self.rand.randint(1933, 1950)
+        form = self.rand.random()
+        if form < 0.5:
+            return u"%d" % year
+        elif form < 0.6:
+            # years typed into Excel come back as floats
+            return float(year)
+        elif form < 0.7:
+            return u"c%d" % year
+        elif form < 0.85:
+            return u"%d-%02d" % (year, self.rand.randint(1, 12))
+        return u"%d-%02d-%02d" % (year, self.rand.randint(1, 12),
+                self.rand.randint(1, 28))
+
+    def dates(self):
+        """A date, or a range of two."""
+        if self.rand.random() < 0.5:
+            return self.date()
+        start = self.rand.randint(1933, 1945)
+        return u"%d,,%d" % (start, self.rand.randint(start, 1950))
+
+    def country(self):
+        return self.skewed(COUNTRIES)
+
+    def repository(self):
+        return float(self.skewed(self.repositories))
+
+    def languages(self):
+        if self.rand.random() < 0.8:
+            return u"en"
+        return self.some(lambda: self.skewed(LANGUAGES), 3)
+
+    def scripts(self):
+        return self.skewed(SCRIPTS)
+
+    def subjects(self):
+        return self.some(lambda: self.skewed(SUBJECTS), 3)
+
+    def places(self):
+        return self.some(lambda: self.skewed(PLACES), 2)
+
+    def phone(self):
+        if self.rand.random() < 0.3:
+            return float(self.rand.randint(10 ** 9, 10 ** 10))
+        return self.some(lambda: u"+%d %d" % (self.rand.randint(1, 99),
+                self.rand.randint(10 ** 6, 10 ** 7)), 2)
+
+    def email(self):
+        return self.some(lambda: u"%s@example.org" % self.rand.choice(WORDS), 2)
+
+    def website(self):
+        return self.some(lambda: u"http://%s.example.org" % self.rand.choice(WORDS), 1)
+
+    def priority(self):
+        return float(self.rand.randint(1, 5))
+
+    def copyright(self):
+        return self.rand.choice([u"yes", u"no"])
+
+    def level(self):
+        return u"Collection"
+
+    def value(self, field, num):
+        """Make up a value for a field in the `num`th row."""
+        method = self.FIELDS.get(field.name)
+        if method is not None:
+            return getattr(self, method)()
+        if field.unique:
+            if field.type == "char":
+                return u"%s %d" % (self.words(6).capitalize(), num)
+            return u"%s-%06d" % (field.name, num)
+        if field.choices is not None:
+            return self.skewed([c for c in field.choices if c is not None])
+        if field.type == "date":
+            return self.dates() if field.multiple else self.date()
+        if field.type == "personname":
+            return self.some(self.person, 3) if field.multiple else self.person()
+        if field.type == "char":
+            if field.multiple:
+                return self.some(lambda: self.words(8), 2)
+            return self.words(8)
+        if field.multiple:
+            return self.some(lambda: self.words(3), 3)
+        return self.text()
+
+    def rows(self, nrows):
+        """Yield (rownum, values) for `nrows` rows."""
+        fields = [self.fielddef.fields[name] for name in self.headings]
+        index = self.plan.index
+        start = self.fielddef.heading_row + 1
+        for num, rownum in enumerate(xrange(start, start + nrows)):
+            values = [self.value(field, num) for field in fields]
+            if self.faults and self.rand.random() < self.bad_rate:
+                name, value = self.rand.choice(self.faults)
+                values[index[name]] = value
+                self.bad.append(rownum)
+            yield rownum, values
+
+
+def _write_xls(path, generator, nrows):
+    if xlwt is None:
+        raise BenchmarkError("Writing .xls files requires xlwt")
+    if generator.fielddef.heading_row + 1 + nrows > XLS_MAX_ROWS:
+        raise BenchmarkError("Too many rows for an .xls file, use .xlsx")
+    book = xlwt.Workbook(encoding="utf-8")
+    sheet = book.add_sheet("Data")
+    if generator.fielddef.heading_row > 0:
+        sheet.write(0, 0, u"Synthetic %s sheet" % generator.klass.name)
+    for col, heading in enumerate(generator.headings):
+        sheet.write(generator.fielddef.heading_row, col, heading)
+    for rownum, values in generator.rows(nrows):
+        for col, value in enumerate(values):
+            if value != u"":
+                sheet.write(rownum, col, value)
+        # don't keep every row in memory until the end
+        if rownum % 1000 == 0:
+            sheet.flush_row_data()
+    book.save(path)
+
+
+def _write_xlsx(path, generator, nrows):
+    if openpyxl is None:
+        raise BenchmarkError("Writing .xlsx files requires openpyxl")
+    book = openpyxl.Workbook(write_only=True)
+    sheet = book.create_sheet()
+    for rownum in range(generator.fielddef.heading_row):
+        sheet.append([u"Synthetic %s sheet" % generator.klass.name] \
+                if rownum == 0 else [])
+    sheet.append(list(generator.headings))
+    for rownum, values in generator.rows(nrows):
+        sheet.append([None if v == u"" else v for v in values])
+    book.save(path)
+
+
+def write_sheet(path, generator, nrows):
+    """Write a sheet of generated rows, as .xlsx if that's the
+    file's extension, otherwise as .xls.  Returns the row numbers
+    of the bad rows."""
+    if os.path.splitext(path)[1].lower() == ".xlsx":
+        _write_xlsx(path, generator, nrows)
+    else:
+        _write_xls(path, generator, nrows)
+    return generator.bad
+
+
+def _run_child(queue, func, args):
+    try:
+        result = func(*args)
+        result["peak_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        queue.put((True, result))
+    except Exception:
+        queue.put((False, traceback.format_exc()))
+
+
+def in_child(func, *args):
+    """Run a benchmark in a process of its own, so its peak memory
+    isn't muddled up with whatever ran before it, and return its
+    results along with the peak memory in KB."""
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_run_child, args=(queue, func, args))
+    proc.start()
+    ok, result = queue.get()
+    proc.join()
+    if not ok:
+        raise BenchmarkError(result)
+    return result
+
+
+def generate(path, klass, nrows, seed=0, bad_rate=BAD_RATE, repositories=(1,)):
+    """Write a sheet of generated rows."""
+    generator = SheetGenerator(klass, seed, bad_rate, repositories)
+    return dict(bad=write_sheet(path, generator, nrows))
+
+
+def validate(klass, path):
+    """Validate a sheet."""
+    validator = klass()
+    started = time.time()
+    validator.validate(path)
+    return dict(rows=validator.num_rows(), seconds=time.time() - started,
+            errors=len(validator.errors), queries=0)
+
+
+def setup_standin(url, atomuser="qubit", repositories=(1,)):
+    """Create the Qubit schema in a throwaway stand-in DB, i.e.
+    sqlite:////tmp/qubit.db, along with the importer's own tables
+    and the user, root objects, standard terms and repositories an
+    import needs, unless it's been set up already.  Returns the
+    engine."""
+    from sqlalchemy.orm import class_mapper
+    from sqlaqubit import models
+    from xlsimport import connections, journal, scheduler
+    engine = connections.get_engine(url=url)
+    # every Qubit table shares the models' metadata
+    class_mapper(models.Slug).local_table.metadata.create_all(engine)
+    scheduler.setup(engine)
+    journal.setup(engine)
+    session = models.Session()
+    try:
+        if session.query(models.User)\
+                .filter(models.User.username == atomuser).count():
+            return engine
+        session.add(models.User(username=atomuser))
+        roots = {}
+        for name, (model, rootid) in connections.ROOTS.iteritems():
+            roots[name] = model(id=rootid, source_culture="en")
+            session.add(roots[name])
+        for taxonomy_id, name in connections.TERMS.itervalues():
+            term = models.Term(taxonomy_id=taxonomy_id, parent=roots["termroot"],
+                    source_culture="en")
+            session.add(term)
+            term.set_i18n(dict(name=name), "en")
+        for repoid in repositories:
+            repo = models.Repository(id=repoid, identifier=u"r%06dXX" % repoid,
+                    parent=roots["actorroot"], source_culture="en")
+            session.add(repo)
+            repo.set_i18n(dict(authorized_form_of_name=u"Repository %d" % repoid), "en")
+        session.commit()
+    finally:
+        session.close()
+    return engine
+
+
+def import_sheet(klass, path, url, atomuser, batch_size=None, pipelined=False):
+    """Import a sheet into the DB at `url`."""
+    # only the import benchmarks need the DB libraries
+    from xlsimport import importers
+    importer = getattr(importers, klass.__name__)(url=url, atomuser=atomuser,
+            batch_size=batch_size, pipelined=pipelined)
+    started = time.time()
+    report = importer.do(path)
+    return dict(rows=report["rows"], seconds=time.time() - started,
+            errors=0, queries=report["total_queries"], phases=report["phases"])
+
+
+def run_suite(klass, nrows, seed=0, bad_rate=BAD_RATE, url=None,
+            atomuser=None, batch_size=None, repositories=(1,), fmt=".xls",
+            pipelined=False):
+    """Validate a generated sheet and, if given the URL of a stand-in
+    DB, import a clean one into it, and again pipelined if asked to.
+    The DB has to have the ICA-AtoM schema, reference terms and the
+    repositories the rows refer to set up already, and shouldn't be
+    one anybody minds filling with junk.  Returns mode -> results."""
+    results = {}
+    fd, path = tempfile.mkstemp(prefix="xlsimport-bench-", suffix=fmt)
+    os.close(fd)
+    try:
+        modes = [("validate", bad_rate)]
+        if url is not None:
+            # the import would refuse a sheet with errors in it
+            modes.append(("import", 0.0))
+            if pipelined:
+                modes.append(("import-pipelined", 0.0))
+        for mode, rate in modes:
+            in_child(generate, path, klass, nrows, seed, rate, repositories)
+            if mode == "validate":
+                result = in_child(validate, klass, path)
+            else:
+                result = in_child(import_sheet, klass, path, url, atomuser,
+                        batch_size, mode == "import-pipelined")
+            result.update(seed=seed, bad_rate=rate,
+                    rows_per_sec=result["rows"] / max(result["seconds"], 1e-9),
+                    queries_per_row=float(result["queries"]) / max(result["rows"], 1))
+            results[mode] = result
+    finally:
+        os.unlink(path)
+    return results
+
+
+def load_baseline(path):
+    """Load stored results, keyed on validator name and mode."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as fp:
+        return json.load(fp)
+
+
+def save_baseline(path, name, results):
+    """Store a suite's results as the baseline for a validator."""
+    baseline = load_baseline(path)
+    baseline[name] = results
+    with open(path, "w") as fp:
+        json.dump(baseline, fp, indent=2, sort_keys=True)
+
+
+def regressions(results, baseline, tolerance=0.2):
+    """Compare a suite's results with the baseline for the same
+    validator, returning (mode, metric, baseline, result) for each
+    metric that's more than `tolerance` worse.  Runs on a different
+    number of rows or seed aren't comparable, and are skipped."""
+    found = []
+    for mode, result in sorted(results.iteritems()):
+        base = baseline.get(mode)
+        if base is None or (base["rows"], base["seed"]) != (result["rows"], result["seed"]):
+            continue
+        for metric, bigger_better in METRICS:
+            old, new = base[metric], result[metric]
+            if bigger_better:
+                worse = new < old * (1 - tolerance)
+            else:
+                worse = new > old * (1 + tolerance) and new - old > 1e-6
+            if worse:
+                found.append((mode, metric, old, new))
+    return found
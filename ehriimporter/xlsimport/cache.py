@@ -0,0 +1,117 @@
+"""On-disk cache of validation results, keyed on the contents of a
+spreadsheet and the version of the definitions it was checked
+against, so a file that's uploaded again (to import it after
+validating, or to retry a failed import) isn't validated again."""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import cPickle
+
+from django.conf import settings
+
+CACHE_DIR = getattr(settings, "IMPORTER_CACHE_DIR",
+        os.path.join(tempfile.gettempdir(), "xlsimport-cache"))
+CACHE_ENTRIES = getattr(settings, "IMPORTER_CACHE_ENTRIES", 20)
+# bumped whenever the format of cached rows or errors changes
+CACHE_FORMAT = 3
+
+
+def file_digest(path, blocksize=1 << 20):
+    """Get the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(blocksize), ""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ValidationCache(object):
+    """Validation errors, row counts and spooled rows, stored as a
+    pair of files per entry.  The least recently used entries are
+    evicted once there are more than `entries` of them."""
+    def __init__(self, directory=CACHE_DIR, entries=CACHE_ENTRIES):
+        self.directory = directory
+        self.entries = entries
+
+    def key(self, validator, xlspath):
+        """Key for the results of a validator on a file."""
+        return "%s-v%d-%s-%s" % (validator.__class__.__name__, CACHE_FORMAT,
+                validator.fielddef.digest[:16], file_digest(xlspath))
+
+    def paths(self, key):
+        """Get the metadata and rows paths for an entry."""
+        base = os.path.join(self.directory, key)
+        return base + ".meta", base + ".rows"
+
+    def get(self, key):
+        """Get the cached results for a key, or None."""
+        metapath, rowspath = self.paths(key)
+        try:
+            with open(metapath, "rb") as fp:
+                entry = cPickle.load(fp)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return
+        if entry["rows"]:
+            if not os.path.exists(rowspath):
+                return
+            os.utime(rowspath, None)
+        # touch the entry so it counts as recently used
+        os.utime(metapath, None)
+        entry.update(rowspath=rowspath if entry["rows"] else None)
+        return entry
+
+    def put(self, key, validator):
+        """Store a validator's results, taking over its spooled
+        rows if it has any."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        metapath, rowspath = self.paths(key)
+        entry = dict(errors=validator.errors, nrows=validator.nrows,
+                rows=validator.rows is not None)
+        if validator.rows is not None:
+            shutil.move(validator.rows.path, rowspath)
+            validator.load_rows(rowspath)
+        # write then rename so readers never see half an entry
+        fd, temppath = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "wb") as fp:
+            cPickle.dump(entry, fp, cPickle.HIGHEST_PROTOCOL)
+        os.rename(temppath, metapath)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries over the limit."""
+        metas = [os.path.join(self.directory, f) for f in os.listdir(self.directory) \
+                if f.endswith(".meta")]
+        metas.sort(key=lambda p: os.stat(p).st_mtime, reverse=True)
+        for metapath in metas[self.entries:]:
+            for path in (metapath, metapath[:-len(".meta")] + ".rows"):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def validate(self, validator, xlspath, keep_rows=True):
+        """Validate a file, keeping its rows unless `keep_rows` is
+        unset, i.e. when it's only being checked, or fill the
+        validator in from the cache if we've already seen it (with
+        its rows, if we want them).  Returns True if the results
+        came from the cache."""
+        key = self.key(validator, xlspath)
+        entry = self.get(key)
+        if entry is None or (keep_rows and entry["rowspath"] is None):
+            validator.validate(xlspath, keep_rows=keep_rows)
+            self.put(key, validator)
+            return False
+        validator.errors = list(entry["errors"])
+        validator.nrows = entry["nrows"]
+        if entry["rowspath"] is not None:
+            validator.load_rows(entry["rowspath"])
+        return True
+
+
+validation_cache = ValidationCache()
+
+
+def validate(validator, xlspath, keep_rows=True):
+    """Validate a file using the shared validation cache."""
+    return validation_cache.validate(validator, xlspath, keep_rows)
@@ -0,0 +1,123 @@
+"""The row model shared by the validators and importers.  Each
+cell a row is asked about is converted to unicode and split into
+its multiple values once, and the result kept on the row, so the
+checks and the import code can all read the same values without
+redoing the work."""
+
+# separator between multiple values in a single cell
+SEPARATOR = ",,"
+
+# headings tuple -> {heading: column index}, shared by every row
+# with the same headings
+INDEXES = {}
+
+
+def split_multiple(multistr, sep=SEPARATOR):
+    return [s for s in unicode(multistr).rsplit(sep) if s.strip()]
+
+
+class Cell(object):
+    """A cell's raw value, its text, and its non-blank multiple
+    values."""
+    __slots__ = ("value", "text", "items")
+
+    def __init__(self, value):
+        self.value = value
+        if type(value) is not unicode:
+            value = unicode(value)
+        self.text = value
+        if SEPARATOR in value:
+            self.items = [s for s in value.rsplit(SEPARATOR) if s.strip()]
+        elif value.strip():
+            self.items = [value]
+        else:
+            self.items = []
+
+    @property
+    def blank(self):
+        return self.value is None or self.text.strip() == ""
+
+    @property
+    def multiple(self):
+        """Whether the cell holds more than one value."""
+        return len(self.items) > 1
+
+
+class Row(object):
+    """The values in a row, which can be read like the ordered dict
+    of heading -> value rows used to be, plus a Cell for each value
+    that's been looked at.  The headings and their index are shared
+    between rows, and the cells aren't pickled along with the row."""
+    __slots__ = ("headings", "index", "data", "cells")
+
+    def __init__(self, headings, data):
+        headings = tuple(headings)
+        index = INDEXES.get(headings)
+        if index is None:
+            index = INDEXES[headings] = dict((h, i) for i, h in enumerate(headings))
+        self.headings = headings
+        self.index = index
+        self.data = list(data)
+        self.cells = {}
+
+    def __reduce__(self):
+        return self.__class__, (self.headings, self.data)
+
+    def __repr__(self):
+        return "Row(%r)" % self.items()
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            return self.items() == other.items()
+        return NotImplemented
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __len__(self):
+        return len(self.headings)
+
+    def __iter__(self):
+        return iter(self.headings)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __getitem__(self, key):
+        return self.data[self.index[key]]
+
+    def __setitem__(self, key, value):
+        self.data[self.index[key]] = value
+        self.cells.pop(key, None)
+
+    def get(self, key, default=None):
+        i = self.index.get(key)
+        return default if i is None else self.data[i]
+
+    def keys(self):
+        return list(self.headings)
+
+    def values(self):
+        return list(self.data)
+
+    def items(self):
+        return zip(self.headings, self.data)
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def cell(self, key):
+        """Get the Cell for a heading, or an empty one if the row
+        doesn't have it."""
+        cell = self.cells.get(key)
+        if cell is None:
+            i = self.index.get(key)
+            cell = self.cells[key] = Cell(u"" if i is None else self.data[i])
+        return cell
+
+    def text(self, key):
+        return self.cell(key).text
+
+    def split(self, key):
+        """Get the multiple values in a cell."""
+        return self.cell(key).items
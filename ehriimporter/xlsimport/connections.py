@@ -0,0 +1,167 @@
+"""Process-wide pool of engines for Qubit DBs, and caches of the
+reference records (the importing user, root objects and standard
+terms) every importer needs and of the slugs in use, so setting up
+an importer in a long-running worker doesn't cost a connection,
+a handful of queries and a scan of the slug table every time."""
+
+import threading
+
+from sqlaqubit import models, keys, create_engine, init_models
+from sqlalchemy.engine.url import URL
+from sqlalchemy.orm import Session
+
+from xlsimport import registry, stats
+
+# URL (including credentials) -> engine
+ENGINES = {}
+# the engine the models were last initialised with
+BOUND = None
+LOCK = threading.RLock()
+
+
+def db_url(database=None, username=None, password=None,
+            hostname="localhost", port=None):
+    return URL("mysql",
+        username=username,
+        password=password,
+        host=hostname,
+        database=database,
+        port=port,
+        query=dict(
+            charset="utf8",
+            use_unicode=0
+        )
+    )
+
+
+def get_engine(database=None, username=None, password=None,
+            hostname="localhost", port=None, url=None):
+    """Get the engine for a DB, creating it the first time it's
+    asked for, and make sure the models are bound to it.  A full
+    `url` can be given instead of the MySQL connection details,
+    i.e. for a stand-in DB to run benchmarks against."""
+    global BOUND
+    if url is None:
+        url = db_url(database, username, password, hostname, port)
+    with LOCK:
+        engine = ENGINES.get(str(url))
+        if engine is None:
+            engine = ENGINES[str(url)] = create_engine(url)
+            stats.instrument(engine)
+        if BOUND is not engine:
+            init_models(engine)
+            BOUND = engine
+    return engine
+
+
+def dispose_engines():
+    """Close all pooled connections and forget the engines."""
+    global BOUND
+    with LOCK:
+        for engine in ENGINES.values():
+            engine.dispose()
+        ENGINES.clear()
+        BOUND = None
+        REFERENCES.invalidate()
+        SLUGS.invalidate()
+
+
+def _term(taxonomy_id, name):
+    def query(session):
+        return session.query(models.Term)\
+                .filter(models.Term.taxonomy_id == taxonomy_id)\
+                .join(models.TermI18N, models.Term.id == models.TermI18N.id)\
+                .filter(models.TermI18N.name == name).one()
+    return query
+
+
+def _root(model, root_id):
+    def query(session):
+        return session.query(model).filter(model.id == root_id).one()
+    return query
+
+
+def _user(session, username):
+    return session.query(models.User).filter(
+            models.User.username == username).one()
+
+
+# reference name -> (taxonomy id, name) of the standard terms
+TERMS = dict(
+    status=(keys.TaxonomyKeys.DESCRIPTION_STATUS_ID, "Draft"),
+    detail=(keys.TaxonomyKeys.DESCRIPTION_DETAIL_LEVEL_ID, "Partial"),
+    pubtype=(keys.TaxonomyKeys.STATUS_TYPE_ID, "publication"),
+    pubstatus=(keys.TaxonomyKeys.PUBLICATION_STATUS_ID, "draft"),
+    lod_coll=(keys.TaxonomyKeys.LEVEL_OF_DESCRIPTION_ID, "Collection"),
+)
+
+# reference name -> (model, id) of the root objects
+ROOTS = dict(
+    actorroot=(models.Actor, keys.ActorKeys.ROOT_ID),
+    termroot=(models.Term, keys.TermKeys.ROOT_ID),
+    inforoot=(models.InformationObject, keys.InformationObjectKeys.ROOT_ID),
+)
+
+# reference name -> function to look it up given a session and
+# any extra arguments
+QUERIES = dict(user=_user)
+QUERIES.update((name, _term(*term)) for name, term in TERMS.iteritems())
+QUERIES.update((name, _root(*root)) for name, root in ROOTS.iteritems())
+
+
+class ReferenceCache(object):
+    """The model and id of reference records, keyed on engine and
+    name.  Each is looked up once, in a session of its own which is
+    then closed.  Only the ids are kept, not the records, since some
+    of them change under us, i.e. the root objects' nested set
+    columns as records are added beneath them, so importers load
+    the records themselves by primary key in their own session.
+    The cache can be invalidated for one engine or all of them if
+    the records change, i.e. a term is renamed."""
+    def __init__(self):
+        # (engine, name, args...) -> (model, id)
+        self.records = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def load(self, engine, name, *args):
+        """Get the model and id of a reference, looking it up if it
+        isn't cached yet."""
+        key = (engine, name) + args
+        with LOCK:
+            ident = self.records.get(key)
+            if ident is None:
+                session = Session(bind=engine)
+                try:
+                    record = QUERIES[name](session, *args)
+                    ident = (record.__class__, record.id)
+                finally:
+                    session.close()
+                self.records[key] = ident
+        return ident
+
+    def get(self, session, engine, name, *args):
+        """Get a reference record, fresh, in the given session."""
+        model, ident = self.load(engine, name, *args)
+        return session.query(model).get(ident)
+
+    def warm(self, engine, username):
+        """Look up all the references, so the first importer
+        doesn't have to."""
+        for name in QUERIES:
+            if name == "user":
+                self.load(engine, name, username)
+            else:
+                self.load(engine, name)
+
+    def invalidate(self, engine=None):
+        """Forget the references for an engine, or all of them."""
+        with LOCK:
+            for key in self.records.keys():
+                if engine is None or key[0] is engine:
+                    del self.records[key]
+
+
+REFERENCES = ReferenceCache()
+SLUGS = registry.SlugCache()
@@ -0,0 +1,103 @@
+"""Parsing the date values found in spreadsheets, shared by the
+validators and the importers so they always agree on what a date
+means.  The usual forms are matched with a regex, anything else
+goes to dateutil, and results are memoized since the same years
+turn up over and over again."""
+
+import re
+import calendar
+import datetime
+
+from dateutil import parser
+
+from xlsimport import utils
+
+# YYYY, YYYY-MM or YYYY-MM-DD, with optional surrounding space
+DATE_RE = re.compile(r"^\s*(\d{4})(?:-(\d{1,2})(?:-(\d{1,2}))?)?\s*$")
+
+# defaults for the parts of a date that aren't given, depending on
+# whether it's the start or end of a range
+START_DEFAULT = datetime.datetime(1900, 1, 1)
+END_DEFAULT = datetime.datetime(1900, 12, 31)
+
+CACHE = utils.LRUCache(10000)
+
+
+def clean(datestr):
+    """Strip a preceding 'c' for 'circa', which is allowed to
+    indicate inexactness, and the '.0' of years which have been
+    coerced to floats."""
+    if datestr.startswith("c"):
+        datestr = datestr[1:]
+    # hack! to rid int dates of coerced float points
+    if datestr.endswith(".0"):
+        datestr = datestr[:-2]
+    return datestr
+
+
+def _fast_parse(datestr, end):
+    """Parse the common forms without dateutil, or return None
+    if the string isn't one of them."""
+    match = DATE_RE.match(datestr)
+    if match is None:
+        return
+    year, month, day = match.groups()
+    year = int(year)
+    month = int(month) if month else (12 if end else 1)
+    if not 1 <= month <= 12 or year < 1:
+        return
+    if day:
+        day = int(day)
+    elif end:
+        day = calendar.monthrange(year, month)[1]
+    else:
+        day = 1
+    try:
+        return datetime.datetime(year, month, day)
+    except ValueError:
+        return
+
+
+def _slow_parse(datestr, end):
+    """Parse anything else with dateutil."""
+    if not end:
+        return parser.parse(datestr, yearfirst=True, default=START_DEFAULT)
+    try:
+        return parser.parse(datestr, yearfirst=True, default=END_DEFAULT)
+    except ValueError:
+        # the 31st isn't in the month given, so the day can't have
+        # been, and the end of the range is the end of the month
+        date = parser.parse(datestr, yearfirst=True, default=START_DEFAULT)
+        return date.replace(day=calendar.monthrange(date.year, date.month)[1])
+
+
+def parse(datestr, end=False):
+    """Parse a date string, filling in any missing month or day as
+    the start of the period it covers, or the end if `end` is set.
+    Raises ValueError if it isn't a date."""
+    key = (datestr, end)
+    result = CACHE.get(key)
+    if result is None:
+        cleaned = clean(datestr)
+        try:
+            result = _fast_parse(cleaned, end) or _slow_parse(cleaned, end)
+        except ValueError, e:
+            result = e
+        CACHE.put(key, result)
+    if isinstance(result, ValueError):
+        raise result
+    return result
+
+
+def date_range(dates):
+    """Get the start and (if there is one) end dates from a list
+    of date strings.  If there are two dates assume them to be
+    start->end."""
+    datedict = dict()
+    if dates:
+        datedict["start_date"] = parse(dates[0])
+    if len(dates) == 2:
+        end = parse(dates[1], end=True)
+        if end > datedict["start_date"]:
+            datedict["end_date"] = end
+    return datedict
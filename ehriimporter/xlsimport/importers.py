@@ -3,23 +3,56 @@
 import re
 import sys
 import datetime
-from dateutil import parser
 from incf.countryutils import data as countrydata
-import phpserialize
 import unicodedata
-from sqlaqubit import models, keys, create_engine, init_models
-from sqlalchemy.engine.url import URL
+from sqlaqubit import models, keys
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.orm import attributes, object_mapper
+from sqlalchemy.orm.interfaces import ONETOMANY
 from sqlalchemy import and_
 
+from xlsimport import cache
+from xlsimport import connections
+from xlsimport import dates as xlsdates
+from xlsimport import journal
 from xlsimport import validators
+from xlsimport import lookups
+from xlsimport import parallel
+from xlsimport import pipeline
+from xlsimport import registry
+from xlsimport import scheduler
+from xlsimport import stats
 from xlsimport import utils
+from xlsimport import writers
 from ordereddict import OrderedDict
 
 class XLSImportError(Exception):
     """Excel import errors."""
 
 
+def loaded_children(obj):
+    """Yield the rows hanging off a record in its one-to-many
+    relationships which have already been loaded, i.e. its i18n
+    rows, slug and relations, but not the records below it in the
+    tree, without loading any more."""
+    mapper = object_mapper(obj)
+    loaded = attributes.instance_state(obj).dict
+    for prop in mapper.iterate_properties:
+        if getattr(prop, "direction", None) is not ONETOMANY \
+                or prop.key not in loaded \
+                or mapper.isa(prop.mapper) or prop.mapper.isa(mapper):
+            continue
+        value = loaded[prop.key]
+        if value is None:
+            continue
+        if not prop.uselist:
+            value = [value]
+        elif isinstance(value, dict):
+            value = value.values()
+        for child in value:
+            yield child
+
+
 SLUGIFY_STRIP_RE = re.compile(r'[^\w\s-]')
 SLUGIFY_HYPHENATE_RE = re.compile(r'[-\s]+')
 def slugify(value):
@@ -47,112 +80,364 @@ class XLSImporter(object):
     """Base class for repository importer."""
     def __init__(self, database=None, username=None,
                 password=None, hostname="localhost", port=None, atomuser=None,
-                rowfunc=None, donefunc=None):
-        engine = create_engine(URL("mysql",
-            username=username,
-            password=password,
-            host=hostname,
-            database=database,
-            port=port,
-            query=dict(
-                charset="utf8",
-                use_unicode=0
-            )
-        ))
-        init_models(engine)
+                rowfunc=None, donefunc=None, phasefunc=None, batch_size=None,
+                writer="orm", url=None, concurrent=False, pipelined=False,
+                journalled=False):
+        # how to make another importer like this one, i.e. in a
+        # worker process
+        self.arguments = dict(database=database, username=username,
+                password=password, hostname=hostname, port=port,
+                atomuser=atomuser, batch_size=batch_size, writer=writer, url=url,
+                concurrent=concurrent, pipelined=pipelined, journalled=journalled)
+        # queries and phase timings for this import
+        self.stats = stats.ImportStats()
+        self.stats.activate()
+        self.stats.enter("opening")
+        # engines and reference records are shared by every
+        # importer in the process
+        self.engine = connections.get_engine(database, username, password,
+                hostname, port, url=url)
         self.session = models.Session()
+        # reference and cached records are kept between batches,
+        # so don't make them reload themselves after every commit
+        self.session.expire_on_commit = False
         self.donefunc = donefunc
         self.rowfunc = rowfunc
+        # called with the name of each phase of the import as it starts
+        self.phasefunc = phasefunc
+        self.phase = None
+        # commit every N rows, or only at the end if None
+        self.batch_size = batch_size
+        # read and transform rows in threads of their own while
+        # writing, see `pipeline`
+        self.pipelined = pipelined
+        # how leaf records are written, see writers.WRITERS
+        self.writer = writers.WRITERS[writer](self.session)
         self.timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
 
-        self.user = self.session.query(models.User).filter(
-                models.User.username == atomuser).one()
-        # load default status and detail... this is where
-        # SQLAlchemy gets horrible
-        self.status = self.session.query(models.Term)\
-                .filter(models.Term.taxonomy_id == keys.TaxonomyKeys\
-                    .DESCRIPTION_STATUS_ID)\
-                .join(models.TermI18N, models.Term.id == models.TermI18N.id)\
-                .filter(models.TermI18N.name == "Draft").one()
-        self.detail = self.session.query(models.Term)\
-                .filter(models.Term.taxonomy_id == keys.TaxonomyKeys\
-                    .DESCRIPTION_DETAIL_LEVEL_ID)\
-                .join(models.TermI18N, models.Term.id == models.TermI18N.id)\
-                .filter(models.TermI18N.name == "Partial").one()
-        self.actorroot = self.session.query(models.Actor).filter(
-                models.Actor.id==keys.ActorKeys.ROOT_ID).one()
-        self.termroot = self.session.query(models.Term).filter(
-                models.Term.id==keys.TermKeys.ROOT_ID).one()
-        # running count of slugs used so far in the import transaction
-        self.slugs = {}
-        self.ids = {}
+        self.user = self.reference("user", atomuser)
+        # default status and detail
+        self.status = self.reference("status")
+        self.detail = self.reference("detail")
+        self.actorroot = self.reference("actorroot")
+        self.termroot = self.reference("termroot")
+        # slugs in the DB plus those used so far in the import
+        # transaction, the former shared by every importer in the
+        # process
+        self.slugs = registry.SlugRegistry(
+                connections.SLUGS.taken(self.session, self.engine))
+        # locks and reservations for running alongside other
+        # imports into the same DB, if we are
+        self.scheduler = scheduler.Scheduler(self.engine) if concurrent else None
+        self.ids = registry.IdentifierAllocator(self.session,
+                reserver=self.scheduler)
+        # row number -> slug, for slugs handed out before the import
+        # or, once they've been imported, to the rows
+        self.row_slugs = {}
+        # the rows committed so far, if journalling, see `start_journal`
+        self.journalled = journalled
+        self.journal = None
+        self.authorities = lookups.AuthorityIndex(self.session)
+        self.terms = lookups.TermCache(self.session)
+
+    def reference(self, name, *args):
+        """Get one of the reference records from connections.QUERIES
+        in our session, without asking the DB if some importer in
+        this process has already looked it up."""
+        return connections.REFERENCES.get(self.session, self.engine, name, *args)
 
     def random_slug(self):
         """Get a completely random 6-letter slug (for things
         like Event objects - don't blame me for this.)"""
-        while True:
-            potential = utils.get_random_string(6)
-            if not self.session.query(models.Slug)\
-                    .filter(models.Slug.slug == potential).count():
-                return potential
+        return self.slugs.random(6)
 
+    @stats.call_site
     def unique_slug(self, value):
         """Get a slug not currently used in the DB. FIXME: This
-        is not an atomic operation."""
-        suffix = 0
-        potential = base = slugify(value)
-        while True:
-            if suffix:
-                potential = "-".join([base, str(suffix)])
-            if not self.session.query(models.Slug)\
-                    .filter(models.Slug.slug == potential).count()\
-                        and self.slugs.get(potential) is None:
-                self.slugs[potential] = True
-                return potential
-            # we hit a conflicting slug, so bump the suffix & try again
-            suffix += 1
-
+        is not an atomic operation, see `check_slugs`."""
+        return self.slugs.unique(slugify(value))
+
+    def row_slug(self, rownum, value):
+        """Get the slug for the record imported from a row, unless
+        one was set aside for it before the import started."""
+        slug = self.row_slugs.get(rownum)
+        if slug is None:
+            slug = self.row_slugs[rownum] = self.unique_slug(value)
+            return slug
+        return self.slugs.claim(slug)
+
+    def locked(self, name):
+        """One of the scheduler's locks on the DB, for a section
+        which mustn't run at the same time as in other imports, or
+        a stand-in if we're not being run alongside others."""
+        if self.scheduler is None:
+            return scheduler.NullLock()
+        return self.scheduler.lock(name)
+
+    def start_journal(self, xlsfile, resume=False):
+        """Start journalling the rows committed, so that if the
+        import fails it can be resumed.  If resuming, the rows the
+        last run of an import of the same file into the same DB
+        committed are skipped."""
+        self.journal = journal.Journal.start(self.engine,
+                cache.file_digest(xlsfile), self.__class__.__name__, resume)
+        if self.journal.finished is not None:
+            raise XLSImportError("Import of this file already finished at: %s" % (
+                self.journal.finished))
+
+    def pending_rows(self):
+        """Yield the rows which haven't already been imported by a
+        run of the import being resumed."""
+        done = self.journal.done if self.journal is not None else ()
+        for rownum, record in self.iter_rows():
+            if rownum not in done:
+                yield rownum, record
+
+    def create_shared(self):
+        """Create the records rows might share, i.e. terms and
+        authorities, and commit them, so other imports, or other
+        parts of this one, find them rather than making their own."""
+        with self.locked("references"):
+            self.prepare()
+            for rownum, record in self.pending_rows():
+                self.prepare_row(rownum, record)
+            self.commit()
+
+    def assign_row_slugs(self):
+        """Pick the slug for each row's record up-front.  If we're
+        being run alongside other imports they're claimed in the DB,
+        picking again for any which another import has used or
+        claimed since we loaded the slugs."""
+        values = {}
+        for rownum, record in self.pending_rows():
+            value = self.slug_value(record)
+            if value is not None:
+                values[rownum] = value
+                self.row_slugs[rownum] = self.unique_slug(value)
+        if self.scheduler is None:
+            return
+        with self.locked("slugs"):
+            picked = dict(self.row_slugs)
+            while picked:
+                taken = self.scheduler.taken(picked.values())
+                self.slugs.mark_taken(taken)
+                picked = dict((rownum, self.unique_slug(values[rownum])) \
+                        for rownum, slug in picked.iteritems() if slug in taken)
+                self.row_slugs.update(picked)
+            self.scheduler.claim(self.row_slugs.values())
+
+    @stats.call_site
+    def check_slugs(self):
+        """Make sure none of the slugs we've handed out in memory
+        have been taken, or claimed by another import, since they
+        were loaded."""
+        clashes = self.slugs.verify(self.engine)
+        if self.scheduler is not None:
+            clashes.update(self.scheduler.taken(self.slugs.pending))
+        if clashes:
+            raise XLSImportError("Slugs taken during import: %s" % (
+                ", ".join(sorted(clashes))))
+
+    @stats.call_site
     def unique_identifier(self, model, prefix, suffix, format="%d", attr="identifier"):
-        """Get an id based on an incremented index of the
-        object count for the given model.  FIXME: Not very safe
-        or atomic."""
-        potid = self.session.query(model).count()
-        pattern = u"%s" + format + "%s"
-        while True:
-            potid += 1
-            potential = pattern % (prefix, potid, suffix)
-            if self.session.query(model).filter(getattr(model, attr)==potential)\
-                        .count() == 0:
-                return potential
+        """Get an id based on an incremented index of the highest
+        identifier with the given prefix and suffix.  FIXME: Not
+        atomic if somebody else is writing to the same table."""
+        return self.ids.next(model, prefix, suffix, format=format, attr=attr)
+
+    def prepare(self):
+        """Hook for loading things the import will need in bulk,
+        before any rows are imported."""
+        pass
+
+    def prepare_row(self, rownum, record, lang="en"):
+        """Hook for creating the records a row refers to which other
+        rows might refer to as well, i.e. terms and authorities, so a
+        parallel import can create them before the rows are shared
+        out between workers."""
+        pass
+
+    def transform_row(self, rownum, record, lang="en"):
+        """Do the work of importing a row which doesn't need the DB,
+        i.e. splitting its cells and parsing its dates, and return
+        the results in a dict for `import_row`.  In a pipelined
+        import this runs in a thread of its own, so it mustn't touch
+        the session or anything else `import_row` changes."""
+        for heading in record:
+            record.cell(heading)
+        return {}
+
+    def identifier_pattern(self, record):
+        """The (model, prefix, suffix, format) of the identifier the
+        record imported from a row gets, or None."""
+        return None
+
+    def slug_value(self, record):
+        """The value the slug of the record imported from a row is
+        made from, or None."""
+        return None
+
+    def set_phase(self, phase):
+        """Note that the import has moved on to another phase, i.e.
+        validating, importing, flushing or committing."""
+        self.phase = phase
+        self.stats.enter(phase)
+        if self.phasefunc:
+            self.phasefunc(phase)
 
     def import_xls(self, xlsfile):
         """Actually import the file."""
-        for row in range(self.HEADING_ROW+1, self.sheet.nrows):
-            data = [d.value for d in self.sheet.row_slice(row, 0, len(self.HEADINGS))]
-            obj = self.import_row(row, OrderedDict(zip(self.HEADINGS, data)))
-            if self.rowfunc:
-                self.rowfunc(obj)
+        self.set_phase("importing")
+        self.prepare()
+        if self.pipelined:
+            rows = pipeline.Pipeline(self.pending_rows(), self.transform_row)
+        else:
+            rows = ((rownum, record, self.transform_row(rownum, record)) \
+                    for rownum, record in self.pending_rows())
+        count = 0
+        try:
+            for rownum, record, payload in rows:
+                obj = self.import_row(rownum, record, payload=payload)
+                if self.journal is not None:
+                    self.journal.add(rownum, getattr(obj, "identifier", None),
+                            self.row_slugs.get(rownum))
+                if self.rowfunc:
+                    self.rowfunc(obj)
+                count += 1
+                self.stats.rows = count
+                if self.batch_size and count % self.batch_size == 0:
+                    self.commit()
+                    self.release()
+                    self.set_phase("importing")
+        finally:
+            if self.pipelined:
+                rows.close()
 
-        self.session.commit()
+        self.commit()
         if self.donefunc:
             self.donefunc()
 
+    def commit(self):
+        """Write everything imported so far to the DB.  Checking
+        the slugs and committing them mustn't be interleaved with
+        other imports doing the same."""
+        self.set_phase("flushing")
+        self.flush()
+        with self.locked("slugs"):
+            self.check_slugs()
+            if self.journal is not None:
+                self.journal.write(self.session.connection())
+            self.set_phase("committing")
+            self.session.commit()
+        self.slugs.commit()
+        if self.journal is not None:
+            self.journal.committed()
+
+    @stats.call_site
+    def flush(self):
+        """Flush the session, then whatever the writer has buffered."""
+        self.session.flush()
+        self.writer.flush(self.session.connection())
+
+    def retained(self):
+        """Records which are kept in the session between batches,
+        i.e. reference terms and cached lookups."""
+        objs = [self.user, self.status, self.detail, self.actorroot, self.termroot]
+        objs.extend(self.authorities.actors.values())
+        objs.extend(self.terms.terms.values())
+        return objs
+
+    def release(self):
+        """Expunge committed rows from the session so memory use
+        stays flat, keeping only the retained records and the rows
+        hanging off them, so that they can still be updated."""
+        keep = set()
+        for obj in self.retained():
+            keep.add(id(obj))
+            keep.update(id(child) for child in loaded_children(obj))
+        for obj in list(self.session.identity_map.values()):
+            if id(obj) not in keep and obj in self.session:
+                self.session.expunge(obj)
+
     def validate_xls(self, xlsfile):
-        """Check file is A-Okay."""
-        self.validate(xlsfile)
+        """Check file is A-Okay, keeping the parsed rows for the
+        import.  Results for a file we've seen before come from
+        the validation cache."""
+        cache.validate(self, xlsfile)
+        if self.errors:
+            raise XLSImportError("XLS validation error: %s" % self.errors)
+
+    def track_references(self, rownum, rowdata):
+        """Hook for noting values in a row which refer to records
+        in the DB, to be checked by `check_references`."""
+        pass
+
+    def check_references(self):
+        """Hook for checking values which refer to records in the
+        DB, once all the rows have been seen."""
+        pass
+
+    def validate_rows(self):
+        """Run the checks on validated rows which need the DB,
+        and so can't be done (or cached) along with the rest."""
+        nrows = 0
+        for rownum, rowdata in self.iter_rows():
+            nrows += 1
+            self.track_references(rownum, rowdata)
+        self.nrows = nrows
+        self.check_references()
         if self.errors:
             raise XLSImportError("XLS validation error: %s" % self.errors)
 
-    def do(self, xlsfile):
-        """Import an XLS file."""
+    def do(self, xlsfile, workers=1, resume=False):
+        """Import an XLS file, or the rows already spooled by a
+        previous validation if there are any, and return a report
+        of the queries made and time taken.  With more than one
+        worker the rows are shared out between that many processes,
+        see `parallel`.  If `resume` is set, rows committed by the
+        last run of an import of the file which failed are skipped,
+        see `start_journal`; the run being resumed must have been
+        `journalled`."""
+        if workers > 1:
+            report, errors = parallel.import_parallel(self, xlsfile, workers,
+                    resume)
+            if errors:
+                raise XLSImportError("Parallel import failed: %s" % (
+                    "\n".join(errors)))
+            if self.donefunc:
+                self.donefunc()
+            return report
         try:
-            self.validate_xls(xlsfile)
+            self.set_phase("validating")
+            if self.rows is None:
+                self.validate_xls(xlsfile)
+            self.validate_rows()
+            if xlsfile is not None and (self.journalled or resume):
+                self.start_journal(xlsfile, resume)
+            # a partition's shared records and slugs were seen to
+            # by the import which shared it out
+            if self.scheduler is not None and not self.scheduler.adopted:
+                self.set_phase("preparing")
+                self.create_shared()
+                self.assign_row_slugs()
             self.import_xls(xlsfile)
+            # a partition's journal is finished by the import which
+            # shared it out, once they're all done
+            if xlsfile is not None and self.journal is not None:
+                self.journal.finish(self.engine)
         finally:
+            if self.scheduler is not None:
+                self.scheduler.release()
+            self.close_xls()
+            self.discard_rows()
             self.session.close()
+            self.stats.enter(None)
+            self.stats.deactivate()
+        return self.stats.report()
 
-    def import_row(self, rownum, rowdata, lang="en"):
-        """Abstract implementation."""
+    def import_row(self, rownum, rowdata, lang="en", payload=None):
+        """Abstract implementation.  `payload` is what
+        `transform_row` returned for the row."""
         pass
 
     def add_note(self, item, record, field, typekey, scope, lang="en"):
@@ -160,67 +445,56 @@ class XLSImporter(object):
         ARCHIVIST_NOTE_ID, MAINTENANCE_NOTE_ID."""
         text = record[field].strip()
         if text:
-            note = models.Note(
-                    object_id=item.id,
-                    type_id=typekey,
-                    user=self.user,
-                    source_culture=lang,
-                    scope=scope
-            )
-            item.notes.append(note)
-            note.set_i18n(dict(content=text), lang)
+            self.writer.note(item, typekey, scope, text, self.user, lang)
 
     def add_alt_names(self, item, record, field, termid, lang="en"):
         """Add an alternative name with the given term id, i.e.
         OTHER_FORM_OF_NAME_ID, PARALLEL_FORM_OF_NAME_ID."""
-        for name in split_multiple(record[field]):
-            othername = models.OtherName(
-                    object_id=item.id,
-                    type_id=termid,
-                    source_culture=lang
-            )
-            item.other_names.append(othername)
-            othername.set_i18n(dict(
-                name=name
-            ), lang)
+        for name in record.split(field):
+            self.writer.other_name(item, termid, name, lang)
 
+    @stats.call_site
     def add_term(self, termstr, item, typeid, lang="en"):
         """Add a term with a given taxonomy, i.e. subject
-        or place."""
-        term = models.Term(taxonomy_id=typeid, parent=self.termroot,
-                source_culture=lang)
-        self.session.add(term)
-        term.set_i18n(dict(name=termstr), lang)
-        term.slug.append(models.Slug(slug=self.unique_slug(termstr)))
-        relation = models.ObjectTermRelation(
-                object=item, term=term)
-        self.session.add(relation)
-
+        or place, creating the term only if it doesn't already
+        exist."""
+        self.writer.term_relation(item, self.get_or_create_term(termstr, typeid, lang))
+
+    def get_or_create_term(self, termstr, typeid, lang="en"):
+        """Find a term in the given taxonomy, or create it."""
+        term = self.terms.get(typeid, termstr, lang)
+        if term is None:
+            term = models.Term(taxonomy_id=typeid, parent=self.termroot,
+                    source_culture=lang)
+            self.session.add(term)
+            term.set_i18n(dict(name=termstr), lang)
+            self.writer.slug(term, self.unique_slug(termstr))
+            self.terms.add(typeid, termstr, lang, term)
+        return term
+
+    @stats.call_site
     def _get_or_create_authority(self, name, typeid, history=None, lang="en"):
         """Find an authority with the given name, or create it
         with the given type."""
         name = name.rstrip(",")
-        try:
-            person = self.session.query(models.Actor).join(
-                    models.ActorI18N, models.Actor.id==models.ActorI18N.id).filter(
-                            models.ActorI18N.authorized_form_of_name==name)\
-                    .one()
+        person = self.authorities.get(name)
+        if person is not None:
             if history:
                 if not person.get_i18n()["history"]:
                     person.set_i18n(dict(history=history), lang)
                 else:
                     sys.stderr.write("Found '%s' in authority records, not updating history\n." % name)
             return person
-        except NoResultFound:
-            person = models.Actor(entity_type_id=typeid, source_culture=lang,
-                parent=self.actorroot,
-                description_status=self.status,
-                description_detail=self.detail
-            )
-            self.session.add(person)
-            person.set_i18n(dict(authorized_form_of_name=name, history=history), lang)
-            person.slug.append(models.Slug(slug=self.unique_slug(name)))
-            return person
+        person = models.Actor(entity_type_id=typeid, source_culture=lang,
+            parent=self.actorroot,
+            description_status=self.status,
+            description_detail=self.detail
+        )
+        self.session.add(person)
+        person.set_i18n(dict(authorized_form_of_name=name, history=history), lang)
+        self.writer.slug(person, self.unique_slug(name))
+        self.authorities.add(name, person)
+        return person
 
     def add_name_access(self, name, typeid, item, lang="en"):
         """Add an associated name."""
@@ -229,50 +503,41 @@ class XLSImporter(object):
                 type_id=keys.TermKeys.NAME_ACCESS_POINT_ID)
         self.session.add(relation)
 
-    def _parse_dates(self, datestr):
-        """Coerce a date string into a dictionary of relevant
+    def _parse_dates(self, dates):
+        """Coerce a list of date strings into a dictionary of relevant
         dates. If there are two dates assume them to be start->end."""
-        datedict = dict()
-        dates = split_multiple(datestr)
-        if dates:
-            print dates
-            datedict["start_date"] = parser.parse(dates[0].replace("c", "").replace(".0", ""),
-                        yearfirst=True,
-                        default=datetime.datetime(1900,1,1))
-        if len(dates) == 2:
-            d2 = parser.parse(dates[1].replace("c", "").replace(".0", ""),
-                        yearfirst=True,
-                        default=datetime.datetime(1900,12,31))
-            if d2 > datedict["start_date"]:
-                datedict["end_date"] = d2
+        datedict = xlsdates.date_range(dates)
         # NB: Hack, converting dates to isoformat to work around
         # bug in MySQLdb module that doesn't handle dates < 1900.
         # Using a string works, however...
         return dict((k, v.isoformat()) for k, v in datedict.items())
 
-    def add_dates(self, datestr, item, typeid, name=None, history=None, lang="en"):
-        """Add a date as an event object."""
-        datedict = self._parse_dates(datestr)
+    def add_dates(self, dates, item, typeid, name=None, history=None, lang="en"):
+        """Add a date as an event object, given the dates parsed
+        from a date field by `_parse_dates`."""
+        datedict = dict(dates)
         if name is not None:
-            ctypeid = keys.TermKeys.PERSON_ID
-            if name.startswith("[org] "):
-                name = name.replace("[org] ", "")
-                ctypeid = keys.TermKeys.CORPORATE_BODY_ID
-            datedict["actor"] = self._get_or_create_authority(
-                    name, ctypeid, history, lang)
+            datedict["actor"] = self.get_creator(name, history, lang)
         datedict.update(information_object=item, source_culture=lang, type_id=typeid)
         # rely on the validator to check this doesn't explode
         event = models.Event(**datedict)
         item.events.append(event)
         # add a random slug for the event (this is really wrong
         # but it's how qubit works...
-        event.slug.append(models.Slug(slug=self.random_slug()))
+        self.writer.slug(event, self.random_slug())
+
+    def get_creator(self, name, history=None, lang="en"):
+        """Find or create the authority for a creator, which is a
+        corporate body if marked with [org], else a person."""
+        ctypeid = keys.TermKeys.PERSON_ID
+        if name.startswith("[org] "):
+            name = name.replace("[org] ", "")
+            ctypeid = keys.TermKeys.CORPORATE_BODY_ID
+        return self._get_or_create_authority(name, ctypeid, history, lang)
 
     def add_property(self, item, name, value, lang="en"):
         """Add a property to the object."""
-        prop = models.Property(name=name, source_culture=lang)
-        item.properties.append(prop)
-        prop.set_i18n(dict(value=phpserialize.dumps(value)), lang)
+        self.writer.property(item, name, value, lang)
 
 
 
@@ -281,17 +546,38 @@ class Repository(validators.Repository, XLSImporter):
     def __init__(self, *args, **kwargs):
         XLSImporter.__init__(self, *args, **kwargs)
         validators.Repository.__init__(self)
-        self.parent = self.session.query(models.Actor)\
-                .filter(models.Actor.id==keys.ActorKeys.ROOT_ID).one()
+        self.parent = self.reference("actorroot")
+
+    def retained(self):
+        """Records which are kept in the session between batches."""
+        return XLSImporter.retained(self) + [self.parent]
+
+    def identifier_pattern(self, record):
+        code = utils.get_code_from_country(record["country"].strip())
+        return models.Repository, "r", code, "%06d"
+
+    def slug_value(self, record):
+        return record["authorized_form_of_name"]
+
+    def transform_row(self, rownum, record, lang="en"):
+        payload = XLSImporter.transform_row(self, rownum, record, lang)
+        revision = "Imported from EHRI spreadsheet at: %s" % self.timestamp
+        i18ndict = dict((k, v) for k, v in record.iteritems() \
+                if k in self.plan.i18n_set)
+        i18ndict.update(desc_revision_history=revision, desc_rules="ISDIAH",
+                desc_sources="\n".join(record.split("sources")))
+        payload["i18n"] = i18ndict
+        return payload
 
-    def import_row(self, rownum, record, lang="en"):
+    def import_row(self, rownum, record, lang="en", payload=None):
         """Import a single repository."""
+        if payload is None:
+            payload = self.transform_row(rownum, record, lang)
         code = utils.get_code_from_country(record["country"].strip())
         name = record["authorized_form_of_name"]
         # FIXME: wrong lang, etc
         print name
-        identifier = self.unique_identifier(models.Repository,
-                "r", code, format="%06d")
+        identifier = self.unique_identifier(*self.identifier_pattern(record))
         repo = models.Repository(
             identifier=identifier,
             entity_type_id=keys.TermKeys.CORPORATE_BODY_ID,
@@ -303,15 +589,10 @@ class Repository(validators.Repository, XLSImporter):
             desc_detail=self.detail
         )
         self.session.add(repo)
-        revision = "Imported from EHRI spreadsheet at: %s" % self.timestamp
-        i18ndict = dict((k, v) for k, v in record.iteritems() \
-                if k in self.I18N)
-        i18ndict.update(desc_revision_history=revision, desc_rules="ISDIAH",
-                desc_sources="\n".join(split_multiple(record["sources"])))
-        repo.set_i18n(i18ndict, lang)
+        repo.set_i18n(payload["i18n"], lang)
 
         # add a slug
-        repo.slug.append(models.Slug(slug=self.unique_slug(name)))
+        self.writer.slug(repo, self.row_slug(rownum, self.slug_value(record)))
 
         # add a note
         self.add_note(repo, record, "notes",
@@ -333,7 +614,7 @@ class Repository(validators.Repository, XLSImporter):
         propdict = dict(language_of_description="languageOfDescription",
                 script_of_description="scriptOfDescription")
         for name, prop in propdict.iteritems():
-            self.add_property(repo, prop, split_multiple(record[name]), lang)
+            self.add_property(repo, prop, record.split(name), lang)
 
         # handle ehri-specific metadata
         ehrimeta = dict(
@@ -368,11 +649,15 @@ class Repository(validators.Repository, XLSImporter):
 
         # some fields can have multiple values, which we need
         # to stick in a secondary contact model
-        contact_fields = list(set(self.CONTACTS).difference(self.I18N))
+        contact_fields = [f for f in self.plan.contacts \
+                if f not in self.plan.i18n_set]
         contacts = []
         for field in contact_fields:
             multival = record.get(field, "")
-            fieldvals = split_multiple(cleanfloat(multival))
+            if isinstance(multival, float):
+                fieldvals = split_multiple(cleanfloat(multival))
+            else:
+                fieldvals = record.split(field)
             for i in range(len(fieldvals)):
                 if i + 1 > len(contacts):
                     contacts.append({})
@@ -389,44 +674,109 @@ class Repository(validators.Repository, XLSImporter):
 
 class Collection(validators.Collection, XLSImporter):
     """Import repository information."""
+    # access point fields -> taxonomy
+    TERM_FIELDS = dict(subject_access=keys.TaxonomyKeys.SUBJECT_ID,
+            place_access=keys.TaxonomyKeys.PLACE_ID)
+
     def __init__(self, *args, **kwargs):
         XLSImporter.__init__(self, *args, **kwargs)
         validators.Collection.__init__(self)
 
-        self.parent = self.session.query(models.InformationObject)\
-                .filter(models.InformationObject.id==keys.InformationObjectKeys.ROOT_ID)\
-                .one()
-        self.pubtype = self.session.query(models.Term)\
-                .filter(models.Term.taxonomy_id == keys.TaxonomyKeys\
-                    .STATUS_TYPE_ID)\
-                .join(models.TermI18N, models.Term.id == models.TermI18N.id)\
-                .filter(models.TermI18N.name == "publication").one()
-        self.lod_coll = self.session.query(models.Term)\
-                .filter(models.Term.taxonomy_id == keys.TaxonomyKeys\
-                    .LEVEL_OF_DESCRIPTION_ID)\
-                .join(models.TermI18N, models.Term.id == models.TermI18N.id)\
-                .filter(models.TermI18N.name == "Collection").one()
-        self.pubstatus = self.session.query(models.Term)\
-                .filter(models.Term.taxonomy_id == keys.TaxonomyKeys\
-                    .PUBLICATION_STATUS_ID)\
-                .join(models.TermI18N, models.Term.id == models.TermI18N.id)\
-                .filter(models.TermI18N.name == "draft").one()
-
-    def import_row(self, rownum, record, lang="en"):
+        self.parent = self.reference("inforoot")
+        self.pubtype = self.reference("pubtype")
+        self.lod_coll = self.reference("lod_coll")
+        self.pubstatus = self.reference("pubstatus")
+        # repositories referred to by the sheet, keyed on id
+        self.repositories = {}
+        # repository codes seen during validation -> row numbers
+        self.repository_rows = OrderedDict()
+        # creators and name access points seen during validation
+        self.authority_names = []
+
+    def retained(self):
+        """Records which are kept in the session between batches."""
+        return XLSImporter.retained(self) + [self.parent, self.pubtype,
+                self.lod_coll, self.pubstatus] + self.repositories.values()
+
+    @stats.call_site
+    def prepare(self):
+        """Look up the access point terms, and all the creators
+        and name access points noted during validation, in as few
+        queries as possible."""
+        self.terms.load(keys.TaxonomyKeys.SUBJECT_ID)
+        self.terms.load(keys.TaxonomyKeys.PLACE_ID)
+        self.authority_names, names = [], self.authority_names
+        self.authorities.prefetch(names)
+
+    def track_references(self, rownum, rowdata):
+        """Note which repository a row belongs to, and the names
+        of the authorities it refers to."""
+        repoid = rowdata["repository_code"]
+        if rowdata.text("repository_code").strip():
+            self.repository_rows.setdefault(repoid, []).append(rownum)
+        self.authority_names.extend(rowdata.split("name_access"))
+        for name in rowdata.split("creator"):
+            self.authority_names.append(name.replace("[org] ", ""))
+
+    @stats.call_site
+    def check_references(self):
+        """Load all the repositories referred to by the sheet in
+        one go, and report any that don't exist as errors before
+        we start writing anything."""
+        rows, self.repository_rows = self.repository_rows, OrderedDict()
+        ids = set(self.coerce_int(v) for v in rows)
+        ids.discard(None)
+        for chunk in registry.chunked(ids):
+            for repo in self.session.query(models.Repository)\
+                    .filter(models.Repository.id.in_(chunk)):
+                self.repositories[repo.id] = repo
+        for repoid, rownums in rows.iteritems():
+            if self.coerce_int(repoid) not in self.repositories:
+                for rownum in rownums:
+                    self.add_error(rownum,
+                        "Unable to find repository with identifier: %s" % repoid)
+
+    def identifier_pattern(self, record):
+        return models.InformationObject, "c", "", "%09d"
+
+    def slug_value(self, record):
+        return record["title"]
+
+    def prepare_row(self, rownum, record, lang="en"):
+        """Create the terms and authorities a row refers to, in the
+        same order `import_row` would."""
+        for key, termid in self.TERM_FIELDS.iteritems():
+            for val in record.split(key):
+                self.get_or_create_term(val, termid, lang)
+        for name in record.split("name_access"):
+            self._get_or_create_authority(name, keys.TermKeys.PERSON_ID,
+                    history=None, lang=lang)
+        self.get_creator(record["creator"], record["biographical_history"], lang)
+
+    def transform_row(self, rownum, record, lang="en"):
+        payload = XLSImporter.transform_row(self, rownum, record, lang)
+        revision = "Imported from EHRI Spreadsheet at: %s" % self.timestamp
+        i18ndict = dict(revision=revision, desc_rules=record["rules"])
+        for k, v in record.iteritems():
+            if k in self.plan.i18n_set:
+                i18ndict[k] = v.replace(",,", "\n")
+        payload.update(i18n=i18ndict,
+                dates=self._parse_dates(record.split("dates")))
+        return payload
+
+    def import_row(self, rownum, record, lang="en", payload=None):
         """Import a single collection."""
+        if payload is None:
+            payload = self.transform_row(rownum, record, lang)
         repoid = record["repository_code"]
 
-        # get the repo and let it error if not found
-        try:
-            repo = self.session.query(models.Repository)\
-                    .filter(models.Repository.id==repoid)\
-                    .one()
-        except NoResultFound:
+        # the repo should have been loaded during validation
+        repo = self.repositories.get(self.coerce_int(repoid))
+        if repo is None:
             raise XLSImportError("Unable to find repository with identifier: %s" % (
                 repoid))
 
-        identifier = self.unique_identifier(models.InformationObject,
-                "c", "", format="%09d")
+        identifier = self.unique_identifier(*self.identifier_pattern(record))
         info = models.InformationObject(
             identifier=identifier,
             source_culture=lang,
@@ -438,27 +788,19 @@ class Collection(validators.Collection, XLSImporter):
             source_standard="ISAD(G) 2nd Edition"
         )
         self.session.add(info)
-        revision = "Imported from EHRI Spreadsheet at: %s" % self.timestamp
-        i18ndict = dict(revision=revision, desc_rules=record["rules"])
-
-        for k, v in record.iteritems():
-            if k in self.I18N:
-                i18ndict[k] = v.replace(",,", "\n")
-        info.set_i18n(i18ndict, lang)
+        info.set_i18n(payload["i18n"], lang)
 
         # add term relations
-        termdict = dict(subject_access=keys.TaxonomyKeys.SUBJECT_ID,
-                place_access=keys.TaxonomyKeys.PLACE_ID)
-        for key, termid in termdict.iteritems():
-            for val in split_multiple(record[key]):
+        for key, termid in self.TERM_FIELDS.iteritems():
+            for val in record.split(key):
                 self.add_term(val, info, termid, lang)
 
         # add name access
-        for name in split_multiple(record["name_access"]):
+        for name in record.split("name_access"):
             self.add_name_access(name, keys.TermKeys.PERSON_ID, info, lang)
 
         # add a slug
-        info.slug.append(models.Slug(slug=self.unique_slug(record["title"])))
+        self.writer.slug(info, self.row_slug(rownum, self.slug_value(record)))
 
         # add various types of note...
         notedict = dict(
@@ -473,13 +815,11 @@ class Collection(validators.Collection, XLSImporter):
                 keys.TermKeys.OTHER_FORM_OF_NAME_ID, lang)
 
         # add creation dates
-        self.add_dates(record["dates"], info, keys.TermKeys.CREATION_ID,
+        self.add_dates(payload["dates"], info, keys.TermKeys.CREATION_ID,
                     record["creator"], record["biographical_history"], lang)
 
         # add a publication status ID
-        status = models.Status(object=info,
-                type_id=self.pubtype.id, status_id=self.pubstatus.id)
-        self.session.add(status)
+        self.writer.status(info, self.pubtype.id, self.pubstatus.id)
 
         propdict = dict(
                 language="language",
@@ -488,7 +828,7 @@ class Collection(validators.Collection, XLSImporter):
                 script_of_description="scriptOfDescription"
         )
         for name, prop in propdict.iteritems():
-            self.add_property(info, prop, split_multiple(record[name]), lang)
+            self.add_property(info, prop, record.split(name), lang)
 
         # handle ehri-specific metadata
         ehrimeta = dict(
@@ -0,0 +1,125 @@
+"""A journal of the rows each import has committed, and the
+identifiers and slugs they were given, so an import which dies part
+way through can be resumed rather than run again from the start.
+Imports are keyed on the digest of the file, the DB and the
+importer, and the journal is kept in tables of our own in the
+Qubit DB, written in the same transaction as the rows it records,
+so it never says a row was imported unless it really was.  Only
+imports which ask for it are journalled, and the tables are created
+once per DB by the create_importer_tables command, see `setup`."""
+
+import datetime
+
+from sqlalchemy import MetaData, Table, Column, ForeignKey
+from sqlalchemy import Integer, String, DateTime
+from sqlalchemy import select, and_
+
+from xlsimport import registry
+
+METADATA = MetaData()
+
+# each run of an import, finished once all its rows are committed
+IMPORTS = Table("xlsimport_import", METADATA,
+    Column("id", Integer, primary_key=True),
+    Column("digest", String(64), nullable=False, index=True),
+    Column("database", String(64), nullable=False),
+    Column("importer", String(64), nullable=False),
+    Column("started", DateTime, nullable=False),
+    Column("finished", DateTime),
+)
+
+# each batch of rows committed by an import
+CHECKPOINTS = Table("xlsimport_checkpoint", METADATA,
+    Column("id", Integer, primary_key=True),
+    Column("import_id", Integer, ForeignKey("xlsimport_import.id"), nullable=False),
+    Column("first_row", Integer, nullable=False),
+    Column("last_row", Integer, nullable=False),
+    Column("committed", DateTime, nullable=False),
+)
+
+# what each row in a checkpoint was imported as
+ROWS = Table("xlsimport_checkpoint_row", METADATA,
+    Column("checkpoint_id", Integer, ForeignKey("xlsimport_checkpoint.id"),
+            primary_key=True),
+    Column("rownum", Integer, primary_key=True, autoincrement=False),
+    Column("identifier", String(255)),
+    Column("slug", String(255)),
+)
+
+
+def setup(engine):
+    """Create the journal tables if they aren't there yet."""
+    METADATA.create_all(engine)
+
+
+class Journal(object):
+    """The journal of one run of an import.  Rows imported are
+    `add`ed, written along with the batch they're in by `write`,
+    and counted as done once the batch has been `committed`."""
+    def __init__(self, engine, import_id, done=(), finished=None):
+        self.engine = engine
+        self.import_id = import_id
+        # row numbers committed, by this run or the ones it resumes
+        self.done = set(done)
+        self.finished = finished
+        # (rownum, identifier, slug) of rows in the current batch
+        self.pending = []
+
+    @classmethod
+    def start(cls, engine, digest, importer, resume=False):
+        """Start journalling an import of a file, or, if resuming,
+        carry on the journal of its last run if there was one."""
+        key = and_(IMPORTS.c.digest == digest,
+                IMPORTS.c.database == (engine.url.database or ""),
+                IMPORTS.c.importer == importer)
+        conn = engine.connect()
+        try:
+            if resume:
+                last = conn.execute(select([IMPORTS.c.id, IMPORTS.c.finished])\
+                        .where(key).order_by(IMPORTS.c.id.desc()).limit(1)).first()
+                if last is not None:
+                    return cls(engine, last[0], cls.committed_rows(conn, last[0]),
+                            last[1])
+            result = conn.execute(IMPORTS.insert(), digest=digest,
+                    database=engine.url.database or "", importer=importer,
+                    started=datetime.datetime.now())
+            return cls(engine, result.inserted_primary_key[0])
+        finally:
+            conn.close()
+
+    @staticmethod
+    def committed_rows(bind, import_id):
+        """Get the row numbers committed by a run of an import."""
+        query = select([ROWS.c.rownum], from_obj=ROWS.join(CHECKPOINTS))\
+                .where(CHECKPOINTS.c.import_id == import_id)
+        return [row[0] for row in bind.execute(query)]
+
+    def add(self, rownum, identifier, slug):
+        self.pending.append((rownum, identifier, slug))
+
+    def write(self, bind):
+        """Record the current batch, in the transaction it's being
+        committed in, so `bind` should be the session's connection
+        rather than the session itself."""
+        if not self.pending:
+            return
+        rownums = [rownum for rownum, _, _ in self.pending]
+        result = bind.execute(CHECKPOINTS.insert(), import_id=self.import_id,
+                first_row=min(rownums), last_row=max(rownums),
+                committed=datetime.datetime.now())
+        checkpoint_id = result.inserted_primary_key[0]
+        for chunk in registry.chunked(self.pending):
+            bind.execute(ROWS.insert(), [dict(checkpoint_id=checkpoint_id,
+                    rownum=rownum, identifier=identifier, slug=slug) \
+                    for rownum, identifier, slug in chunk])
+
+    def committed(self):
+        """Note that the current batch has been committed."""
+        self.done.update(rownum for rownum, _, _ in self.pending)
+        self.pending = []
+
+    def finish(self, bind):
+        """Mark the import finished, so it isn't resumed."""
+        self.finished = datetime.datetime.now()
+        bind.execute(IMPORTS.update().where(IMPORTS.c.id == self.import_id),
+                finished=self.finished)
@@ -0,0 +1,115 @@
+"""Per-import caches of Qubit records which get looked up by
+name over and over again, i.e. authorities and terms."""
+
+import re
+import unicodedata
+
+from sqlaqubit import models
+
+from xlsimport.registry import chunked
+
+WHITESPACE_RE = re.compile(r"\s+", re.UNICODE)
+
+
+def normalize_name(name):
+    """Normalize a name for use as a lookup key, folding case
+    and whitespace in much the same way MySQL's default collation
+    does when comparing strings."""
+    if not isinstance(name, unicode):
+        name = str(name).decode("utf-8")
+    name = unicodedata.normalize("NFC", name)
+    return WHITESPACE_RE.sub(" ", name).strip().rstrip(",").lower()
+
+
+class AuthorityIndex(object):
+    """Actors keyed on their normalized authorized form of name.
+    Names can be prefetched in batches, any others are looked up
+    one at a time on first use, and actors created during the
+    import are added as we go so the DB never needs to be asked
+    about a name twice."""
+    def __init__(self, session):
+        self.session = session
+        self.actors = {}
+        self.missing = set()
+
+    def __contains__(self, name):
+        return normalize_name(name) in self.actors
+
+    def __len__(self):
+        return len(self.actors)
+
+    def _query(self, names):
+        return self.session.query(models.Actor,
+                    models.ActorI18N.authorized_form_of_name)\
+                .join(models.ActorI18N, models.Actor.id==models.ActorI18N.id)\
+                .filter(models.ActorI18N.authorized_form_of_name.in_(names))
+
+    def _load(self, names):
+        """Look up a batch of names and remember the ones which
+        weren't found."""
+        keys = set(normalize_name(n) for n in names)
+        for actor, name in self._query(names):
+            self.actors.setdefault(normalize_name(name), actor)
+        self.missing.update(keys.difference(self.actors))
+
+    def prefetch(self, names):
+        """Load the actors for a number of names using batched
+        IN (...) queries."""
+        wanted = {}
+        for name in names:
+            name = name.strip().rstrip(",")
+            key = normalize_name(name)
+            if key and key not in self.actors and key not in self.missing:
+                wanted[key] = name
+        for chunk in chunked(wanted.values()):
+            self._load(chunk)
+
+    def get(self, name):
+        """Get the actor with the given name, or None."""
+        key = normalize_name(name)
+        if key not in self.actors and key not in self.missing:
+            self._load([name])
+        return self.actors.get(key)
+
+    def add(self, name, actor):
+        """Add an actor created during the import."""
+        key = normalize_name(name)
+        self.missing.discard(key)
+        self.actors[key] = actor
+
+
+class TermCache(object):
+    """Terms keyed on (taxonomy id, culture, normalized name).
+    Each taxonomy is loaded in a single query the first time it
+    is needed, and terms created during the import are added as
+    we go."""
+    def __init__(self, session):
+        self.session = session
+        self.terms = {}
+        self.loaded = set()
+
+    def __len__(self):
+        return len(self.terms)
+
+    def load(self, taxonomy_id):
+        """Load all the terms in a taxonomy."""
+        if taxonomy_id in self.loaded:
+            return
+        query = self.session.query(models.Term,
+                    models.TermI18N.culture, models.TermI18N.name)\
+                .join(models.TermI18N, models.Term.id == models.TermI18N.id)\
+                .filter(models.Term.taxonomy_id == taxonomy_id)
+        for term, culture, name in query:
+            if name:
+                self.terms.setdefault(
+                        (taxonomy_id, culture, normalize_name(name)), term)
+        self.loaded.add(taxonomy_id)
+
+    def get(self, taxonomy_id, name, culture="en"):
+        """Get the term with the given name, or None."""
+        self.load(taxonomy_id)
+        return self.terms.get((taxonomy_id, culture, normalize_name(name)))
+
+    def add(self, taxonomy_id, name, culture, term):
+        """Add a term created during the import."""
+        self.terms[(taxonomy_id, culture, normalize_name(name))] = term
@@ -0,0 +1,155 @@
+"""
+Validate, and optionally import, a generated spreadsheet and compare
+the rows per second, queries per row and peak memory with a stored
+baseline.
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from xlsimport import benchmarks, validators
+
+class Command(BaseCommand):
+    """Benchmark validation and import."""
+    option_list = BaseCommand.option_list + (
+        make_option(
+                "-r",
+                "--rows",
+                action="store",
+                dest="rows",
+                type="int",
+                default=10000,
+                help="Number of rows to generate"),
+        make_option(
+                "-t",
+                "--type",
+                action="store",
+                dest="type",
+                default="Collection",
+                help="Sheet type (Repository or Collection)"),
+        make_option(
+                "-s",
+                "--seed",
+                action="store",
+                dest="seed",
+                type="int",
+                default=0,
+                help="Random seed for the generated sheet"),
+        make_option(
+                "--bad-rate",
+                action="store",
+                dest="bad_rate",
+                type="float",
+                default=benchmarks.BAD_RATE,
+                help="Proportion of bad rows in the validated sheet"),
+        make_option(
+                "--xlsx",
+                action="store_true",
+                dest="xlsx",
+                default=False,
+                help="Generate an .xlsx sheet rather than an .xls one"),
+        make_option(
+                "--url",
+                action="store",
+                dest="url",
+                help="URL of a throwaway stand-in DB to import into, "
+                     "i.e. sqlite:////tmp/qubit.db"),
+        make_option(
+                "--setup",
+                action="store_true",
+                dest="setup",
+                default=False,
+                help="Create the Qubit schema, reference records and "
+                     "repositories in the stand-in DB first"),
+        make_option(
+                "-u",
+                "--user",
+                action="store",
+                dest="user",
+                default="qubit",
+                help="User to own imported records"),
+        make_option(
+                "--repositories",
+                action="store",
+                dest="repositories",
+                default="1",
+                help="Comma-separated ids of repositories in the DB for "
+                     "collections to belong to"),
+        make_option(
+                "-b",
+                "--batch-size",
+                action="store",
+                dest="batch_size",
+                type="int",
+                help="Commit every N rows instead of only at the end"),
+        make_option(
+                "--pipelined",
+                action="store_true",
+                dest="pipelined",
+                default=False,
+                help="Also time a pipelined import"),
+        make_option(
+                "--baseline",
+                action="store",
+                dest="baseline",
+                help="JSON file of baseline results to compare with"),
+        make_option(
+                "--save-baseline",
+                action="store_true",
+                dest="save_baseline",
+                default=False,
+                help="Store the results as the new baseline"),
+        make_option(
+                "--tolerance",
+                action="store",
+                dest="tolerance",
+                type="float",
+                default=0.2,
+                help="How much worse than the baseline counts as a regression"),
+    )
+
+    def handle(self, *args, **options):
+        """Run the benchmarks."""
+        klass = getattr(validators, options["type"], None)
+        if klass not in validators.VALIDATORS:
+            raise CommandError("Unknown sheet type: %s" % options["type"])
+        try:
+            repositories = [int(r) for r in options["repositories"].split(",")]
+        except ValueError:
+            raise CommandError("Bad repository ids: %s" % options["repositories"])
+        if options["setup"]:
+            if not options["url"]:
+                raise CommandError("--setup needs a stand-in DB --url.")
+            benchmarks.setup_standin(options["url"], options["user"], repositories)
+            # the benchmarks run in child processes with their own
+            # connections, and only the import needs the DB libraries
+            from xlsimport import connections
+            connections.dispose_engines()
+        try:
+            results = benchmarks.run_suite(klass, options["rows"],
+                    seed=options["seed"], bad_rate=options["bad_rate"],
+                    url=options["url"], atomuser=options["user"],
+                    batch_size=options["batch_size"], repositories=repositories,
+                    fmt=".xlsx" if options["xlsx"] else ".xls",
+                    pipelined=options["pipelined"])
+        except benchmarks.BenchmarkError, e:
+            raise CommandError(e)
+        baseline = {}
+        if options["baseline"]:
+            baseline = benchmarks.load_baseline(options["baseline"]).get(klass.__name__, {})
+        for mode, result in sorted(results.iteritems()):
+            self.stdout.write("%s: %d rows, %d errors, %.2fs\n" % (
+                    mode, result["rows"], result["errors"], result["seconds"]))
+            for metric, _ in benchmarks.METRICS:
+                line = "  %-16s %12.2f" % (metric, result[metric])
+                if mode in baseline:
+                    line += " (baseline %.2f)" % baseline[mode][metric]
+                self.stdout.write(line + "\n")
+        if options["baseline"] and options["save_baseline"]:
+            benchmarks.save_baseline(options["baseline"], klass.__name__, results)
+            return
+        found = benchmarks.regressions(results, baseline, options["tolerance"])
+        if found:
+            raise CommandError("Regressions: %s" % ", ".join(
+                    "%s %s %.2f -> %.2f" % r for r in found))
@@ -0,0 +1,65 @@
+"""
+Create the tables the importer keeps in the Qubit DB.
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from xlsimport import connections, journal, scheduler
+
+class Command(BaseCommand):
+    """Create the importer's own tables in the Qubit DB, if they
+    aren't there already: the identifier reservations and slug
+    claims of concurrent imports, and the journal of imports which
+    can be resumed."""
+    option_list = BaseCommand.option_list + (
+        make_option(
+                "-U",
+                "--dbuser",
+                action="store",
+                dest="dbuser",
+                default="icaatom",
+                help="Database user"),
+        make_option(
+                "-p",
+                "--dbpass",
+                action="store",
+                dest="dbpass",
+                help="Database password"),
+        make_option(
+                "-H",
+                "--dbhost",
+                action="store",
+                dest="dbhost",
+                default="localhost",
+                help="Database host name"),
+        make_option(
+                "-P",
+                "--dbport",
+                action="store",
+                dest="dbport",
+                help="Database port"),
+        make_option(
+                "-D",
+                "--database",
+                action="store",
+                dest="database",
+                default="icaatom",
+                help="Database name"),
+        make_option(
+                "--url",
+                action="store",
+                dest="url",
+                help="URL of the DB, instead of the MySQL details, "
+                     "i.e. sqlite:////tmp/qubit.db"),
+    )
+
+    def handle(self, *args, **options):
+        """Create the tables."""
+        engine = connections.get_engine(options["database"], options["dbuser"],
+                options["dbpass"], options["dbhost"], options["dbport"],
+                url=options["url"])
+        scheduler.setup(engine)
+        journal.setup(engine)
+        self.stderr.write("Created importer tables in: %s\n" % engine.url)
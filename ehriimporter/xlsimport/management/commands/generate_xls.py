@@ -0,0 +1,71 @@
+"""
+Write a spreadsheet of made-up rows, for testing.
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from xlsimport import benchmarks, validators
+
+class Command(BaseCommand):
+    """Generate a test spreadsheet."""
+    args = "<XLS file>"
+    option_list = BaseCommand.option_list + (
+        make_option(
+                "-r",
+                "--rows",
+                action="store",
+                dest="rows",
+                type="int",
+                default=1000,
+                help="Number of rows to generate"),
+        make_option(
+                "-t",
+                "--type",
+                action="store",
+                dest="type",
+                default="Collection",
+                help="Sheet type (Repository or Collection)"),
+        make_option(
+                "-s",
+                "--seed",
+                action="store",
+                dest="seed",
+                type="int",
+                default=0,
+                help="Random seed"),
+        make_option(
+                "--bad-rate",
+                action="store",
+                dest="bad_rate",
+                type="float",
+                default=benchmarks.BAD_RATE,
+                help="Proportion of rows with an error in them"),
+        make_option(
+                "--repositories",
+                action="store",
+                dest="repositories",
+                default="1",
+                help="Comma-separated ids of repositories for "
+                     "collections to belong to"),
+    )
+
+    def handle(self, *args, **options):
+        """Write the sheet."""
+        if not args:
+            raise CommandError("No XLS file given.")
+        klass = getattr(validators, options["type"], None)
+        if klass not in validators.VALIDATORS:
+            raise CommandError("Unknown sheet type: %s" % options["type"])
+        try:
+            repositories = [int(r) for r in options["repositories"].split(",")]
+        except ValueError:
+            raise CommandError("Bad repository ids: %s" % options["repositories"])
+        generator = benchmarks.SheetGenerator(klass, options["seed"],
+                options["bad_rate"], repositories)
+        try:
+            bad = benchmarks.write_sheet(args[0], generator, options["rows"])
+        except benchmarks.BenchmarkError, e:
+            raise CommandError(e)
+        self.stdout.write("%d rows, %d bad\n" % (options["rows"], len(bad)))
@@ -6,7 +6,7 @@ from optparse import make_option
 
 from django.core.management.base import BaseCommand, CommandError
 
-from xlsimport import importers
+from xlsimport import importers, scheduler, stats
 
 class Command(BaseCommand):
     """Import to ICA Atom."""
@@ -45,6 +45,55 @@ class Command(BaseCommand):
                 dest="database",
                 default="icaatom",
                 help="Database name"),
+        make_option(
+                "-b",
+                "--batch-size",
+                action="store",
+                dest="batch_size",
+                type="int",
+                help="Commit every N rows instead of only at the end"),
+        make_option(
+                "-w",
+                "--workers",
+                action="store",
+                dest="workers",
+                type="int",
+                default=1,
+                help="Import with N worker processes"),
+        make_option(
+                "--journal",
+                action="store_true",
+                dest="journal",
+                default=False,
+                help="Journal the rows committed, so the import can "
+                     "be carried on with --resume if it fails"),
+        make_option(
+                "--resume",
+                action="store_true",
+                dest="resume",
+                default=False,
+                help="Carry on from the rows committed by the last "
+                     "journalled run of the import, if it failed"),
+        make_option(
+                "--pipelined",
+                action="store_true",
+                dest="pipelined",
+                default=False,
+                help="Read and transform rows in threads of their own "
+                     "while writing"),
+        make_option(
+                "--concurrent",
+                action="store_true",
+                dest="concurrent",
+                default=False,
+                help="Wait for a free slot on the DB and run safely "
+                     "alongside other imports into it"),
+        make_option(
+                "--stats",
+                action="store_true",
+                dest="stats",
+                default=False,
+                help="Print query counts and timings when done"),
         make_option(
                 "-u",
                 "--user",
@@ -65,6 +114,19 @@ class Command(BaseCommand):
             self.stderr.write("Imported: %s\n" % repo.identifier)
         importer = importers.Collection(options["database"], options["dbuser"],
                 options["dbpass"], options["dbhost"], options["dbport"], options["user"],
-                rowfunc=rowfunc, donefunc=donefunc)
-        importer.do(args[0])
+                rowfunc=rowfunc, donefunc=donefunc, batch_size=options["batch_size"],
+                concurrent=options["concurrent"], pipelined=options["pipelined"],
+                journalled=options["journal"])
+        slot = None
+        if options["concurrent"]:
+            slot = scheduler.wait_for_slot(importer.engine)
+        try:
+            report = importer.do(args[0], workers=options["workers"],
+                    resume=options["resume"])
+        finally:
+            if slot is not None:
+                slot.release()
+        if options["stats"]:
+            for line in stats.format_report(report):
+                self.stderr.write("%s\n" % line)
 
@@ -4,7 +4,7 @@ Validate repository information from a spreadsheet.
 
 from django.core.management.base import BaseCommand, CommandError
 
-from xlsimport import validators
+from xlsimport import cache, validators
 
 class Command(BaseCommand):
     """Import repositories from ICA Atom."""
@@ -15,7 +15,8 @@ class Command(BaseCommand):
             raise CommandError("No XLS file given.")
 
         validator = validators.Repository()
-        validator.validate(args[0])
+        # the rows are only wanted for importing
+        cache.validate(validator, args[0], keep_rows=False)
         if validator.errors:
             for err in validator.errors:
                 self.stderr.write("Line %-6d : %s\n" % err[0:2])
@@ -0,0 +1,194 @@
+"""Importing one big sheet with several processes at once.  The
+rows are validated as usual, then the terms and authorities they
+refer to are created up-front, so no two workers create the same
+one.  The rows are then split into contiguous partitions, each of
+which is given the identifiers and row slugs it needs in advance,
+so workers never hand out the same one, and imported by a worker
+process with its own connection and session.  If the import is
+running alongside others its workers act for its scheduler, so they
+share its reservations and slug claims.  Each partition is
+committed by its worker, so if one fails the others are kept.
+The same partitions are what `tasks` hands out to Celery workers
+when an import is fanned out in chunks, with their rows sent along
+in the message, since the workers needn't share our filesystem."""
+
+import traceback
+import multiprocessing
+
+from xlsimport import connections, journal, readers, registry, stats, utils
+
+
+class Partition(object):
+    """A contiguous run of rows to be imported by one worker, with
+    the identifiers and slugs set aside for it."""
+    def __init__(self, index):
+        self.index = index
+        self.spool = readers.RowSpool()
+        self.nrows = 0
+        # identifier key -> number of identifiers needed
+        self.counts = {}
+        # identifier key -> (first number, end)
+        self.ranges = {}
+        # row number -> slug
+        self.slugs = {}
+        # what this partition's random slugs start with, see split
+        self.initials = utils.SLUG_CHARS
+
+    def add(self, importer, rownum, record):
+        """Add a row, noting the identifier and slug it needs."""
+        self.spool.append(rownum, record)
+        self.nrows += 1
+        pattern = importer.identifier_pattern(record)
+        if pattern is not None:
+            key = registry.IdentifierAllocator.key(*pattern[:3])
+            self.counts[key] = self.counts.get(key, 0) + 1
+        slug = importer.row_slugs.get(rownum)
+        if slug is not None:
+            self.slugs[rownum] = slug
+
+    def job(self, importer, inline=False):
+        """What a worker needs to import this partition, with the
+        rows themselves if `inline`, otherwise the spool's path."""
+        journal_id = importer.journal.import_id if importer.journal else None
+        owner = importer.scheduler.owner if importer.scheduler else None
+        rows = list(self.spool) if inline else self.spool.path
+        return (importer.__class__, importer.arguments, importer.timestamp,
+                rows, self.ranges, self.slugs, self.initials, owner, journal_id)
+
+
+def split(importer, workers):
+    """Share the rows out between at most `workers` partitions, and
+    give each the identifiers its rows need, following on from the
+    highest in use for each pattern in row order, or reserved for
+    us if other imports are running alongside.  Each partition's
+    random slugs, i.e. events', start with different characters from
+    the others', so there can't be more partitions than there are
+    SLUG_CHARS."""
+    workers = min(workers, len(utils.SLUG_CHARS))
+    nrows = importer.num_rows()
+    if importer.journal is not None:
+        nrows -= len(importer.journal.done)
+    size = max(1, -(-nrows // workers))
+    partitions = []
+    for i, (rownum, record) in enumerate(importer.pending_rows()):
+        if i % size == 0:
+            if partitions:
+                partitions[-1].spool.close()
+            partitions.append(Partition(len(partitions)))
+        partitions[-1].add(importer, rownum, record)
+    if partitions:
+        partitions[-1].spool.close()
+    for partition in partitions:
+        partition.initials = utils.SLUG_CHARS[partition.index::len(partitions)]
+    totals = {}
+    for partition in partitions:
+        for key, count in partition.counts.iteritems():
+            totals[key] = totals.get(key, 0) + count
+    following = {}
+    for key, count in totals.iteritems():
+        model, attr, prefix, suffix = key
+        high_water = lambda bind=None: importer.ids.high_water(
+                model, attr, prefix, suffix, bind)
+        if importer.scheduler is not None:
+            following[key] = importer.scheduler.reserve(key, count, high_water)[0]
+        else:
+            following[key] = high_water() + 1
+    for partition in partitions:
+        for key, count in partition.counts.iteritems():
+            partition.ranges[key] = (following[key], following[key] + count)
+            following[key] += count
+    return partitions
+
+
+def partition_importer(job):
+    """Make an importer for a partition, from its job."""
+    (klass, arguments, timestamp, rows, ranges, slugs, initials, owner,
+            journal_id) = job
+    importer = klass(**arguments)
+    importer.timestamp = timestamp
+    importer.load_rows(rows)
+    for key, (start, end) in ranges.iteritems():
+        importer.ids.assign(key, start, end)
+    importer.row_slugs = slugs
+    importer.slugs.initials = initials
+    if owner is not None and importer.scheduler is not None:
+        importer.scheduler.adopt(owner)
+    if journal_id is not None:
+        importer.journal = journal.Journal(importer.engine, journal_id)
+    return importer
+
+
+def import_partition(job):
+    """Import a partition in a worker process, returning its stats
+    report and None, or None and the error."""
+    try:
+        return partition_importer(job).do(None), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def plan(importer, xlsfile, workers, resume=False):
+    """Get an import ready to be shared out: validate the file,
+    start its journal, create the records rows might share and
+    split the rows still to be imported into at most `workers`
+    partitions.  The importer is done with after
+    this, apart from its stats, and the partitions' spools belong
+    to the caller."""
+    partitions = []
+    try:
+        importer.set_phase("validating")
+        if importer.rows is None:
+            importer.validate_xls(xlsfile)
+        importer.validate_rows()
+        if xlsfile is not None and (importer.journalled or resume):
+            importer.start_journal(xlsfile, resume)
+        importer.set_phase("preparing")
+        importer.create_shared()
+        importer.assign_row_slugs()
+        importer.set_phase("partitioning")
+        partitions = split(importer, workers)
+    except Exception:
+        for partition in partitions:
+            partition.spool.discard()
+        raise
+    finally:
+        importer.close_xls()
+        importer.discard_rows()
+        importer.session.close()
+    return partitions
+
+
+def import_parallel(importer, xlsfile, workers, resume=False):
+    """Import a file with up to `workers` processes, returning the
+    merged stats report and a list of errors from any partitions
+    which failed.  The partitions which didn't fail are journalled
+    as committed, so the import can be resumed."""
+    partitions = []
+    try:
+        partitions = plan(importer, xlsfile, workers, resume)
+        # the workers mustn't share our pooled connections
+        connections.dispose_engines()
+        importer.set_phase("importing")
+        pool = multiprocessing.Pool(len(partitions) or 1)
+        try:
+            results = pool.map(import_partition,
+                    [p.job(importer) for p in partitions])
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        for partition in partitions:
+            partition.spool.discard()
+        if importer.scheduler is not None:
+            importer.scheduler.release()
+        importer.stats.enter(None)
+        importer.stats.deactivate()
+    reports, errors = [], []
+    for partition, (report, error) in zip(partitions, results):
+        if error is not None:
+            errors.append("Partition %d: %s" % (partition.index, error))
+        else:
+            reports.append(report)
+    if not errors and importer.journal is not None:
+        importer.journal.finish(importer.engine)
+    return stats.merge_reports(importer.stats.report(), reports), errors
@@ -0,0 +1,126 @@
+"""Importing rows in a pipeline of threads, so reading the workbook
+and the work on each row which doesn't need the DB, i.e. splitting
+cells and parsing dates, overlap with waiting on the DB.  A reader
+thread produces rows, a transform thread works out what's to be
+written for each, and the import's own thread, which owns the
+session, writes them.  The stages are joined by bounded queues, so
+a stage that gets ahead has to wait for the one after it rather
+than piling rows up in memory.  If any stage fails the exception is
+raised in the writing thread, and if that fails the others stop."""
+
+import sys
+import Queue
+import threading
+
+# rows each queue between stages holds before the stage feeding
+# it has to wait
+QUEUE_SIZE = 100
+# seconds between checks on whether a waiting stage should stop
+POLL = 0.1
+
+
+class Stopped(Exception):
+    """The pipeline was shut down while a stage was waiting."""
+
+
+class Failure(object):
+    """An exception raised in a stage, passed down the pipeline in
+    place of a row so it can be raised again in the writer."""
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+    def reraise(self):
+        raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+
+# marks the end of the rows
+DONE = object()
+
+
+class Pipe(object):
+    """A bounded queue between two stages, which gives up waiting
+    if the pipeline is stopped."""
+    def __init__(self, stop, maxsize=QUEUE_SIZE):
+        self.stop = stop
+        self.queue = Queue.Queue(maxsize)
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                return self.queue.put(item, timeout=POLL)
+            except Queue.Full:
+                pass
+        raise Stopped()
+
+    def get(self):
+        while not self.stop.is_set():
+            try:
+                return self.queue.get(timeout=POLL)
+            except Queue.Empty:
+                pass
+        raise Stopped()
+
+    def __iter__(self):
+        """Yield items until the end of the rows, raising any
+        failure from upstream."""
+        while True:
+            item = self.get()
+            if item is DONE:
+                return
+            if isinstance(item, Failure):
+                item.reraise()
+            yield item
+
+
+def run_stage(source, func, pipe):
+    """Put `func` of each item from `source` in the pipe, followed
+    by DONE, or by the Failure if anything goes wrong."""
+    try:
+        for item in source:
+            pipe.put(func(item))
+        pipe.put(DONE)
+    except Stopped:
+        pass
+    except Exception:
+        try:
+            pipe.put(Failure(sys.exc_info()))
+        except Stopped:
+            pass
+
+
+class Pipeline(object):
+    """Read (rownum, record) pairs from `rows` in one thread and
+    call `transform(rownum, record)` on them in another, yielding
+    (rownum, record, payload) triples, in order, to whoever's
+    iterating over the pipeline.  Close it when done, whether or
+    not all the rows have been read."""
+    def __init__(self, rows, transform, maxsize=QUEUE_SIZE):
+        self.stop = threading.Event()
+        self.read = Pipe(self.stop, maxsize)
+        self.transformed = Pipe(self.stop, maxsize)
+        def apply((rownum, record)):
+            return rownum, record, transform(rownum, record)
+        self.threads = [
+            threading.Thread(target=run_stage,
+                    args=(rows, lambda row: row, self.read)),
+            threading.Thread(target=run_stage,
+                    args=(self.read, apply, self.transformed)),
+        ]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def __iter__(self):
+        return iter(self.transformed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Stop the stages and wait for them to finish."""
+        self.stop.set()
+        for thread in self.threads:
+            thread.join()
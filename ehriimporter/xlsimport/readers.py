@@ -0,0 +1,226 @@
+"""Row sources which stream the cell values of the first worksheet
+in a workbook, without holding the whole thing in memory, and a
+spool for keeping parsed rows around once they've been read."""
+
+import os
+import datetime
+import tempfile
+import cPickle
+
+import xlrd
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+
+class ReaderError(Exception):
+    """The workbook couldn't be read."""
+
+
+class RowSource(object):
+    """Abstract source of rows from the first worksheet of a
+    workbook.  Rows are yielded as (rownum, values) pairs, with
+    rownum being 0-based and empty cells given as u""."""
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def nrows(self):
+        """Number of rows in the sheet, or None if we can't tell
+        without reading it."""
+        return None
+
+    def rows(self, start=0, width=None):
+        """Yield rows from `start`, padded or trimmed to `width`
+        values if given."""
+        raise NotImplementedError
+
+    def row(self, rownum, width=None):
+        """Get a single row, or None if the sheet isn't that long."""
+        for num, values in self.rows(rownum, width):
+            return values
+
+    def close(self):
+        """Release any resources held by the reader."""
+        pass
+
+    def _fit(self, values, width):
+        if width is None:
+            return values
+        values = values[:width]
+        if len(values) < width:
+            values.extend([u""] * (width - len(values)))
+        return values
+
+
+class XLSRowSource(RowSource):
+    """Rows from an .xls file.  The sheet is only loaded when it
+    is read, without formatting info, and unloaded again once all
+    its rows have been consumed."""
+    def __init__(self, path):
+        super(XLSRowSource, self).__init__(path)
+        try:
+            self.workbook = xlrd.open_workbook(path, on_demand=True)
+        except (IOError, xlrd.XLRDError), e:
+            raise ReaderError(unicode(e))
+        if self.workbook.nsheets < 1:
+            raise ReaderError("No worksheets found")
+
+    @property
+    def nrows(self):
+        sheet = self.workbook.sheet_by_index(0)
+        return sheet.nrows
+
+    def rows(self, start=0, width=None):
+        sheet = self.workbook.sheet_by_index(0)
+        for rownum in xrange(start, sheet.nrows):
+            yield rownum, self._fit(
+                    [c.value for c in sheet.row_slice(rownum, 0, width)], width)
+        self.workbook.unload_sheet(0)
+
+    def close(self):
+        self.workbook.release_resources()
+
+
+class XLSXRowSource(RowSource):
+    """Rows from an .xlsx file, read using openpyxl's read-only
+    mode, which parses the sheet XML as a stream."""
+    def __init__(self, path):
+        super(XLSXRowSource, self).__init__(path)
+        if openpyxl is None:
+            raise ReaderError("Reading .xlsx files requires openpyxl")
+        # openpyxl won't open a path without an .xlsx extension,
+        # which uploaded temp files don't have, but a file is fine
+        try:
+            self.fp = open(path, "rb")
+            self.workbook = openpyxl.load_workbook(self.fp, read_only=True,
+                    data_only=True)
+        except Exception, e:
+            raise ReaderError(unicode(e))
+        if not self.workbook.worksheets:
+            raise ReaderError("No worksheets found")
+
+    def _value(self, value):
+        """Coerce values to what xlrd would give us: u"" for empty
+        cells, floats for numbers and ints for booleans.  Dates are
+        the exception, given as ISO dates, which the date parsing
+        understands, rather than xlrd's day numbers."""
+        if value is None:
+            return u""
+        if isinstance(value, bool):
+            return int(value)
+        if isinstance(value, (int, long)):
+            return float(value)
+        if isinstance(value, datetime.datetime):
+            return value.date().isoformat()
+        if isinstance(value, datetime.date):
+            return value.isoformat()
+        return value
+
+    def rows(self, start=0, width=None):
+        sheet = self.workbook.worksheets[0]
+        for rownum, cells in enumerate(sheet.iter_rows(min_row=start + 1), start):
+            yield rownum, self._fit(
+                    [self._value(c.value) for c in cells[:width]], width)
+
+    def close(self):
+        self.workbook.close()
+        self.fp.close()
+
+
+# .xlsx files are zip archives, .xls files are OLE2 documents
+ZIP_SIGNATURE = "PK\x03\x04"
+
+
+def open_rows(path):
+    """Get a row source for a workbook, based on its extension
+    or, since uploads are saved without one, its first bytes."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".xlsx":
+        return XLSXRowSource(path)
+    if not ext:
+        try:
+            with open(path, "rb") as fp:
+                if fp.read(len(ZIP_SIGNATURE)) == ZIP_SIGNATURE:
+                    return XLSXRowSource(path)
+        except IOError, e:
+            raise ReaderError(unicode(e))
+    return XLSRowSource(path)
+
+
+class RowSpool(object):
+    """Parsed (rownum, rowdata) pairs spilled to a temporary file
+    as they're read, so they can be used again without parsing
+    the workbook a second time, even from another process.  Spools
+    opened from an existing path belong to someone else and are
+    left alone when discarded."""
+    def __init__(self, path=None):
+        self.fp = None
+        self.readfp = None
+        self.count = None
+        self.owned = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="xlsimport-", suffix=".rows")
+            self.fp = os.fdopen(fd, "wb")
+            self.count = 0
+        self.path = path
+
+    @property
+    def complete(self):
+        """Whether all the rows have been written."""
+        return self.fp is None
+
+    def __len__(self):
+        if self.count is None:
+            self.count = sum(1 for row in self)
+        return self.count
+
+    def __iter__(self):
+        # keep the file open between passes, so the rows can still
+        # be read if it's removed from under us, i.e. evicted from
+        # the validation cache
+        if self.readfp is None:
+            self.readfp = open(self.path, "rb")
+        self.readfp.seek(0)
+        unpickler = cPickle.Unpickler(self.readfp)
+        while True:
+            try:
+                yield unpickler.load()
+            except EOFError:
+                break
+
+    def append(self, rownum, rowdata):
+        cPickle.dump((rownum, rowdata), self.fp, cPickle.HIGHEST_PROTOCOL)
+        self.count += 1
+
+    def close(self):
+        """Finish writing rows."""
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+    def discard(self):
+        """Throw the spooled rows away."""
+        self.close()
+        if self.readfp is not None:
+            self.readfp.close()
+            self.readfp = None
+        if self.owned and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class RowList(list):
+    """(rownum, rowdata) pairs held in memory, standing in for a
+    RowSpool, i.e. the rows sent to a chunk task in its message."""
+    complete = True
+
+    def discard(self):
+        del self[:]
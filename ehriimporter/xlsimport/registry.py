@@ -0,0 +1,213 @@
+"""In-memory registries of values which must be unique in the
+Qubit DB, so the importer doesn't have to ask MySQL about every
+candidate it tries."""
+
+import re
+import threading
+
+from sqlalchemy import select, func
+from sqlaqubit import models
+
+from xlsimport import utils
+
+# max number of values sent in a single IN (...) clause
+CHUNK_SIZE = 500
+
+
+class AllocationError(Exception):
+    """Ran out of the identifiers set aside for an import."""
+
+
+def chunked(items, size=CHUNK_SIZE):
+    """Split a sequence into lists of at most `size` items."""
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class SlugRegistry(object):
+    """Set of slugs known to be taken.  Existing slugs are loaded
+    from the DB in one go, or given as `taken`, i.e. by a SlugCache,
+    and slugs handed out during the import are added as we go, so
+    collisions can be settled in memory."""
+    def __init__(self, taken=None):
+        self.taken = set() if taken is None else taken
+        self.pending = set()
+        # characters random slugs start with, so the workers sharing
+        # out an import can be given disjoint sets and never pick
+        # the same one
+        self.initials = utils.SLUG_CHARS
+
+    def __contains__(self, slug):
+        return slug in self.taken or slug in self.pending
+
+    def __len__(self):
+        return len(self.taken) + len(self.pending)
+
+    def load(self, session):
+        """Load every slug currently in the DB."""
+        for (slug,) in session.query(models.Slug.slug).yield_per(10000):
+            self.taken.add(slug)
+
+    def claim(self, slug):
+        """Mark a slug as used by this import."""
+        self.pending.add(slug)
+        return slug
+
+    def unique(self, base):
+        """Get a slug based on `base` which is not yet taken,
+        bumping a numeric suffix until we find one."""
+        suffix = 0
+        potential = base
+        while potential in self:
+            # we hit a conflicting slug, so bump the suffix & try again
+            suffix += 1
+            potential = "-".join([base, str(suffix)])
+        return self.claim(potential)
+
+    def random(self, length=6):
+        """Get a completely random slug which is not yet taken."""
+        while True:
+            potential = utils.get_random_string(length, self.initials)
+            if potential not in self:
+                return self.claim(potential)
+
+    def mark_taken(self, slugs):
+        """Note slugs someone else has taken since we loaded them."""
+        self.taken.update(slugs)
+        self.pending.difference_update(slugs)
+
+    def verify(self, bind):
+        """Check the slugs claimed since the last commit against
+        the DB, in batches, and return any that someone else has
+        taken in the meantime.  `bind` should be an engine or a
+        connection outside the import transaction, otherwise our
+        own flushed slugs will show up."""
+        clashes = set()
+        for chunk in chunked(self.pending):
+            query = select([models.Slug.slug]).where(models.Slug.slug.in_(chunk))
+            clashes.update(row[0] for row in bind.execute(query))
+        return clashes
+
+    def commit(self):
+        """Pending slugs have been written to the DB."""
+        self.taken.update(self.pending)
+        self.pending = set()
+
+
+class SlugCache(object):
+    """The slugs in each DB, keyed on engine, for SlugRegistries to
+    share, so each importer in a long-running worker doesn't scan
+    the whole slug table.  The first importer loads them all and
+    each after that just the ones added since, by the table's ids.
+    Only slugs which really are taken are ever added to the sets, so
+    registries can safely update them."""
+    def __init__(self):
+        # engine -> [highest slug id loaded, set of slugs]
+        self.slugs = {}
+        self.lock = threading.Lock()
+
+    def taken(self, session, engine):
+        """Get the set of slugs in the DB, topped up with any
+        added since we last looked."""
+        with self.lock:
+            loaded = self.slugs.setdefault(engine, [0, set()])
+            query = session.query(models.Slug.id, models.Slug.slug)\
+                    .filter(models.Slug.id > loaded[0])
+            for slug_id, slug in query.yield_per(10000):
+                loaded[0] = max(loaded[0], slug_id)
+                loaded[1].add(slug)
+            return loaded[1]
+
+    def invalidate(self, engine=None):
+        """Forget the slugs for an engine, or all of them."""
+        with self.lock:
+            for key in self.slugs.keys():
+                if engine is None or key is engine:
+                    del self.slugs[key]
+
+
+class IdentifierAllocator(object):
+    """Hands out identifiers of the form <prefix><number><suffix>,
+    i.e. c000000123 or r000042GB.  The highest number in use for
+    each prefix/suffix is read from the DB once, after which
+    numbers are given out from blocks reserved in memory, with a
+    separate sequence for every prefix/suffix pair.  If there's a
+    `reserver`, i.e. a scheduler.Scheduler, blocks are reserved
+    through it so other imports can't be given the same ones."""
+    def __init__(self, session, block_size=100, reserver=None):
+        self.session = session
+        self.block_size = block_size
+        self.reserver = reserver
+        # key -> [next number, end of reserved block]
+        self.blocks = {}
+        # key -> last number reserved so far
+        self.reserved = {}
+        # keys limited to the numbers they've been assigned
+        self.assigned = set()
+
+    @staticmethod
+    def key(model, prefix, suffix, attr="identifier"):
+        return (model, attr, prefix, suffix)
+
+    def high_water(self, model, attr, prefix, suffix, bind=None):
+        """Get the highest number used in identifiers matching
+        the prefix/suffix pattern, or 0 if there are none, asking
+        `bind` if given rather than our session.  The DB sorts the
+        candidates, longest and then highest first, which puts the
+        highest number at the top as long as a pattern's numbers are
+        all padded to the same width, or none are; only that one is
+        usually fetched, unless it doesn't really match, in which
+        case the following ones are fetched a chunk at a time."""
+        column = getattr(model, attr)
+        pattern = re.compile(r"^%s(\d+)%s$" % (re.escape(prefix), re.escape(suffix)))
+        query = select([column]).where(column.like(u"%s%%%s" % (prefix, suffix)))\
+                .order_by(func.length(column).desc(), column.desc())
+        offset, limit = 0, 1
+        while True:
+            values = [value for (value,) in (bind or self.session).execute(
+                    query.offset(offset).limit(limit))]
+            for value in values:
+                match = pattern.match(value or "")
+                if match:
+                    return int(match.group(1))
+            if len(values) < limit:
+                return 0
+            offset += limit
+            limit = CHUNK_SIZE
+
+    def reserve(self, model, attr, prefix, suffix):
+        """Reserve the next block of numbers for a pattern and
+        return it as a (start, end) pair."""
+        key = self.key(model, prefix, suffix, attr)
+        if self.reserver is not None:
+            start, end = self.reserver.reserve(key, self.block_size,
+                    lambda bind: self.high_water(model, attr, prefix, suffix, bind))
+            self.reserved[key] = end - 1
+            return start, end
+        last = self.reserved.get(key)
+        if last is None:
+            last = self.high_water(model, attr, prefix, suffix)
+        self.reserved[key] = last + self.block_size
+        return last + 1, last + self.block_size + 1
+
+    def assign(self, key, start, end):
+        """Only give out the numbers from `start` up to `end` for a
+        pattern, i.e. those set aside for one part of an import
+        being run in parallel."""
+        self.blocks[key] = [start, end]
+        self.reserved[key] = end - 1
+        self.assigned.add(key)
+
+    def next(self, model, prefix, suffix, format="%d", attr="identifier"):
+        """Get the next free identifier for the given pattern."""
+        key = self.key(model, prefix, suffix, attr)
+        block = self.blocks.get(key)
+        if block is None or block[0] >= block[1]:
+            if key in self.assigned:
+                raise AllocationError("No identifiers left for pattern: %s%s%s" % (
+                    prefix, format, suffix))
+            block = self.blocks[key] = list(self.reserve(model, attr, prefix, suffix))
+        num = block[0]
+        block[0] += 1
+        return (u"%s" + format + "%s") % (prefix, num, suffix)
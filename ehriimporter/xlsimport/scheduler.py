@@ -0,0 +1,237 @@
+"""Letting several imports into the same Qubit DB run at once.
+Only the sections which really conflict are serialized, each under
+a named lock on the DB: creating the terms and authorities rows
+share, handing out identifiers and claiming slugs.  Identifiers
+come from blocks reserved in a table of our own, and the slugs
+picked for rows are claimed in another, so other imports know not
+to use them before they've been committed.  The number of imports
+running against a DB at once is limited by a set of slots, which
+are also locks on the DB; imports which can't get one have to wait
+their turn.  The tables aren't created by imports themselves, but
+once per DB by the create_importer_tables command, see `setup`."""
+
+import time
+import datetime
+import threading
+
+from django.conf import settings
+from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime
+from sqlalchemy import select, and_, text
+from sqlaqubit import models
+
+from xlsimport import registry, utils
+
+# max imports running against a DB at once
+CONCURRENCY = getattr(settings, "IMPORTER_CONCURRENCY", 2)
+# seconds to wait for a lock before giving up
+LOCK_TIMEOUT = getattr(settings, "IMPORTER_LOCK_TIMEOUT", 300)
+# seconds before a slug claim left by a failed import lapses
+CLAIM_TTL = 24 * 60 * 60
+
+METADATA = MetaData()
+
+# last identifier number reserved for each pattern
+RESERVATIONS = Table("xlsimport_reservation", METADATA,
+    Column("pattern", String(255), primary_key=True),
+    Column("last", Integer, nullable=False),
+)
+
+# slugs picked by imports which haven't been committed yet
+CLAIMS = Table("xlsimport_slug_claim", METADATA,
+    Column("slug", String(255), primary_key=True),
+    Column("owner", String(32), nullable=False),
+    Column("claimed", DateTime, nullable=False),
+)
+
+# locks standing in for MySQL's on other DBs, i.e. SQLite
+LOCAL_LOCKS = {}
+LOCAL_LOCK = threading.Lock()
+
+
+def setup(engine):
+    """Create the scheduler's tables if they aren't there yet."""
+    METADATA.create_all(engine)
+
+
+class LockTimeout(Exception):
+    """Gave up waiting for a lock on the DB."""
+
+
+class DatabaseLock(object):
+    """A named lock shared by everything importing into a DB.  On
+    MySQL this is GET_LOCK, held on a connection of its own, so it
+    goes away if the process holding it dies.  Other DBs get a lock
+    in this process, which is enough for a stand-in."""
+    def __init__(self, engine, name, timeout=LOCK_TIMEOUT):
+        self.engine = engine
+        self.name = "xlsimport:%s:%s" % (engine.url.database, name)
+        self.timeout = timeout
+        self.conn = None
+        self.local = None
+
+    def acquire(self, timeout=None):
+        """Try to get the lock, waiting up to `timeout` seconds,
+        and return whether we did."""
+        timeout = self.timeout if timeout is None else timeout
+        if self.engine.dialect.name != "mysql":
+            with LOCAL_LOCK:
+                lock = LOCAL_LOCKS.setdefault(self.name, threading.Lock())
+            if lock.acquire(timeout != 0):
+                self.local = lock
+            return self.local is not None
+        conn = self.engine.connect()
+        got = conn.execute(text("SELECT GET_LOCK(:name, :timeout)"),
+                name=self.name, timeout=timeout).scalar()
+        if got != 1:
+            conn.close()
+            return False
+        self.conn = conn
+        return True
+
+    def release(self):
+        if self.local is not None:
+            self.local.release()
+            self.local = None
+        if self.conn is not None:
+            self.conn.execute(text("SELECT RELEASE_LOCK(:name)"), name=self.name)
+            self.conn.close()
+            self.conn = None
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LockTimeout("Timed out waiting for lock: %s" % self.name)
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class NullLock(object):
+    """Stands in for a DatabaseLock for imports which aren't being
+    run alongside others."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def take_slot(engine, limit=CONCURRENCY):
+    """Get one of the slots for running an import against a DB,
+    or None if they're all taken.  Release it when done."""
+    for num in range(limit):
+        slot = DatabaseLock(engine, "slot-%d" % num)
+        if slot.acquire(0):
+            return slot
+
+
+def wait_for_slot(engine, limit=CONCURRENCY, poll=5):
+    """Wait as long as it takes for an import slot."""
+    while True:
+        slot = take_slot(engine, limit)
+        if slot is not None:
+            return slot
+        time.sleep(poll)
+
+
+def pattern_name(key):
+    """The name of an identifier pattern in the reservations table."""
+    model, attr, prefix, suffix = key
+    return u"%s.%s:%s:%s" % (getattr(model, "__name__", model), attr, prefix, suffix)
+
+
+class Scheduler(object):
+    """Locks, identifier reservations and slug claims for one import
+    into a DB, so it can safely run alongside others."""
+    def __init__(self, engine):
+        self.engine = engine
+        # tells our slug claims from other imports'
+        self.owner = utils.get_random_string(32)
+        # whether we're acting for another import's scheduler, see
+        # `adopt`
+        self.adopted = False
+
+    def lock(self, name):
+        return DatabaseLock(self.engine, name)
+
+    def adopt(self, owner):
+        """Act for the scheduler of the import which shared its rows
+        out to us, by its owner, i.e. in one of its partitions: its
+        slug claims count as ours, and are left for it to release."""
+        self.owner = owner
+        self.adopted = True
+
+    def reserve(self, key, count, high_water):
+        """Reserve the next `count` numbers for an identifier pattern,
+        after the last reserved by any import and the highest in use
+        in the DB, which `high_water(bind)` gets.  Returns a (start,
+        end) pair."""
+        name = pattern_name(key)
+        with self.lock("ids"):
+            conn = self.engine.connect()
+            try:
+                trans = conn.begin()
+                last = conn.execute(select([RESERVATIONS.c.last])\
+                        .where(RESERVATIONS.c.pattern == name)).scalar()
+                start = max(last or 0, high_water(conn))
+                if last is None:
+                    conn.execute(RESERVATIONS.insert(), pattern=name,
+                            last=start + count)
+                else:
+                    conn.execute(RESERVATIONS.update()\
+                            .where(RESERVATIONS.c.pattern == name),
+                            last=start + count)
+                trans.commit()
+            finally:
+                conn.close()
+        return start + 1, start + count + 1
+
+    def taken(self, slugs):
+        """Which of the slugs are in the DB, or claimed by another
+        import.  Call with the slugs lock held."""
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=CLAIM_TTL)
+        found = set()
+        conn = self.engine.connect()
+        try:
+            for chunk in registry.chunked(slugs):
+                query = select([models.Slug.slug]).where(models.Slug.slug.in_(chunk))
+                found.update(row[0] for row in conn.execute(query))
+                query = select([CLAIMS.c.slug]).where(and_(
+                        CLAIMS.c.slug.in_(chunk),
+                        CLAIMS.c.owner != self.owner,
+                        CLAIMS.c.claimed > cutoff))
+                found.update(row[0] for row in conn.execute(query))
+        finally:
+            conn.close()
+        return found
+
+    def claim(self, slugs):
+        """Claim slugs none of which are `taken`, replacing any
+        lapsed claims on them.  Call with the slugs lock held."""
+        now = datetime.datetime.now()
+        conn = self.engine.connect()
+        try:
+            trans = conn.begin()
+            for chunk in registry.chunked(slugs):
+                conn.execute(CLAIMS.delete().where(CLAIMS.c.slug.in_(chunk)))
+                conn.execute(CLAIMS.insert(), [dict(slug=slug, owner=self.owner,
+                        claimed=now) for slug in chunk])
+            trans.commit()
+        finally:
+            conn.close()
+
+    def release(self):
+        """Drop our slug claims, once the slugs have been committed
+        or the import has failed, unless they're another import's."""
+        if not self.adopted:
+            release_claims(self.engine, self.owner)
+
+
+def release_claims(engine, owner):
+    """Drop the slug claims of a Scheduler, by its owner, i.e. from
+    the task which finishes off a fanned-out import."""
+    conn = engine.connect()
+    try:
+        conn.execute(CLAIMS.delete().where(CLAIMS.c.owner == owner))
+    finally:
+        conn.close()
@@ -0,0 +1,155 @@
+"""Counting and timing the queries an import makes, grouped by the
+importer method they came from, and timing each phase of the
+import, so there's some way to tell where the time goes."""
+
+import time
+import functools
+import threading
+
+from sqlalchemy import event
+
+# the stats being collected in each thread, if any
+CURRENT = threading.local()
+
+# label for queries made outside any of the marked call sites
+OTHER = "other"
+
+
+class ImportStats(object):
+    """Query counts and times keyed on call site, plus the total
+    time spent in each phase of an import."""
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.created = clock()
+        # call site -> [queries, seconds]
+        self.queries = {}
+        # phase -> seconds
+        self.phases = {}
+        self.phase = None
+        self.phase_started = None
+        self.sites = []
+        self.query_started = None
+        self.rows = 0
+
+    def activate(self):
+        """Collect stats for the queries made in this thread."""
+        CURRENT.stats = self
+
+    def deactivate(self):
+        if getattr(CURRENT, "stats", None) is self:
+            CURRENT.stats = None
+
+    def enter(self, phase):
+        """Stop timing the current phase, if any, and start timing
+        another, unless it's None."""
+        now = self.clock()
+        if self.phase is not None:
+            self.phases[self.phase] = self.phases.get(self.phase, 0.0) + \
+                    now - self.phase_started
+        self.phase = phase
+        self.phase_started = now
+
+    def push(self, site):
+        self.sites.append(site)
+
+    def pop(self):
+        self.sites.pop()
+
+    def query_start(self):
+        self.query_started = self.clock()
+
+    def query_end(self):
+        if self.query_started is None:
+            return
+        site = self.sites[-1] if self.sites else OTHER
+        counts = self.queries.setdefault(site, [0, 0.0])
+        counts[0] += 1
+        counts[1] += self.clock() - self.query_started
+        self.query_started = None
+
+    def report(self):
+        """The stats as a dict of plain values, suitable for JSON."""
+        importing = self.phases.get("importing", 0.0)
+        return dict(
+            elapsed=self.clock() - self.created,
+            rows=self.rows,
+            per_row=importing / self.rows if self.rows else None,
+            phases=dict(self.phases),
+            queries=dict((site, dict(count=count, seconds=seconds)) \
+                    for site, (count, seconds) in self.queries.iteritems()),
+            total_queries=sum(count for count, _ in self.queries.itervalues()),
+        )
+
+
+def merge_reports(report, parts):
+    """Combine the report of an import run in parallel with those
+    of its parts.  The phases of the whole are wall-clock times,
+    those of the parts are added up and listed as worker phases."""
+    merged = dict(report, phases=dict(report["phases"]),
+            queries=dict((site, dict(info)) \
+                    for site, info in report["queries"].iteritems()),
+            workers=len(parts))
+    for part in parts:
+        merged["rows"] += part["rows"]
+        merged["total_queries"] += part["total_queries"]
+        for phase, seconds in part["phases"].iteritems():
+            phase = "worker " + phase
+            merged["phases"][phase] = merged["phases"].get(phase, 0.0) + seconds
+        for site, info in part["queries"].iteritems():
+            counts = merged["queries"].setdefault(site, dict(count=0, seconds=0.0))
+            counts["count"] += info["count"]
+            counts["seconds"] += info["seconds"]
+    importing = merged["phases"].get("worker importing", 0.0)
+    if merged["rows"]:
+        merged["per_row"] = importing / merged["rows"]
+    return merged
+
+
+def format_report(report):
+    """Lines of text describing a stats report."""
+    lines = ["%d rows in %.2fs" % (report["rows"], report["elapsed"])]
+    if report.get("workers"):
+        lines[0] += " with %d workers" % report["workers"]
+    if report["per_row"] is not None:
+        lines.append("  %.2fms per row imported" % (report["per_row"] * 1000))
+    for phase, seconds in sorted(report["phases"].iteritems(),
+            key=lambda p: -p[1]):
+        lines.append("  %-24s %8.2fs" % (phase, seconds))
+    lines.append("%d queries" % report["total_queries"])
+    for site, info in sorted(report["queries"].iteritems(),
+            key=lambda q: -q[1]["seconds"]):
+        lines.append("  %-24s %8d %8.2fs" % (site, info["count"], info["seconds"]))
+    return lines
+
+
+def call_site(func):
+    """Mark an importer method as a call site, so the queries made
+    while it runs are counted under its name."""
+    name = func.__name__
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        self.stats.push(name)
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.stats.pop()
+    return wrapper
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = getattr(CURRENT, "stats", None)
+    if stats is not None:
+        stats.query_start()
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = getattr(CURRENT, "stats", None)
+    if stats is not None:
+        stats.query_end()
+
+
+def instrument(engine):
+    """Report the queries run on an engine to whichever stats are
+    active in the thread running them."""
+    event.listen(engine, "before_cursor_execute", _before_execute)
+    event.listen(engine, "after_cursor_execute", _after_execute)
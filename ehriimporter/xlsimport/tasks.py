@@ -1,29 +1,346 @@
 """Importer long-running tasks."""
 
+import os
+import time
+import traceback
+import logging as LOG
+
 from django.conf import settings
-from celery.task import Task
-from xlsimport import importers
+from celery import result, states
+from celery.signals import worker_process_init
+from celery.task import Task, chord
+from celery.utils import uuid
+from xlsimport import connections, importers, journal, parallel, scheduler, stats
 
 DBNAME = getattr(settings, "IMPORTER_QUBIT_DBNAME", "icaatom")
 DBUSER = getattr(settings, "IMPORTER_QUBIT_DBUSER", "icaatom")
 DBPASS = getattr(settings, "IMPORTER_QUBIT_DBPASS", "changeme")
 USER = getattr(settings, "IMPORTER_QUBIT_USER", "mikeb")
+BATCH_SIZE = getattr(settings, "IMPORTER_BATCH_SIZE", None)
+# min seconds and/or rows between progress updates, either of
+# which can be None to only go by the other
+PROGRESS_INTERVAL = getattr(settings, "IMPORTER_PROGRESS_INTERVAL", 1.0)
+PROGRESS_ROWS = getattr(settings, "IMPORTER_PROGRESS_ROWS", 1000)
+# number of chunk tasks to split each import between, or 1 to
+# import in a single task
+CHUNKS = getattr(settings, "IMPORTER_CHUNKS", 1)
+# whether to read and transform rows in threads of their own while
+# writing, see `pipeline`
+PIPELINED = getattr(settings, "IMPORTER_PIPELINED", False)
+# whether imports run alongside each other, each taking one of the
+# DB's slots, see scheduler.CONCURRENCY; the scheduler's tables have
+# to have been created first, see scheduler.setup
+CONCURRENT = getattr(settings, "IMPORTER_CONCURRENT", False)
+# seconds an import waits before trying again for one of the DB's
+# slots
+QUEUE_DELAY = getattr(settings, "IMPORTER_QUEUE_DELAY", 10)
+# whether imports journal the rows they commit, so they can be
+# resumed if they fail; the journal's tables have to have been
+# created first, see journal.setup
+JOURNAL = getattr(settings, "IMPORTER_JOURNAL", False)
+# times a failed journalled import is retried, carrying on from the
+# rows it committed, and seconds to wait before each retry
+RESUME_RETRIES = getattr(settings, "IMPORTER_RESUME_RETRIES", 3)
+RESUME_DELAY = getattr(settings, "IMPORTER_RESUME_DELAY", 60)
+
+
+class Progress(object):
+    """Keeps track of how an import is going and reports it via a
+    task's state, but only when `interval` seconds or `rows` rows
+    have passed since the last report, or the import moves on to
+    another phase, so the result backend isn't written to for every
+    single row."""
+    def __init__(self, task, importer, interval=PROGRESS_INTERVAL,
+                rows=PROGRESS_ROWS, clock=time.time):
+        self.task = task
+        self.importer = importer
+        self.interval = interval
+        self.rows = rows
+        self.clock = clock
+        self.started = self.clock()
+        # when importing started, for working out the rate
+        self.importing = None
+        # rows an earlier run committed, which a resumed import skips
+        self.skipped = 0
+        self.current = 0
+        self.phase = None
+        self.last_time = None
+        self.last_current = 0
+
+    def meta(self, now):
+        """Progress info to be stored with the task state."""
+        total = self.importer.num_rows()
+        if total > 0:
+            total -= self.skipped
+        rate = eta = None
+        if self.importing is not None and now > self.importing:
+            rate = self.current / (now - self.importing)
+            if rate and total > 0:
+                eta = max(total - self.current, 0) / rate
+        return dict(current=self.current, total=total, phase=self.phase,
+                rate=rate, elapsed=now - self.started, eta=eta)
+
+    def due(self, now):
+        """Whether enough time or rows have passed to report
+        again."""
+        if self.last_time is None:
+            return True
+        if self.interval is not None and now - self.last_time >= self.interval:
+            return True
+        return self.rows is not None and \
+                self.current - self.last_current >= self.rows
+
+    def report(self, force=False):
+        now = self.clock()
+        if force or self.due(now):
+            self.task.update_state(state="PROGRESS", meta=self.meta(now))
+            self.last_time = now
+            self.last_current = self.current
+
+    def row(self, obj):
+        self.current += 1
+        self.report()
+
+    def set_phase(self, phase):
+        if phase == "importing" and self.importing is None:
+            self.importing = self.clock()
+            # the journal's rows are those resumed until we commit
+            journal = getattr(self.importer, "journal", None)
+            if journal is not None:
+                self.skipped = len(journal.done)
+        self.phase = phase
+        self.report(force=True)
+
+
+@worker_process_init.connect
+def warm_references(**kwargs):
+    """Connect to the Qubit DB and look up the reference records
+    as each worker process starts, so the first import it runs
+    doesn't have to."""
+    try:
+        engine = connections.get_engine(DBNAME, DBUSER, DBPASS)
+        connections.REFERENCES.warm(engine, USER)
+    except Exception, e:
+        # not fatal, the importer will try again when it's run
+        LOG.warning("Unable to warm importer references: %s" % e)
 
 
 class ImportXLSTask(Task):
     name = "xlsimport.ImportXSL"
-    def run(self, importerklass, xlsfile):
-        importer = getattr(importers, importerklass)(database=DBNAME, username=DBUSER, 
-                    password=DBPASS, atomuser=USER)
-        importer.validate(xlsfile)
-        total = importer.num_rows()
-        meta = dict(counter=0)
-        def rowfunc(repo):
-            meta["counter"] += 1
-            self.update_state(state="PROGRESS", meta=dict(
-                current=meta["counter"], total=total))
-        importer.rowfunc = rowfunc
-        importer.do(xlsfile)
+    # imports queue for a slot on the DB for as long as it takes
+    max_retries = None
+
+    def run(self, importerklass, xlsfile, batch_size=BATCH_SIZE, rowsfile=None,
+                chunks=CHUNKS, resume=False, attempt=0):
+        """Import an XLS file.  If `rowsfile` is given it should be
+        the spooled rows from a successful validation of the file,
+        which are imported instead of reading the file again.  If
+        they've since been evicted from the validation cache the
+        file is validated (via the cache) as usual.  With more than
+        one chunk the import is fanned out, see `fan_out`.  If
+        CONCURRENT is set, only so many imports run against the DB at
+        once; if they're all in use the task is retried until one
+        frees up.  A fanned-out import gives its slot up once its
+        chunks are sent off, since each of them takes a slot of its
+        own.  If JOURNAL is set and the import fails, other than by
+        the file not validating, it's retried up to RESUME_RETRIES
+        times, resuming from the rows committed so far rather than
+        starting again."""
+        slot = None
+        if CONCURRENT:
+            engine = connections.get_engine(DBNAME, DBUSER, DBPASS)
+            slot = scheduler.take_slot(engine)
+            if slot is None:
+                raise self.retry(countdown=QUEUE_DELAY)
+        try:
+            return self.import_xls(importerklass, xlsfile, batch_size,
+                    rowsfile, chunks, resume, attempt)
+        finally:
+            if slot is not None:
+                slot.release()
+
+    def import_xls(self, importerklass, xlsfile, batch_size, rowsfile, chunks,
+                resume, attempt):
+        importer = getattr(importers, importerklass)(database=DBNAME, username=DBUSER,
+                    password=DBPASS, atomuser=USER, batch_size=batch_size,
+                    concurrent=CONCURRENT, pipelined=PIPELINED, journalled=JOURNAL)
+        if rowsfile is not None and os.path.exists(rowsfile):
+            importer.load_rows(rowsfile)
+        progress = Progress(self, importer)
+        importer.rowfunc = progress.row
+        importer.phasefunc = progress.set_phase
+        try:
+            if chunks > 1:
+                return self.fan_out(importer, xlsfile, chunks, resume)
+            # the stats report ends up as the task's result
+            return importer.do(xlsfile, resume=resume)
+        except Exception, e:
+            # in case that was down to the reference records having
+            # changed under us, look them up again next time
+            connections.REFERENCES.invalidate(importer.engine)
+            if importer.errors or importer.journal is None \
+                    or attempt >= RESUME_RETRIES:
+                raise
+            raise self.retry(args=(importerklass, xlsfile), kwargs=dict(
+                    batch_size=batch_size, rowsfile=rowsfile, chunks=chunks,
+                    resume=True, attempt=attempt + 1),
+                    exc=e, countdown=RESUME_DELAY)
+
+    def fan_out(self, importer, xlsfile, chunks, resume=False):
+        """Validate the file and create the records rows share,
+        then split the rows into chunks, each with its identifiers
+        and slugs set aside, and send them, rows and all, to
+        ImportChunkTasks across the worker pool, with a
+        MergeReportsTask to put their reports together and clean up
+        once they're all done, whether or not they succeeded.  Returns the
+        chunk task ids and sizes and the merge task id, which is
+        what ImportResult needs to follow the rest of the import."""
+        partitions = []
+        try:
+            partitions = parallel.plan(importer, xlsfile, chunks, resume)
+            importer.set_phase("importing")
+            importer.stats.enter(None)
+            importer.stats.deactivate()
+            header = [ImportChunkTask.subtask((p.job(importer, inline=True),),
+                    task_id=uuid()) for p in partitions]
+            for partition in partitions:
+                partition.spool.discard()
+            owner = importer.scheduler.owner if importer.scheduler else None
+            journal_id = importer.journal.import_id if importer.journal else None
+            callback = MergeReportsTask.subtask((importer.stats.report(),
+                    owner, journal_id), task_id=uuid())
+            started = time.time()
+            merged = chord(header)(callback)
+        except Exception:
+            for partition in partitions:
+                partition.spool.discard()
+            if importer.scheduler is not None:
+                importer.scheduler.release()
+            raise
+        # when run eagerly, i.e. in tests, it's all over already
+        if merged.ready():
+            return merged.get()
+        return dict(
+            chunks=[(t.options["task_id"], p.nrows) for t, p in zip(header, partitions)],
+            merge=callback.options["task_id"],
+            started=started,
+        )
+
+
+class ImportChunkTask(Task):
+    name = "xlsimport.ImportChunk"
+    # chunks queue for a slot on the DB like whole imports
+    max_retries = None
+
+    def run(self, job):
+        """Import one chunk of a fanned-out import, in one of the
+        DB's slots if CONCURRENT is set.  The chunk is committed by
+        itself, so if it fails only its rows are lost.  Returns its
+        stats report and None, or None and the error, rather than
+        failing, so the chord's MergeReportsTask still runs and
+        cleans up after the import."""
+        engine = connections.get_engine(DBNAME, DBUSER, DBPASS)
+        slot = None
+        if CONCURRENT:
+            slot = scheduler.take_slot(engine)
+            if slot is None:
+                raise self.retry(countdown=QUEUE_DELAY)
+        try:
+            return self.import_chunk(job), None
+        except Exception:
+            connections.REFERENCES.invalidate(engine)
+            return None, traceback.format_exc()
+        finally:
+            if slot is not None:
+                slot.release()
+
+    def import_chunk(self, job):
+        importer = parallel.partition_importer(job)
+        progress = Progress(self, importer)
+        importer.rowfunc = progress.row
+        importer.phasefunc = progress.set_phase
+        try:
+            return importer.do(None)
+        finally:
+            importer.discard_rows()
+
+
+class MergeReportsTask(Task):
+    name = "xlsimport.MergeReports"
+    def run(self, results, report, owner=None, journal_id=None):
+        """Drop the slug claims of a fanned-out import now its
+        chunks are over, then, if they all succeeded, mark it
+        finished in the journal and merge their stats reports into
+        that of the task which fanned them out.  If any failed the
+        import is left unfinished, so it can be resumed, and the
+        chunks' errors raised."""
+        if owner is not None:
+            scheduler.release_claims(
+                    connections.get_engine(DBNAME, DBUSER, DBPASS), owner)
+        errors = ["Chunk %d: %s" % (i, error) \
+                for i, (_, error) in enumerate(results) if error is not None]
+        if errors:
+            raise importers.XLSImportError("\n".join(errors))
+        if journal_id is not None:
+            engine = connections.get_engine(DBNAME, DBUSER, DBPASS)
+            journal.Journal(engine, journal_id).finish(engine)
+        return stats.merge_reports(report, [r for r, _ in results])
+
+
+class ImportResult(object):
+    """The state of an import task, which can be used in place of
+    its AsyncResult.  Once a fanned-out import has been handed to
+    its chunk tasks the task that fanned it out has succeeded, but
+    the import goes on: the state is then worked out from the chunks
+    and the task merging their reports, and the progress is the sum
+    of the chunks'.  That progress says when the import started
+    rather than how long it has been going, so it only changes when
+    the chunks' progress does."""
+    def __init__(self, task_id, lookup=result.AsyncResult):
+        self.task_id = task_id
+        async = lookup(task_id)
+        self.status = async.status
+        self.result = async.result
+        if self.status == states.SUCCESS and isinstance(self.result, dict) \
+                and "chunks" in self.result:
+            self.combine(self.result, lookup)
+
+    @property
+    def state(self):
+        return self.status
+
+    @property
+    def info(self):
+        return self.result
+
+    def combine(self, fanout, lookup):
+        merge = lookup(fanout["merge"])
+        if merge.status in states.READY_STATES:
+            self.status, self.result = merge.status, merge.result
+            return
+        current = 0
+        for task_id, nrows in fanout["chunks"]:
+            chunk = lookup(task_id)
+            if chunk.status == "PROGRESS":
+                current += chunk.info["current"]
+            elif chunk.status == states.SUCCESS:
+                current += nrows
+            elif chunk.status in states.PROPAGATE_STATES:
+                self.status, self.result = chunk.status, chunk.result
+                return
+        total = sum(nrows for _, nrows in fanout["chunks"])
+        self.status = "PROGRESS"
+        self.result = dict(current=current, total=total, phase="importing",
+                started=fanout["started"])
+
+    def ready(self):
+        return self.status in states.READY_STATES
+
+    def failed(self):
+        return self.status == states.FAILURE
+
+    def successful(self):
+        return self.status == states.SUCCESS
 
 
 
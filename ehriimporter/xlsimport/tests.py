@@ -1,11 +1,48 @@
 """
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
-
-Replace this with more appropriate tests for your application.
+Tests for the xlsimport app.  These avoid touching the Qubit DB,
+using throwaway SQLite stand-ins where they need one, so they can
+be run with "manage.py test".  The stand-ins get the real Qubit
+schema from sqlaqubit, so that has to be installed, see
+requirements; don't fake its models, or tests which depend on the
+schema, i.e. the writers', will pass without meaning anything.
 """
 
+import os
+import copy
+import random
+import shutil
+import threading
+import cPickle
+import datetime
+import time
+import tempfile
+
 from django.test import TestCase
+from django.test.client import RequestFactory
+from sqlalchemy import MetaData, Table, Column, Integer, String, create_engine
+from sqlalchemy.orm import class_mapper
+
+from xlsimport import benchmarks, cache, cells, connections, dates, importers, lookups
+from xlsimport import parallel, pipeline
+from xlsimport import journal, readers, registry, scheduler, stats, tasks, utils
+from xlsimport import validators, views, writers
+
+
+class StandinTestCase(TestCase):
+    """Tests which need a Qubit DB get a stand-in SQLite one with
+    the reference records and a repository."""
+    def setUp(self):
+        fd, self.dbpath = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.url = "sqlite:///%s" % self.dbpath
+        self.engine = benchmarks.setup_standin(self.url, "qubit", (1,))
+
+    def tearDown(self):
+        connections.dispose_engines()
+        os.unlink(self.dbpath)
+
+    def importer(self, klass=importers.Collection, **kwargs):
+        return klass(url=self.url, atomuser="qubit", **kwargs)
 
 
 class SimpleTest(TestCase):
@@ -14,3 +51,902 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class SlugRegistryTest(TestCase):
+    def test_unique_bumps_suffix(self):
+        slugs = registry.SlugRegistry()
+        slugs.taken.update(["poland", "poland-1"])
+        self.assertEqual(slugs.unique("poland"), "poland-2")
+        self.assertEqual(slugs.unique("poland"), "poland-3")
+        self.assertEqual(slugs.unique("germany"), "germany")
+
+    def test_commit_moves_pending(self):
+        slugs = registry.SlugRegistry()
+        slug = slugs.random(6)
+        self.assertEqual(len(slug), 6)
+        self.assertTrue(slug in slugs.pending)
+        slugs.commit()
+        self.assertTrue(slug in slugs.taken)
+        self.assertFalse(slugs.pending)
+
+
+class IdentifierAllocatorTest(TestCase):
+    def test_assigned_numbers_run_out(self):
+        ids = registry.IdentifierAllocator(None)
+        ids.assign(ids.key("model", "c", ""), 5, 7)
+        self.assertEqual(ids.next("model", "c", "", format="%03d"), u"c005")
+        self.assertEqual(ids.next("model", "c", "", format="%03d"), u"c006")
+        self.assertRaises(registry.AllocationError, ids.next, "model", "c", "")
+
+    def test_high_water(self):
+        engine = create_engine("sqlite://")
+        table = Table("record", MetaData(), Column("identifier", String(32)))
+        table.create(engine)
+        engine.execute(table.insert(), [dict(identifier=v) for v in (u"c000000009",
+                u"c000000010", u"c00000001x", u"cx", u"r000001GB", None)])
+        ids = registry.IdentifierAllocator(None)
+        self.assertEqual(ids.high_water(table.c, "identifier", "c", "", engine), 10)
+        self.assertEqual(ids.high_water(table.c, "identifier", "r", "GB", engine), 1)
+        self.assertEqual(ids.high_water(table.c, "identifier", "r", "DE", engine), 0)
+
+
+class AuthorityIndexTest(TestCase):
+    def test_normalize_name(self):
+        self.assertEqual(lookups.normalize_name(u"  Smith,   John, "),
+                u"smith, john")
+
+    def test_added_actors_found_without_query(self):
+        index = lookups.AuthorityIndex(None)
+        actor = object()
+        index.add(u"Smith, John", actor)
+        self.assertTrue(index.get(u"smith,  john,") is actor)
+
+
+class TermCacheTest(TestCase):
+    def test_terms_keyed_on_taxonomy_and_culture(self):
+        terms = lookups.TermCache(None)
+        terms.loaded.update([1, 2])
+        term = object()
+        terms.add(1, u"Poland", "en", term)
+        self.assertTrue(terms.get(1, u"poland ", "en") is term)
+        self.assertTrue(terms.get(1, u"Poland", "fr") is None)
+        self.assertTrue(terms.get(2, u"Poland", "en") is None)
+
+
+class ValidationPlanTest(TestCase):
+    def test_collection_plan(self):
+        plan = validators.load_definitions("collections.yaml").compile()
+        self.assertTrue(plan is validators.Collection().plan)
+        self.assertEqual(plan.limits, (("dates", 2),))
+        self.assertTrue("title" in plan.singles)
+        self.assertFalse("subject_access" in plan.singles)
+        self.assertEqual(plan.headings[plan.index["creator"]], "creator")
+
+
+class ValidatorErrorsTest(TestCase):
+    def test_validator_without_definitions(self):
+        validator = validators.XLSValidator()
+        self.assertEqual(validator.HEADINGS, [])
+        self.assertEqual(validator.errors, [])
+
+    def test_column_errors_come_first(self):
+        generator = benchmarks.SheetGenerator(validators.Collection,
+                seed=1, bad_rate=0.0)
+        index = dict((h, i) for i, h in enumerate(generator.headings))
+        rows = [values for _, values in generator.rows(3)]
+        rows[0][index["repository_code"]] = u""
+        rows[2][index["dates"]] = u"not a date"
+        rows[1][index["identifier"]] = rows[0][index["identifier"]]
+        validator = validators.Collection()
+        validator.check_rows((rownum, cells.Row(generator.headings, values)) \
+                for rownum, values in enumerate(rows))
+        self.assertEqual([(row, msg.split(":")[0]) for row, msg, _ in validator.errors],
+                [(0, "Duplicate on unique column"),
+                 (0, "Missing value on required column"),
+                 (2, "Bad date string in field")])
+        self.assertTrue(isinstance(validator.errors[1][1], str))
+
+
+class RandomSlugTest(TestCase):
+    def test_random_slugs_start_with_initials(self):
+        slugs = registry.SlugRegistry()
+        slugs.initials = "ab"
+        for _ in range(50):
+            slug = slugs.random(6)
+            self.assertEqual(len(slug), 6)
+            self.assertTrue(slug[0] in "ab")
+
+
+class ImporterSetupTest(StandinTestCase):
+    def test_engine_is_the_db_engine(self):
+        importer = self.importer(importers.Collection)
+        self.assertTrue(importer.engine is connections.get_engine(url=self.url))
+        importer.session.close()
+
+    def test_importers_share_the_slugs(self):
+        first = self.importer()
+        table = class_mapper(connections.models.Slug).local_table
+        self.engine.execute(table.insert(), object_id=1, slug=u"added-later")
+        second = self.importer()
+        self.assertTrue(second.slugs.taken is first.slugs.taken)
+        self.assertTrue(u"added-later" in second.slugs)
+        first.session.close()
+        second.session.close()
+
+    def test_references_are_loaded_fresh(self):
+        first = self.importer()
+        table = class_mapper(connections.models.Actor).local_table
+        self.engine.execute(table.update().where(table.c.id == first.actorroot.id),
+                source_culture="fr")
+        second = self.importer()
+        self.assertEqual(second.actorroot.source_culture, "fr")
+        first.session.close()
+        second.session.close()
+
+    def test_partitions_act_for_the_import_scheduler(self):
+        parent = self.importer(concurrent=True)
+        parent.scheduler.claim([u"claimed"])
+        partition = parallel.Partition(0)
+        partition.spool.close()
+        try:
+            child = parallel.partition_importer(partition.job(parent, inline=True))
+        finally:
+            partition.spool.discard()
+        self.assertEqual(child.scheduler.owner, parent.scheduler.owner)
+        self.assertEqual(child.scheduler.taken([u"claimed"]), set())
+        other = scheduler.Scheduler(self.engine)
+        self.assertEqual(other.taken([u"claimed"]), set([u"claimed"]))
+        # the claims are the parent's to drop
+        child.scheduler.release()
+        self.assertEqual(other.taken([u"claimed"]), set([u"claimed"]))
+        parent.scheduler.release()
+        self.assertEqual(other.taken([u"claimed"]), set())
+        child.session.close()
+        parent.session.close()
+
+
+class ValidationCacheTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = cache.ValidationCache(self.directory, entries=2)
+        fd, self.path = tempfile.mkstemp(suffix=".xls")
+        os.close(fd)
+        benchmarks.generate(self.path, validators.Repository, 20, seed=1, bad_rate=0.2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        os.unlink(self.path)
+
+    def validate(self, keep_rows=True, fielddef=None):
+        validator = validators.Repository()
+        if fielddef is not None:
+            validator.fielddef = fielddef
+        hit = self.cache.validate(validator, self.path, keep_rows)
+        return hit, validator
+
+    def test_results_are_reused(self):
+        hit, first = self.validate()
+        self.assertFalse(hit)
+        self.assertTrue(first.errors)
+        hit, second = self.validate()
+        self.assertTrue(hit)
+        self.assertEqual(second.errors, first.errors)
+        self.assertEqual(list(second.iter_rows()), list(first.iter_rows()))
+        first.discard_rows()
+        second.discard_rows()
+
+    def test_changes_miss(self):
+        self.validate(keep_rows=False)
+        # rows weren't kept, so validating to import can't use it
+        hit, validator = self.validate()
+        self.assertFalse(hit)
+        validator.discard_rows()
+        self.assertTrue(self.validate(keep_rows=False)[0])
+        fielddef = copy.copy(validators.Repository().fielddef)
+        fielddef.digest = "0" * 64
+        self.assertFalse(self.validate(keep_rows=False, fielddef=fielddef)[0])
+        benchmarks.generate(self.path, validators.Repository, 20, seed=2, bad_rate=0.2)
+        self.assertFalse(self.validate(keep_rows=False)[0])
+
+
+class RowSourceTest(TestCase):
+    ROWS = [
+        [u"heading", u"number", u"flag", u"empty", u"last"],
+        [u"text", 3, True, None, 2.5],
+        [u"short"],
+    ]
+
+    def write(self, suffix):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        os.close(fd)
+        if suffix == ".xls":
+            book = benchmarks.xlwt.Workbook(encoding="utf-8")
+            sheet = book.add_sheet("Data")
+            for rownum, values in enumerate(self.ROWS):
+                for col, value in enumerate(values):
+                    if value is not None:
+                        sheet.write(rownum, col, value)
+        else:
+            book = readers.openpyxl.Workbook(write_only=True)
+            sheet = book.create_sheet()
+            for values in self.ROWS:
+                sheet.append(values)
+        book.save(path)
+        return path
+
+    def read(self, path, start, width):
+        with readers.open_rows(path) as source:
+            return list(source.rows(start, width))
+
+    def test_xls_and_xlsx_rows_match(self):
+        # .xlsx support is optional
+        paths = [self.write(".xls")]
+        if readers.openpyxl is not None:
+            paths.append(self.write(".xlsx"))
+        try:
+            for path in paths:
+                self.assertEqual(self.read(path, 1, 5), [
+                    (1, [u"text", 3.0, 1, u"", 2.5]),
+                    (2, [u"short", u"", u"", u"", u""]),
+                ])
+                # trimmed, and padded beyond the last column
+                self.assertEqual(self.read(path, 1, 2), [(1, [u"text", 3.0]),
+                        (2, [u"short", u""])])
+                self.assertEqual(self.read(path, 2, 6)[0][1], [u"short"] + [u""] * 5)
+                self.assertEqual(type(self.read(path, 1, 2)[0][1][1]), float)
+                with readers.open_rows(path) as source:
+                    self.assertEqual(source.row(0, 1), [u"heading"])
+                    self.assertEqual(source.row(3), None)
+        finally:
+            for path in paths:
+                os.unlink(path)
+
+
+class InsertRowsTest(TestCase):
+    def test_ids_follow_insert_order(self):
+        engine = create_engine("sqlite://")
+        table = Table("object", MetaData(), Column("id", Integer, primary_key=True),
+                Column("class_name", String(255)))
+        table.create(engine)
+        conn = engine.connect()
+        conn.execute(table.insert(), class_name=u"before")
+        # more rows than go in one statement
+        ids = writers.insert_rows(conn, table,
+                [dict(class_name=u"row%d" % i) for i in range(1200)])
+        self.assertEqual(ids, range(2, 1202))
+        names = dict(conn.execute(table.select()).fetchall())
+        self.assertTrue(all(names[rowid] == u"row%d" % i for i, rowid in enumerate(ids)))
+        conn.close()
+
+
+class BatchCommitTest(TestCase):
+    class Importer(object):
+        import_xls = importers.XLSImporter.import_xls.im_func
+
+        def __init__(self, nrows, batch_size, pipelined=False):
+            self.rows = range(nrows)
+            self.batch_size = batch_size
+            self.pipelined = pipelined
+            self.journal = None
+            self.row_slugs = {}
+            self.rowfunc = self.donefunc = None
+            self.stats = stats.ImportStats()
+            self.events = []
+
+        def set_phase(self, phase):
+            pass
+
+        def prepare(self):
+            pass
+
+        def pending_rows(self):
+            return ((rownum, None) for rownum in self.rows)
+
+        def transform_row(self, rownum, record):
+            return None
+
+        def import_row(self, rownum, record, payload=None):
+            self.events.append(rownum)
+
+        def commit(self):
+            self.events.append("commit")
+
+        def release(self):
+            self.events.append("release")
+
+    def test_commits_and_releases_every_batch(self):
+        for pipelined in (False, True):
+            importer = self.Importer(7, 3, pipelined)
+            importer.import_xls(None)
+            self.assertEqual(importer.events, [0, 1, 2, "commit", "release",
+                    3, 4, 5, "commit", "release", 6, "commit"])
+
+    def test_commits_once_without_a_batch_size(self):
+        importer = self.Importer(5, None)
+        importer.import_xls(None)
+        self.assertEqual(importer.events, [0, 1, 2, 3, 4, "commit"])
+
+
+class ReleaseTest(StandinTestCase):
+    def test_retained_actors_can_be_updated_after_a_batch(self):
+        importer = self.importer()
+        try:
+            person = importer._get_or_create_authority(u"Jane Doe",
+                    importers.keys.TermKeys.PERSON_ID)
+            importer.commit()
+            importer.release()
+            importer._get_or_create_authority(u"Jane Doe",
+                    importers.keys.TermKeys.PERSON_ID, history=u"Born 1900")
+            importer.commit()
+            self.assertEqual(self.engine.execute(
+                    "SELECT history FROM actor_i18n WHERE id = ?",
+                    person.id).scalar(), u"Born 1900")
+        finally:
+            importer.session.close()
+
+
+class CheckReferencesTest(StandinTestCase):
+    def test_unknown_repositories_are_errors(self):
+        generator = benchmarks.SheetGenerator(validators.Collection, seed=1,
+                bad_rate=0.0, repositories=(1, 7))
+        rows = [(rownum, cells.Row(generator.headings, values)) \
+                for rownum, values in generator.rows(30)]
+        unknown = [rownum for rownum, row in rows if row["repository_code"] == 7.0]
+        self.assertTrue(unknown and len(unknown) < len(rows))
+        importer = self.importer()
+        try:
+            for rownum, row in rows:
+                importer.track_references(rownum, row)
+            importer.check_references()
+            self.assertEqual([e[0] for e in importer.errors], unknown)
+            self.assertEqual(set(e[1] for e in importer.errors),
+                    set(["Unable to find repository with identifier: 7.0"]))
+            self.assertEqual(importer.repositories.keys(), [1])
+        finally:
+            importer.session.close()
+
+
+class WriterParityTest(StandinTestCase):
+    # leaf tables, with the id of their parent object and of the
+    # row their i18n rows hang off
+    LEAVES = [
+        ("note", "object_id", "note_i18n"),
+        ("other_name", "object_id", "other_name_i18n"),
+        ("property", "object_id", "property_i18n"),
+        ("object_term_relation", "object_id", None),
+        ("status", "object_id", None),
+    ]
+
+    def leaf_rows(self, engine):
+        """The leaf rows in a DB, with ids, which depend on the order
+        things were inserted in, swapped for the parent's slug."""
+        slugs = dict(engine.execute("SELECT object_id, slug FROM slug").fetchall())
+        leaves = dict(slugs=sorted(slugs.values()))
+        for table, parent, i18n in self.LEAVES:
+            rows = []
+            for row in engine.execute("SELECT * FROM %s" % table):
+                row = dict(row)
+                rowid = row.pop("id")
+                row[parent] = slugs.get(row[parent])
+                if i18n is not None:
+                    row[i18n] = sorted(sorted(dict(r, id=None).items()) for r in \
+                            engine.execute("SELECT * FROM %s WHERE id = ?" % i18n, rowid))
+                rows.append(sorted(row.items()))
+            leaves[table] = sorted(rows)
+        return leaves
+
+    def test_core_writes_the_same_rows_as_orm(self):
+        fd, path = tempfile.mkstemp(suffix=".xls")
+        os.close(fd)
+        fd, dbpath = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        try:
+            benchmarks.generate(path, validators.Collection, 50, seed=2, bad_rate=0.0)
+            core = "sqlite:///%s" % dbpath
+            benchmarks.setup_standin(core, "qubit", (1,))
+            random.seed(0)
+            self.importer(writer="orm").do(path)
+            random.seed(0)
+            importers.Collection(url=core, atomuser="qubit", writer="core").do(path)
+            orm_rows = self.leaf_rows(self.engine)
+            self.assertTrue(orm_rows["note"] and orm_rows["property"])
+            self.assertEqual(orm_rows, self.leaf_rows(connections.get_engine(url=core)))
+        finally:
+            connections.dispose_engines()
+            os.unlink(dbpath)
+            os.unlink(path)
+
+
+class SheetGeneratorTest(TestCase):
+    def test_only_bad_rows_have_errors(self):
+        generator = benchmarks.SheetGenerator(validators.Collection,
+                seed=1, bad_rate=0.2)
+        validator = validators.Collection()
+        validator.check_rows((rownum, cells.Row(generator.headings, values)) \
+                for rownum, values in generator.rows(500))
+        self.assertTrue(generator.bad)
+        self.assertEqual(sorted(set(e[0] for e in validator.errors)),
+                generator.bad)
+
+    def test_regressions(self):
+        base = dict(rows=10, seed=0, rows_per_sec=100.0,
+                queries_per_row=5.0, peak_kb=1000)
+        result = dict(base, rows_per_sec=70.0, queries_per_row=5.5)
+        self.assertEqual(benchmarks.regressions(dict(validate=result),
+                dict(validate=base)), [("validate", "rows_per_sec", 100.0, 70.0)])
+
+
+class RowTest(TestCase):
+    def test_cells_split_once(self):
+        row = cells.Row(("title", "dates"), (u"Title", u"1939,, ,,1945"))
+        self.assertEqual(row.split("dates"), [u"1939", u"1945"])
+        self.assertTrue(row.split("dates") is row.split("dates"))
+        self.assertTrue(row.cell("dates").multiple)
+        self.assertTrue(row.cell("missing").blank)
+
+    def test_pickle_drops_cells(self):
+        row = cells.Row(("title", "phone"), (u"Title", 123.0))
+        self.assertEqual(row.text("phone"), u"123.0")
+        copy = cPickle.loads(cPickle.dumps(row, cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual(copy, row)
+        self.assertEqual(copy.cells, {})
+        self.assertTrue(copy.index is row.index)
+
+
+class DatesTest(TestCase):
+    def test_range_fills_in_start_and_end(self):
+        self.assertEqual(dates.date_range([u"c1940.0", u"1943-02"]), dict(
+                start_date=datetime.datetime(1940, 1, 1),
+                end_date=datetime.datetime(1943, 2, 28)))
+
+    def test_fast_path_agrees_with_dateutil(self):
+        for datestr in (u"1939", u"1942-05-01", u"1943-2-3"):
+            self.assertEqual(dates._fast_parse(datestr, False),
+                    dates._slow_parse(datestr, False))
+        self.assertRaises(ValueError, dates.parse, u"1941-1945")
+
+    def test_lru_cache_evicts_oldest(self):
+        cache = utils.LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertEqual(sorted(cache.links), ["a", "c"])
+
+    def test_lru_cache_survives_threads(self):
+        cache = utils.LRUCache(50)
+        def work(seed):
+            rand = random.Random(seed)
+            for _ in range(5000):
+                key = rand.randrange(100)
+                if cache.get(key) is None:
+                    cache.put(key, key)
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the list still links up every item, and only them
+        keys, link = [], cache.root[1]
+        while link is not cache.root:
+            keys.append(link[2])
+            link = link[1]
+        self.assertEqual(len(keys), 50)
+        self.assertEqual(sorted(keys), sorted(cache.links))
+
+
+class CountryIndexTest(TestCase):
+    def test_names_are_normalized(self):
+        self.assertEqual(utils.normalize_country(u" C\xf4te D\u2019Ivoire "),
+                u"cote divoire")
+        self.assertEqual(utils.get_code_from_country(u"russia"), "RU")
+        self.assertEqual(utils.get_country_from_code("ru"), "Russia")
+        self.assertTrue(utils.get_code_from_country(u"Narnia") is None)
+
+
+class ProgressTest(TestCase):
+    class FakeTask(object):
+        def __init__(self):
+            self.updates = []
+
+        def update_state(self, state, meta):
+            self.updates.append(meta)
+
+    class FakeImporter(object):
+        def num_rows(self):
+            return 100
+
+    def test_updates_are_throttled(self):
+        now = [0.0]
+        task = self.FakeTask()
+        progress = tasks.Progress(task, self.FakeImporter(), interval=5,
+                rows=None, clock=lambda: now[0])
+        progress.set_phase("importing")
+        for i in range(50):
+            now[0] += 0.5
+            progress.row(None)
+        # the phase change, then one every 10 rows
+        self.assertEqual(len(task.updates), 6)
+        last = task.updates[-1]
+        self.assertEqual((last["current"], last["phase"]), (50, "importing"))
+        self.assertEqual((last["rate"], last["eta"]), (2.0, 25.0))
+
+    def test_resumed_rows_are_left_out(self):
+        task = self.FakeTask()
+        importer = self.FakeImporter()
+        importer.journal = journal.Journal(None, 1, done=range(40))
+        progress = tasks.Progress(task, importer, interval=None, rows=None)
+        progress.set_phase("validating")
+        progress.set_phase("importing")
+        self.assertEqual(task.updates[-1]["total"], 60)
+        # rows this run commits don't count as skipped
+        importer.journal.done.update(range(40, 50))
+        progress.set_phase("importing")
+        self.assertEqual(task.updates[-1]["total"], 60)
+
+
+class ProgressJSONTest(TestCase):
+    def setUp(self):
+        self.saved = views.task_state, views.LONGPOLL_TIMEOUT, views.PROGRESS_TTL
+        views.LONGPOLL_TIMEOUT, views.PROGRESS_TTL = 0.2, 0.01
+        # the states the task goes through, the last repeated
+        self.states = []
+        self.calls = 0
+        def task_state(task_id):
+            self.calls += 1
+            return self.states[min(self.calls, len(self.states)) - 1]
+        views.task_state = task_state
+
+    def tearDown(self):
+        views.task_state, views.LONGPOLL_TIMEOUT, views.PROGRESS_TTL = self.saved
+
+    def get(self, etag=None, **params):
+        headers = {} if etag is None else dict(HTTP_IF_NONE_MATCH=etag)
+        return views.progress_json(RequestFactory().get("/", params, **headers),
+                "task")
+
+    def test_unchanged_state_is_not_modified(self):
+        self.states = [('{"current": 1}', '"a"', False)]
+        response = self.get()
+        self.assertEqual((response.status_code, response["ETag"]), (200, '"a"'))
+        self.assertEqual(response.content, '{"current": 1}')
+        response = self.get('"a"')
+        self.assertEqual((response.status_code, response["ETag"]), (304, '"a"'))
+        self.assertEqual(self.get('"old"').status_code, 200)
+
+    def test_long_poll_waits_for_a_change(self):
+        self.states = [('{"current": 1}', '"a"', False)] * 3 + \
+                [('{"current": 2}', '"b"', False)]
+        response = self.get('"a"', wait=1)
+        self.assertEqual((response.status_code, response["ETag"]), (200, '"b"'))
+        self.assertEqual(self.calls, 4)
+
+    def test_long_poll_times_out(self):
+        self.states = [('{"current": 1}', '"a"', False)]
+        started = time.time()
+        response = self.get('"a"', wait=1)
+        self.assertEqual(response.status_code, 304)
+        self.assertTrue(time.time() - started >= views.LONGPOLL_TIMEOUT)
+        self.assertTrue(self.calls > 1)
+
+    def test_long_poll_ends_with_the_task(self):
+        self.states = [('{"state": "SUCCESS"}', '"a"', True)]
+        response = self.get('"a"', wait=1)
+        self.assertEqual((response.status_code, self.calls), (304, 1))
+
+
+class FanOutTest(TestCase):
+    class FakeResult(object):
+        def __init__(self, status, result=None):
+            self.status = self.state = status
+            self.result = self.info = result
+
+    def test_progress_combines_chunks(self):
+        results = dict(
+            coord=self.FakeResult("SUCCESS", dict(chunks=[("a", 10), ("b", 10),
+                    ("c", 5)], merge="m", started=0.0)),
+            a=self.FakeResult("SUCCESS", {}),
+            b=self.FakeResult("PROGRESS", dict(current=4)),
+            c=self.FakeResult("PENDING"),
+            m=self.FakeResult("PENDING"),
+        )
+        state = tasks.ImportResult("coord", lookup=results.get)
+        self.assertEqual(state.status, "PROGRESS")
+        self.assertFalse(state.ready())
+        self.assertEqual((state.info["current"], state.info["total"]), (14, 25))
+        self.assertEqual(state.info["started"], 0.0)
+        info = views.timing(state.info, 7.0)
+        self.assertEqual((info["elapsed"], info["rate"], info["eta"]), (7.0, 2.0, 5.5))
+        results["m"] = self.FakeResult("SUCCESS", dict(rows=25))
+        state = tasks.ImportResult("coord", lookup=results.get)
+        self.assertTrue(state.successful())
+        self.assertEqual(state.result, dict(rows=25))
+
+    def test_unchanged_chunks_are_not_modified(self):
+        results = dict(
+            coord=self.FakeResult("SUCCESS", dict(chunks=[("a", 10), ("b", 10)],
+                    merge="m", started=time.time() - 60)),
+            a=self.FakeResult("PROGRESS", dict(current=4)),
+            b=self.FakeResult("PENDING"),
+            m=self.FakeResult("PENDING"),
+        )
+        saved = tasks.ImportResult
+        tasks.ImportResult = lambda task_id: saved(task_id, lookup=results.get)
+        try:
+            def get(etag=None):
+                # skip the state cache, so the results are asked again
+                views.state_cache.delete("xlsimport-progress-coord")
+                headers = {} if etag is None else dict(HTTP_IF_NONE_MATCH=etag)
+                return views.progress_json(RequestFactory().get("/", **headers),
+                        "coord")
+            response = get()
+            self.assertEqual(response.status_code, 200)
+            time.sleep(0.01)
+            self.assertEqual(get(response["ETag"]).status_code, 304)
+            results["a"] = self.FakeResult("PROGRESS", dict(current=5))
+            self.assertEqual(get(response["ETag"]).status_code, 200)
+        finally:
+            tasks.ImportResult = saved
+
+    def test_merge_reports(self):
+        report = dict(elapsed=2.0, rows=0, per_row=None, phases=dict(validating=1.0),
+                queries=dict(other=dict(count=1, seconds=0.5)), total_queries=1)
+        part = dict(report, rows=4, phases=dict(importing=2.0))
+        merged = tasks.MergeReportsTask.apply(args=([(part, None), (part, None)],
+                report)).get()
+        self.assertEqual((merged["rows"], merged["workers"]), (8, 2))
+        self.assertEqual(merged["phases"], {"validating": 1.0,
+                "worker importing": 4.0})
+        self.assertEqual(merged["queries"]["other"], dict(count=3, seconds=1.5))
+        self.assertEqual(merged["per_row"], 0.5)
+        self.assertEqual(report["queries"]["other"]["count"], 1)
+
+    def test_merge_fails_if_a_chunk_did(self):
+        report = dict(elapsed=2.0, rows=0, per_row=None, phases={}, queries={},
+                total_queries=0)
+        merged = tasks.MergeReportsTask.apply(args=([(report, None),
+                (None, "Traceback: it broke")], report))
+        self.assertTrue(merged.failed())
+        self.assertTrue("Chunk 1: Traceback: it broke" in str(merged.result))
+
+
+class ParallelSplitTest(TestCase):
+    class Importer(object):
+        def __init__(self, rows):
+            self.rows = rows
+            self.slugs = registry.SlugRegistry()
+            self.ids = self
+            self.scheduler = None
+            self.journal = None
+            self.arguments = {}
+            self.timestamp = None
+            self.row_slugs = dict((rownum, self.slugs.unique(record["name"])) \
+                    for rownum, record in rows)
+
+        def num_rows(self):
+            return len(self.rows)
+
+        def pending_rows(self):
+            return iter(self.rows)
+
+        def identifier_pattern(self, record):
+            return "model", "r", record["country"], "%06d"
+
+        def high_water(self, model, attr, prefix, suffix, bind=None):
+            return dict(GB=41).get(suffix, 0)
+
+    def test_partitions_get_their_own_identifiers_and_slugs(self):
+        rows = [(rownum, cells.Row(("name", "country"), (u"archive", country))) \
+                for rownum, country in enumerate(["GB", "DE", "GB", "GB", "DE"])]
+        parts = parallel.split(self.Importer(rows), 2)
+        try:
+            self.assertEqual([p.nrows for p in parts], [3, 2])
+            gb = registry.IdentifierAllocator.key("model", "r", "GB")
+            de = registry.IdentifierAllocator.key("model", "r", "DE")
+            self.assertEqual([p.ranges[gb] for p in parts], [(42, 44), (44, 45)])
+            self.assertEqual([p.ranges[de] for p in parts], [(1, 2), (2, 3)])
+            self.assertEqual(parts[1].slugs, {3: "archive-3", 4: "archive-4"})
+            self.assertFalse(set(parts[0].initials) & set(parts[1].initials))
+            self.assertEqual(len(parts[0].initials + parts[1].initials),
+                    len(utils.SLUG_CHARS))
+            self.assertEqual(list(readers.RowSpool(parts[1].spool.path)), rows[3:])
+            self.assertEqual(parts[1].job(self.Importer(rows), inline=True)[3],
+                    rows[3:])
+        finally:
+            for part in parts:
+                part.spool.discard()
+
+
+class PipelineTest(TestCase):
+    def rows(self, count):
+        return [(rownum, cells.Row(("date",), (u"19%02d" % rownum,))) \
+                for rownum in range(count)]
+
+    def test_same_as_sequential(self):
+        transform = lambda rownum, record: dates.date_range(record.split("date"))
+        rows = self.rows(50)
+        expected = [(rownum, record, transform(rownum, record)) \
+                for rownum, record in rows]
+        with pipeline.Pipeline(iter(rows), transform, maxsize=4) as rows:
+            self.assertEqual(list(rows), expected)
+
+    def test_errors_are_raised_in_the_writer(self):
+        def transform(rownum, record):
+            if rownum == 3:
+                raise ValueError("bad row")
+        seen = []
+        with pipeline.Pipeline(iter(self.rows(10)), transform, maxsize=2) as rows:
+            try:
+                for rownum, record, payload in rows:
+                    seen.append(rownum)
+            except ValueError, e:
+                self.assertEqual(str(e), "bad row")
+            else:
+                self.fail("Transform error wasn't raised")
+        self.assertEqual(seen, [0, 1, 2])
+
+    def test_close_stops_stages(self):
+        rows = pipeline.Pipeline(iter(self.rows(1000)), lambda *args: {}, maxsize=2)
+        for row in rows:
+            break
+        rows.close()
+        self.assertFalse([t for t in rows.threads if t.is_alive()])
+
+
+class SchedulerTest(TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        scheduler.setup(self.engine)
+
+    def test_imports_reserve_separate_identifiers(self):
+        key = registry.IdentifierAllocator.key("Repository", "r", "GB")
+        first = scheduler.Scheduler(self.engine)
+        second = scheduler.Scheduler(self.engine)
+        self.assertEqual(first.reserve(key, 10, lambda bind: 5), (6, 16))
+        self.assertEqual(second.reserve(key, 10, lambda bind: 5), (16, 26))
+        # records added by something else are skipped too
+        self.assertEqual(first.reserve(key, 10, lambda bind: 100), (101, 111))
+
+    def test_tables_are_left_to_setup(self):
+        engine = create_engine("sqlite://")
+        scheduler.Scheduler(engine)
+        self.assertEqual(engine.table_names(), [])
+
+    def test_slots_are_limited(self):
+        slots = [scheduler.take_slot(self.engine, 2) for _ in range(3)]
+        try:
+            self.assertEqual(slots[2], None)
+        finally:
+            for slot in slots[:2]:
+                slot.release()
+        slot = scheduler.take_slot(self.engine, 2)
+        self.assertNotEqual(slot, None)
+        slot.release()
+
+
+class JournalTest(TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        journal.setup(self.engine)
+
+    def commit_batch(self, log, rows):
+        for row in rows:
+            log.add(*row)
+        conn = self.engine.connect()
+        trans = conn.begin()
+        log.write(conn)
+        trans.commit()
+        conn.close()
+        log.committed()
+
+    def test_resume_skips_committed_rows(self):
+        log = journal.Journal.start(self.engine, "abc", "Collection")
+        self.commit_batch(log, [(1, "c000000001", "a"), (2, "c000000002", "b")])
+        # rows which never got committed aren't counted
+        log.add(3, "c000000003", "c")
+        resumed = journal.Journal.start(self.engine, "abc", "Collection", resume=True)
+        self.assertEqual(resumed.import_id, log.import_id)
+        self.assertEqual(resumed.done, set([1, 2]))
+        self.assertEqual(resumed.finished, None)
+        # another file, or starting over, gets a journal of its own
+        self.assertEqual(journal.Journal.start(self.engine, "def", "Collection",
+                resume=True).done, set())
+        self.assertNotEqual(journal.Journal.start(self.engine, "abc",
+                "Collection").import_id, log.import_id)
+
+    def test_finished_imports_are_noted(self):
+        log = journal.Journal.start(self.engine, "abc", "Repository")
+        self.commit_batch(log, [(1, "r000001GB", "a")])
+        log.finish(self.engine)
+        resumed = journal.Journal.start(self.engine, "abc", "Repository", resume=True)
+        self.assertNotEqual(resumed.finished, None)
+
+
+class JournalImportTest(StandinTestCase):
+    def test_checkpoints_commit_with_the_session(self):
+        importer = self.importer()
+        fd, path = tempfile.mkstemp(suffix=".xls")
+        os.write(fd, "sheet")
+        os.close(fd)
+        try:
+            importer.start_journal(path)
+            importer.journal.add(0, u"c000000001", u"a-slug")
+            importer.commit()
+            self.assertEqual(journal.Journal.committed_rows(self.engine,
+                    importer.journal.import_id), [0])
+            self.assertEqual(importer.journal.done, set([0]))
+        finally:
+            importer.session.close()
+            os.unlink(path)
+
+
+    def test_imports_are_only_journalled_if_asked(self):
+        fd, path = tempfile.mkstemp(suffix=".xls")
+        os.close(fd)
+        try:
+            benchmarks.generate(path, validators.Collection, 5, seed=2, bad_rate=0.0)
+            importer = self.importer()
+            importer.do(path)
+            self.assertEqual(importer.journal, None)
+            self.assertEqual(self.engine.execute(
+                    journal.IMPORTS.count()).scalar(), 0)
+        finally:
+            os.unlink(path)
+
+
+class ReferenceCacheTest(TestCase):
+    def setUp(self):
+        self.calls = []
+        class Record(object):
+            def __init__(self, id):
+                self.id = id
+        self.Record = Record
+        def query(session):
+            self.calls.append(session)
+            return Record(len(self.calls))
+        connections.QUERIES["test"] = query
+
+    def tearDown(self):
+        del connections.QUERIES["test"]
+
+    def test_loaded_once_per_engine(self):
+        refs = connections.ReferenceCache()
+        first, second = create_engine("sqlite://"), create_engine("sqlite://")
+        self.assertEqual(refs.load(first, "test"), (self.Record, 1))
+        self.assertEqual(refs.load(first, "test"), (self.Record, 1))
+        self.assertEqual(refs.load(second, "test"), (self.Record, 2))
+        refs.invalidate(first)
+        self.assertEqual(refs.load(first, "test"), (self.Record, 3))
+        self.assertEqual(refs.load(second, "test"), (self.Record, 2))
+
+
+class ImportStatsTest(TestCase):
+    class Importer(object):
+        def __init__(self, engine):
+            self.engine = engine
+            self.stats = stats.ImportStats()
+
+        @stats.call_site
+        def add_term(self):
+            self.engine.execute("select 1")
+            self.engine.execute("select 2")
+
+    def test_queries_counted_by_call_site(self):
+        engine = create_engine("sqlite://")
+        stats.instrument(engine)
+        importer = self.Importer(engine)
+        importer.stats.activate()
+        try:
+            importer.stats.enter("importing")
+            importer.add_term()
+            engine.execute("select 3")
+            importer.stats.enter(None)
+        finally:
+            importer.stats.deactivate()
+        engine.execute("select 4")
+        report = importer.stats.report()
+        self.assertEqual(report["total_queries"], 3)
+        self.assertEqual(report["queries"]["add_term"]["count"], 2)
+        self.assertEqual(report["queries"][stats.OTHER]["count"], 1)
+        self.assertTrue("importing" in report["phases"])
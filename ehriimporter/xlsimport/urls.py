@@ -11,6 +11,8 @@ urlpatterns = patterns('',
     url(r'^import/?$', views.importxls, name='xls_import'),
     url(r'^import/(?P<task_id>[a-z0-9-]+)/?$', 
             views.progress, name='xls_progress'),
+    url(r'^import/(?P<task_id>[a-z0-9-]+)/progress.json$',
+            views.progress_json, name='xls_progress_json'),
     url(r'^help/?$', views.help, name='xls_help'),
 )
 
@@ -2,30 +2,92 @@
 Common function and data for Qubit interoperability.
 """
 
+import re
 import string
 import random
+import threading
+import unicodedata
 from incf.countryutils import transformations, data as countrydata
 
 def get_country_from_code(code):
-    """Get the country code from a coutry name."""
-    try:
-        name = transformations.cc_to_cn(code)
-        return SUBNAMES.get(name, name)
-    except KeyError:
-        pass
+    """Get the country name from a country code."""
+    return COUNTRIES.name(code)
 
 def get_code_from_country(name):
     """Get the country code from a coutry name."""
-    revmap = dict((v, k) for k, v in SUBNAMES.iteritems())
-    ccn = countrydata.cn_to_ccn.get(revmap.get(name, name))
-    if ccn is None:
-        return # should raise an error with sheet context
-    return countrydata.ccn_to_cca2.get(ccn)
+    return COUNTRIES.code(name) # should raise an error with sheet context
+
+
+# characters random slugs are made of
+SLUG_CHARS = string.ascii_lowercase + string.digits
+
+
+def get_random_string(length, initials=SLUG_CHARS):
+    """Get a random string of SLUG_CHARS, starting with one of
+    `initials`."""
+    if length < 1:
+        return ''
+    return random.choice(initials) + ''.join(random.choice(SLUG_CHARS) \
+                for x in range(length - 1))
+
+
+class LRUCache(object):
+    """Dictionary-ish cache holding at most `maxsize` items, which
+    throws away the least recently used one when it's full.  Items
+    are kept in a circular doubly-linked list of [prev, next, key,
+    value] links, most recently used last.  Even reads rearrange
+    the list, so it's guarded by a lock for the threads of a
+    pipelined import, see `pipeline`."""
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.clear()
 
+    def __len__(self):
+        return len(self.links)
 
-def get_random_string(length):
-    return ''.join(random.choice(string.ascii_lowercase + string.digits) \
-                for x in range(6)) 
+    def __contains__(self, key):
+        return key in self.links
+
+    def clear(self):
+        with self.lock:
+            self.links = {}
+            self.root = root = []
+            root[:] = [root, root, None, None]
+
+    def _touch(self, link):
+        """Move a link to the end of the list."""
+        prev, next, _, _ = link
+        prev[1] = next
+        next[0] = prev
+        last = self.root[0]
+        last[1] = self.root[0] = link
+        link[0], link[1] = last, self.root
+
+    def get(self, key, default=None):
+        with self.lock:
+            link = self.links.get(key)
+            if link is None:
+                return default
+            self._touch(link)
+            return link[3]
+
+    def put(self, key, value):
+        with self.lock:
+            link = self.links.get(key)
+            if link is not None:
+                link[3] = value
+                self._touch(link)
+                return
+            if len(self.links) >= self.maxsize:
+                # drop the least recently used item
+                oldest = self.root[1]
+                del self.links[oldest[2]]
+                self.root[1] = oldest[1]
+                oldest[1][0] = self.root
+            last = self.root[0]
+            link = [last, self.root, key, value]
+            last[1] = self.root[0] = self.links[key] = link
 
 
 # Hacky dictionary of official country/languages names
@@ -39,3 +101,118 @@ SUBNAMES = {
 }
 
 
+# Other names people use for countries, mapped to their code
+ALIASES = {
+    "UK": "GB",
+    "Great Britain": "GB",
+    "Britain": "GB",
+    "USA": "US",
+    "United States": "US",
+    "United States of America": "US",
+    "Russia": "RU",
+    "Czech Republic": "CZ",
+    "Czechia": "CZ",
+    "Slovakia": "SK",
+    "Vatican": "VA",
+    "Holy See": "VA",
+    "Moldova": "MD",
+    "Macedonia": "MK",
+    "Ivory Coast": "CI",
+    "Cote d'Ivoire": "CI",
+    "Iran": "IR",
+    "Syria": "SY",
+    "South Korea": "KR",
+    "North Korea": "KP",
+    "Vietnam": "VN",
+    "Laos": "LA",
+    "Bolivia": "BO",
+    "Venezuela": "VE",
+    "Tanzania": "TZ",
+    "Burma": "MM",
+}
+
+COUNTRY_STRIP_RE = re.compile(u"['`\u2018\u2019]")
+COUNTRY_SPACE_RE = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def normalize_country(name):
+    """Fold case, accents, apostrophes and punctuation out of a
+    country name, so different spellings of "Cote d'Ivoire" all
+    look the same."""
+    if not isinstance(name, unicode):
+        name = str(name).decode("utf-8")
+    name = unicodedata.normalize("NFKD", name)
+    name = u"".join(c for c in name if not unicodedata.combining(c))
+    name = COUNTRY_STRIP_RE.sub(u"", name.lower().replace(u"&", u" and "))
+    return COUNTRY_SPACE_RE.sub(u" ", name).strip()
+
+
+class CountryIndex(object):
+    """Country codes keyed on normalized name, covering the names
+    from incf.countryutils, our friendlier SUBNAMES and ALIASES,
+    plus a reverse index of the name we display for each code."""
+    def __init__(self):
+        self.codes = {}
+        self.names = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def add(self, name, code):
+        """Add a name for a country code, without replacing one
+        that's already there."""
+        self.codes.setdefault(normalize_country(name), code)
+
+    def load_data(self):
+        """Index the country names from incf.countryutils."""
+        for name, ccn in countrydata.cn_to_ccn.iteritems():
+            code = countrydata.ccn_to_cca2.get(ccn)
+            if code is not None:
+                self.add(name, code)
+        for name, subname in SUBNAMES.iteritems():
+            code = self.code(name)
+            if code is not None:
+                self.add(subname, code)
+        for name, code in ALIASES.iteritems():
+            self.add(name, code)
+        for code in set(self.codes.itervalues()):
+            try:
+                name = transformations.cc_to_cn(code)
+            except KeyError:
+                continue
+            self.names[code] = SUBNAMES.get(name, name)
+
+    def load_aliases(self, path):
+        """Add aliases from a UTF-8 file of "name = code" lines,
+        ignoring blank lines and # comments."""
+        with open(path) as fp:
+            for line in fp:
+                line = line.decode("utf-8").split("#", 1)[0].strip()
+                if line:
+                    name, code = line.rsplit("=", 1)
+                    self.add(name, code.strip().upper())
+
+    def code(self, name):
+        """Get the code for a country name, or None."""
+        return self.codes.get(normalize_country(name))
+
+    def name(self, code):
+        """Get the display name for a country code, or None."""
+        if code:
+            return self.names.get(code.upper())
+
+
+def alias_files():
+    """Extra country alias files listed in the Django settings, if
+    there are any."""
+    try:
+        from django.conf import settings
+        return getattr(settings, "IMPORTER_COUNTRY_ALIASES", [])
+    except ImportError:
+        return []
+
+
+COUNTRIES = CountryIndex()
+COUNTRIES.load_data()
+for path in alias_files():
+    COUNTRIES.load_aliases(path)
@@ -2,16 +2,15 @@
 
 import os
 import re
+import hashlib
 import datetime
 import logging as LOG
 from ordereddict import OrderedDict
-from dateutil import parser
 
 import phpserialize
-import xlrd
 import yaml
 
-from xlsimport import utils
+from xlsimport import cells, dates, readers, utils
 
 
 class XLSError(Exception):
@@ -27,8 +26,38 @@ ERROR_CODES = {
 }
 
 
-def split_multiple(multistr, sep=",,"):
-    return [s for s in unicode(multistr).rsplit(sep) if s.strip()]
+ROW_ERRORS = {
+        "required": "Missing value on required column: %s",
+        "too_long": "Field over 255 characters: '%s'",
+        "multiple": "Double-comma separator in a strictly single-value field: '%s'",
+        "over_limit": "Multiple-value field exceeds value limit: '%s' (limit %d)",
+        "no_comma": "No 'comma' delimiting surname/given name in person name field '%s': '%s'",
+        "many_commas": "Multiple 'commas' in name field '%s': '%s'",
+        "bad_choice": "Invalid value for field '%s': '%s'. Must be one of: %s",
+        "bad_date": "Bad date string in field: '%s': %s",
+}
+
+
+split_multiple = cells.split_multiple
+
+
+def person_name_error(field, item):
+    """Get the error for a value in a person name field, if
+    it has one."""
+    if item.startswith("[org] "):
+        return
+    if item.count(",") < 1:
+        return ROW_ERRORS["no_comma"] % (field, item)
+    elif item.count(",") > 1:
+        return ROW_ERRORS["many_commas"] % (field, item)
+
+
+def date_error(field, datestr):
+    """Get the error for a value in a date field, if it has one."""
+    try:
+        dates.parse(datestr)
+    except ValueError:
+        return ROW_ERRORS["bad_date"] % (dates.clean(datestr), field)
 
 
 class XLSField(object):
@@ -57,12 +86,18 @@ class XLSField(object):
 class XLSSheetDefinition(object):
     def __init__(self, heading_row=0, fields=None):
         self.heading_row = heading_row
-        self.fields = fields if fields is not None else []
+        self.fields = fields if fields is not None else OrderedDict()
+        # hash of the definitions file, to tell versions apart
+        self.digest = None
+        self.plan = None
 
     def load_yaml(self, filepath):
         self.fields = OrderedDict()
+        self.plan = None
         with open(filepath, "r") as fp:
-            data = yaml.load(fp)
+            text = fp.read()
+            self.digest = hashlib.sha256(text).hexdigest()
+            data = yaml.load(text)
             self.heading_row = data.get("heading_row", self.heading_row)
             for fielddef in data.get("fields", []):
                 for name, fdef in fielddef.iteritems():
@@ -99,21 +134,102 @@ class XLSSheetDefinition(object):
     def choices(self):
         return [f for f in self.fields.values() if f.choices is not None]
 
+    def compile(self):
+        """Get the validation plan for these definitions, building
+        it the first time it's needed."""
+        if self.plan is None:
+            self.plan = ValidationPlan(self)
+        return self.plan
+
+
+class ValidationPlan(object):
+    """Everything the validator needs to know about a sheet
+    definition, worked out once up-front rather than by scanning
+    the field list on every row: column names and indices, sets
+    for membership tests and the checks each row needs.  Treat it
+    as read-only; it's shared by every validator using the same
+    definitions."""
+    __slots__ = ("headings", "index", "uniques", "multiples", "multiple_set",
+            "singles", "required", "dates", "chars", "contacts",
+            "personnames", "i18n", "i18n_set", "limited", "limits",
+            "choices", "checks")
+
+    # row checks in the order they're run, with the attribute
+    # holding the columns each applies to
+    ROW_CHECKS = (
+        ("check_multiples", "singles"),
+        ("check_limited", "limits"),
+        ("check_person_names", "personnames"),
+        ("check_dates", "dates"),
+        ("check_charfield_length", "chars"),
+        ("check_choices", "choices"),
+    )
+
+    def __init__(self, fielddef):
+        fields = fielddef.fields.values()
+        self.headings = tuple(fielddef.names())
+        self.index = dict((name, i) for i, name in enumerate(self.headings))
+        self.uniques = tuple(f.name for f in fielddef.unique())
+        self.multiples = tuple(f.name for f in fielddef.multiple())
+        self.multiple_set = frozenset(self.multiples)
+        self.singles = tuple(n for n in self.headings if n not in self.multiple_set)
+        self.required = tuple(f.name for f in fielddef.required())
+        self.dates = tuple(f.name for f in fielddef.date())
+        self.chars = tuple(f.name for f in fielddef.oftype("char"))
+        self.contacts = tuple(f.name for f in fielddef.oftype("contact"))
+        self.personnames = tuple(f.name for f in fielddef.oftype("personname"))
+        self.i18n = tuple(f.name for f in fielddef.i18n())
+        self.i18n_set = frozenset(self.i18n)
+        self.limited = tuple(f.name for f in fielddef.limited())
+        # only multiple-value fields have their limit checked
+        self.limits = tuple((f.name, f.limit) for f in fields \
+                if f.multiple and f.limit)
+        # (name, set of choices, choices as listed in error messages)
+        self.choices = tuple((f.name, frozenset(f.choices),
+                    ", ".join(["'%s'" % c for c in f.choices])) \
+                for f in fielddef.choices())
+        self.checks = tuple(check for check, attr in self.ROW_CHECKS \
+                if getattr(self, attr))
+
+
+# loaded definitions, keyed on file name
+DEFINITIONS = {}
+
+
+def load_definitions(name):
+    """Get the sheet definitions in a file in the definitions
+    directory, loading and caching them the first time."""
+    fielddef = DEFINITIONS.get(name)
+    if fielddef is None:
+        fielddef = XLSSheetDefinition()
+        fielddef.load_yaml(os.path.abspath(
+                os.path.join(os.path.dirname(__file__), "definitions", name)))
+        DEFINITIONS[name] = fielddef
+    return fielddef
+
 
 class XLSValidator(object):
+    # names of checks to run on each row after the plan's own
+    EXTRA_CHECKS = ()
+
     def __init__(self, definitions=None, raise_err=False):
-        self.workbook = None
-        self.sheet = None
+        self.source = None
+        self.nrows = None
+        # parsed rows, kept if asked for during validation
+        self.rows = None
         self.fielddef = XLSSheetDefinition()
         if definitions is not None:
-            defpath = os.path.abspath(
-                    os.path.join(
-                        os.path.dirname(__file__),                        
-                        "definitions", definitions))
-            self.fielddef.load_yaml(defpath)
-        
+            self.fielddef = load_definitions(definitions)
+
         self.raise_err = raise_err
         self.errors = []
+        # the plan's row checks, bound to this validator
+        self.row_checks = [getattr(self, check) for check in \
+                self.plan.checks + tuple(self.EXTRA_CHECKS)]
+        # values seen so far in unique columns -> row numbers
+        self.seen = {}
+        # required columns -> row numbers they're blank on
+        self.missing = {}
 
     @property
     def HEADING_ROW(self):
@@ -123,55 +239,93 @@ class XLSValidator(object):
     def HEADINGS(self):
         return self.fielddef.names()
 
+    @property
+    def plan(self):
+        return self.fielddef.compile()
+
     @property
     def UNIQUES(self):
-        return [f.name for f in self.fielddef.unique()]
+        return list(self.plan.uniques)
 
     @property
     def MULTIPLES(self):
-        return [f.name for f in self.fielddef.multiple()]
+        return list(self.plan.multiples)
 
     @property
     def REQUIRED(self):
-        return [f.name for f in self.fielddef.required()]
+        return list(self.plan.required)
 
     @property
     def DATES(self):
-        return [f.name for f in self.fielddef.date()]
+        return list(self.plan.dates)
 
     @property
     def CHARS(self):
-        return [f.name for f in self.fielddef.oftype("char")]
+        return list(self.plan.chars)
 
     @property
     def CONTACTS(self):
-        return [f.name for f in self.fielddef.oftype("contact")]
+        return list(self.plan.contacts)
 
     @property
     def PERSONNAMES(self):
-        return [f.name for f in self.fielddef.oftype("personname")]
+        return list(self.plan.personnames)
 
     @property
     def I18N(self):
-        return [f.name for f in self.fielddef.i18n()]
+        return list(self.plan.i18n)
 
     @property
     def LIMITED(self):
-        return [f.name for f in self.fielddef.limited()]
+        return list(self.plan.limited)
 
     @property
     def CHOICES(self):
-        return [f.name for f in self.fielddef.choices()]
+        return [name for name, _, _ in self.plan.choices]
 
     def open_xls(self, xlsfile):
-        self.workbook = xlrd.open_workbook(xlsfile, formatting_info=True)
+        self.close_xls()
         try:
-            self.sheet = self.workbook.sheet_by_index(0)
-        except IOError:
+            self.source = readers.open_rows(xlsfile)
+        except readers.ReaderError:
             self.add_error(None, ERROR_CODES["bad_xls"], fatal=True)
-        except IndexError:
+        if self.source.row(self.HEADING_ROW) is None:
             self.add_error(None, ERROR_CODES["worksheet_not_found"], fatal=True)
 
+    def close_xls(self):
+        """Release the workbook, if one is open."""
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+
+    def load_rows(self, rows):
+        """Use rows spooled by an earlier validation, given the
+        spool's path, or a list of (rownum, rowdata) pairs."""
+        self.discard_rows()
+        if isinstance(rows, basestring):
+            self.rows = readers.RowSpool(rows)
+        else:
+            self.rows = readers.RowList(rows)
+
+    def discard_rows(self):
+        """Throw away any kept rows."""
+        if self.rows is not None:
+            self.rows.discard()
+            self.rows = None
+
+    def iter_rows(self):
+        """Yield the row number and a Row of the data for
+        each row below the headings, from the rows kept during
+        validation if there are any, otherwise reading them
+        lazily from the workbook."""
+        if self.rows is not None and self.rows.complete:
+            for rownum, rowdata in self.rows:
+                yield rownum, rowdata
+            return
+        headings = self.plan.headings
+        for rownum, data in self.source.rows(self.HEADING_ROW+1, len(headings)):
+            yield rownum, cells.Row(headings, data)
+
     def is_valid(self):
         return len(self.errors) > 0
 
@@ -202,20 +356,23 @@ class XLSValidator(object):
                 LOG.error(fullmsg)
 
     def add_error(self, row, msg, warn=False, fatal=False):
-        fullmsg = "row %d: %s" % (row+1, msg)
+        fullmsg = msg if row is None else "row %d: %s" % (row+1, msg)
         self.errors.append((row, msg, warn))
         if fatal or (self.raise_err and not warn):
             raise XLSError(fullmsg)
 
     def num_rows(self):
-        if self.sheet is None:
+        if self.nrows is not None:
+            return self.nrows
+        if self.rows is not None and self.rows.complete:
+            return len(self.rows)
+        if self.source is None or self.source.nrows is None:
             return -1
-        return self.sheet.nrows - (self.HEADING_ROW + 1)
+        return self.source.nrows - (self.HEADING_ROW + 1)
 
     def validate_headers(self):
         """Check header match watch we're expecting."""
-        numheads = len(self.HEADINGS)
-        heads = [h.value for h in self.sheet.row_slice(self.HEADING_ROW, 0, numheads)]
+        heads = self.source.row(self.HEADING_ROW, len(self.HEADINGS))
         diffs = set(heads).difference(self.HEADINGS)
         err = ERROR_CODES["unexpected_heading"]
         if diffs:
@@ -229,138 +386,141 @@ class XLSValidator(object):
                 self.add_error(self.HEADING_ROW, "%s: %s" % (err, diff))
             raise XLSError(err)
 
-    def validate(self, xlspath):
-        """Check everything is A-Okay with the XLS data."""
+    def validate(self, xlspath, keep_rows=False):
+        """Check everything is A-Okay with the XLS data.  If
+        `keep_rows` is set the parsed rows are spooled to disk so
+        they can be imported without reading the workbook again."""
+        self.discard_rows()
         # These actions will stop any further validation
         # if they error
-        self.open_xls(xlspath)
         try:
+            self.open_xls(xlspath)
             self.validate_headers()
         except XLSError:
+            self.close_xls()
             return
+        if keep_rows:
+            self.rows = readers.RowSpool()
+        try:
+            self.check_rows(self.iter_rows(), spool=self.rows)
+        finally:
+            self.close_xls()
+            if keep_rows:
+                self.rows.close()
+
+    def check_rows(self, rows, spool=None):
+        """Validate (rownum, rowdata) pairs, adding them to a row
+        spool as we go if given one.  Errors on unique and required
+        columns come first, column by column, then those found in
+        each row."""
+        self.seen = dict((name, OrderedDict()) for name in self.plan.uniques)
+        self.missing = dict((name, []) for name in self.plan.required)
+        self.nrows = 0
+        start = len(self.errors)
+        for rownum, rowdata in rows:
+            self.nrows += 1
+            self.track_unique_values(rownum, rowdata)
+            self.track_missing_values(rownum, rowdata)
+            self.validate_row(rownum, rowdata)
+            if spool is not None:
+                spool.append(rownum, rowdata)
+        row_errors = self.errors[start:]
+        del self.errors[start:]
         self.check_unique_columns()
         self.check_required_columns()
-        for row in range(self.HEADING_ROW+1, self.sheet.nrows):
-            data = [d.value for d in self.sheet.row_slice(row, 0, len(self.HEADINGS))]
-            self.validate_row(row, OrderedDict(zip(self.HEADINGS, data)))
+        self.errors.extend(row_errors)
 
     def validate_row(self, rownum, rowdata):
-        """Check a single row of data."""
-        self.check_multiples(rownum, rowdata)
-        self.check_limited(rownum, rowdata)
-        self.check_person_names(rownum, rowdata)
-        self.check_dates(rownum, rowdata)
-        self.check_charfield_length(rownum, rowdata)
-        self.check_choices(rownum, rowdata)
+        """Check a single row of data, running each of the checks
+        the plan says are needed."""
+        for check in self.row_checks:
+            check(rownum, rowdata)
+
+    def track_missing_values(self, rownum, rowdata):
+        """Note which rows have blanks in required columns."""
+        for colhead, datarows in self.missing.iteritems():
+            if rowdata.cell(colhead).blank:
+                datarows.append(rownum)
 
     def check_required_columns(self):
         """Make sure there are no blanks where there shouldn't
         be."""
-        for colhead in self.REQUIRED:
-            col = self.HEADINGS.index(colhead)
-            rowsdata = [(i + self.HEADING_ROW, c.value) for i, c in \
-                    enumerate(self.sheet.col_slice(
-                        col, self.HEADING_ROW, self.sheet.nrows))]
-            for i, data in rowsdata:
-                if data is None or unicode(data).strip() == "":
-                    self.add_error(i, "Missing value on required column: %s" % (
-                        colhead))
+        for colhead in self.plan.required:
+            for rownum in self.missing.get(colhead, []):
+                self.add_error(rownum, ROW_ERRORS["required"] % colhead)
+
+    def track_unique_values(self, rownum, rowdata):
+        """Note which rows the values in unique columns are found
+        on, so duplicates can be reported once all the rows have
+        been seen."""
+        for colhead, datarows in self.seen.iteritems():
+            key = rowdata[colhead]
+            # don't count empty fields
+            if key is None or key == "":
+                continue
+            datarows.setdefault(key, []).append(rownum)
 
     def check_unique_columns(self):
         """Check columns which should contain unique values
         actually do."""
-        for colhead in self.UNIQUES:
-            col = self.HEADINGS.index(colhead)
-            rowsdata = [(i + self.HEADING_ROW, c.value) for i, c in \
-                    enumerate(self.sheet.col_slice(
-                        col, self.HEADING_ROW, self.sheet.nrows))]
-            datarows = OrderedDict()
-            for i, key in rowsdata:
-                item = datarows.get(key)
-                # don't count empty fields
-                if key is None or key == "":
-                    continue
-                if item is None:
-                    datarows[key] = [i]
-                else:
-                    datarows[key].append(i)
-            for key, rows in datarows.iteritems():
+        for colhead in self.plan.uniques:
+            for key, rows in self.seen.get(colhead, {}).iteritems():
                 if len(rows) > 1:
-                    header = self.sheet.cell(self.HEADING_ROW, col).value
                     self.add_error(
                             rows[0], "Duplicate on unique column: %s: '%s' %s" % (
-                                header, key, [r+1 for r in rows[1:]]))
+                                colhead, key, [r+1 for r in rows[1:]]))
 
     def check_charfield_length(self, rownum, rowdata):
         """Check char fields aren't longer than 255 chars."""
-        for field in self.CHARS:
+        for field in self.plan.chars:
             # just pretend everything's a multi-value
-            for item in split_multiple(rowdata.get(field, "")):
+            for item in rowdata.split(field):
                 if len(item) > MAX_CHARFIELD_LENGTH:
-                    self.add_error(rownum, "Field over 255 characters: '%s'" % field)
+                    self.add_error(rownum, ROW_ERRORS["too_long"] % field)
 
     def check_multiples(self, rownum, rowdata):
         """Check fields that only allow single entries don't
         contain multiple ones."""
-        for i, (key, val) in enumerate(rowdata.iteritems()):
-            if len(split_multiple(unicode(val))) > 1 and key not in self.MULTIPLES:
-                self.add_error(rownum, 
-                        "Double-comma separator in a strictly single-value field: '%s'" % key)
+        for key in self.plan.singles:
+            if rowdata.cell(key).multiple:
+                self.add_error(rownum, ROW_ERRORS["multiple"] % key)
 
     def check_limited(self, rownum, rowdata):
         """Check multiple entries with a limit don't exceed
         that limit."""
-        for field in self.MULTIPLES:
-            if field in self.LIMITED:
-                fmax = self.fielddef.fields[field].limit
-                if len(split_multiple(rowdata[field])) > fmax:
-                    self.add_error(rownum,
-                            "Multiple-value field exceeds value limit: '%s' (limit %d)" % (
-                                field, fmax))
+        for field, fmax in self.plan.limits:
+            if len(rowdata.split(field)) > fmax:
+                self.add_error(rownum, ROW_ERRORS["over_limit"] % (field, fmax))
 
     def check_person_names(self, rownum, rowdata):
-        for field in self.PERSONNAMES:
-            for item in split_multiple(rowdata.get(field, "")):
-                if item.startswith("[org] "):
-                    continue
-                if item.count(",") < 1:
-                    self.add_error(rownum, "No 'comma' delimiting surname/given name in person name field '%s': '%s'" %
-                            (field, item))
-                elif item.count(",") > 1:
-                    self.add_error(rownum, "Multiple 'commas' in name field '%s': '%s'" % (field, item))
+        for field in self.plan.personnames:
+            for item in rowdata.split(field):
+                err = person_name_error(field, item)
+                if err:
+                    self.add_error(rownum, err)
 
     def check_choices(self, rownum, rowdata):
         """Check fields that must contain choices are limited to
         the appropriate values."""
-        for fieldobj in self.fielddef.choices():
-            name = fieldobj.name
-            choices = fieldobj.choices
+        for name, choices, choicestr in self.plan.choices:
             if rowdata[name] not in choices:
-                self.add_error(rownum,
-                        "Invalid value for field '%s': '%s'. Must be one of: %s" % (
-                            name, rowdata[name], ", ".join(["'%s'" % s for s in choices])))
-
+                self.add_error(rownum, ROW_ERRORS["bad_choice"] % (
+                            name, rowdata[name], choicestr))
 
     def check_dates(self, rownum, rowdata):
         """Check dates are in YYYY-MM-DD format.  A preceding 'c' for
         'circa' is allowed to indicate inexactness."""
-        for field in self.DATES:
-            for datestr in split_multiple(rowdata[field]):
-                if datestr.startswith("c"):
-                    datestr = datestr[1:]
-                # hack! to rid int dates of coerced float points
-                if datestr.endswith(".0"):
-                    datestr = datestr[:-2]
-                try:
-                    parser.parse(datestr, yearfirst=True)
-                except ValueError:
-                    self.add_error(rownum, "Bad date string in field: '%s': %s" % (
-                            datestr, field))
+        for field in self.plan.dates:
+            for datestr in rowdata.split(field):
+                err = date_error(field, datestr)
+                if err:
+                    self.add_error(rownum, err)
 
 
 class Repository(XLSValidator):
     """Validator for Repository import."""
     name = "Repositories"
+    EXTRA_CHECKS = ("check_countrycode",)
 
     def __init__(self, *args, **kwargs):
         kwargs["definitions"] = kwargs.get("definitions", "repositories.yaml")
@@ -368,16 +528,11 @@ class Repository(XLSValidator):
 
     def check_countrycode(self, rownum, rowdata):
         """Check we can lookup the country code."""
-        code = utils.get_code_from_country(rowdata["country"].strip())
+        code = utils.get_code_from_country(rowdata.text("country").strip())
         if code is None:
             self.add_error(rownum, "Unable to find 2-letter country code at row: '%s'" % (
                 rowdata["country"],))
 
-    def validate_row(self, rownum, rowdata):
-        """Check a single row of data."""
-        super(Repository, self).validate_row(rownum, rowdata)
-        self.check_countrycode(rownum, rowdata)
-
 
 class Collection(XLSValidator):
     """Validator for Collection import."""    
@@ -387,11 +542,6 @@ class Collection(XLSValidator):
         kwargs["definitions"] = kwargs.get("definitions", "collections.yaml")
         super(Collection, self).__init__(*args, **kwargs)
 
-    def validate_row(self, rownum, rowdata):
-        """Check a single row of data."""
-        super(Collection, self).validate_row(rownum, rowdata)
-
-
 
 VALIDATORS = [Repository, Collection]
 
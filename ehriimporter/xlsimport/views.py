@@ -1,13 +1,24 @@
 """XLS Import/validate views."""
 
 import os
+import json
+import time
+import hashlib
 import tempfile
 
+from django.conf import settings
+from django.core.cache import cache as state_cache
+from django.http import HttpResponse, HttpResponseNotModified
 from django.shortcuts import render, redirect
 
-from celery import result
+from xlsimport import cache, forms, tasks, validators, importers
 
-from xlsimport import forms, tasks, validators, importers
+# how long a task's state is cached for pollers to share, and how
+# long finished tasks' states, which won't change, are kept
+PROGRESS_TTL = getattr(settings, "IMPORTER_PROGRESS_TTL", 1)
+FINISHED_TTL = 300
+# max seconds a long-poll request waits for progress to change
+LONGPOLL_TIMEOUT = getattr(settings, "IMPORTER_LONGPOLL_TIMEOUT", 20)
 
 
 def save_to_temp(f):
@@ -35,7 +46,8 @@ def validate(request):
             name = request.FILES["xlsfile"].name
             temppath = save_to_temp(request.FILES["xlsfile"])
             validator = getattr(validators, form.cleaned_data["xlstype"])()
-            validator.validate(temppath)
+            # only checking, so there's no need to spool the rows
+            cache.validate(validator, temppath, keep_rows=False)
             os.unlink(temppath)
             context.update(errors=validator.errors, validator=validator)
     context.update(form=form)
@@ -53,34 +65,93 @@ def importxls(request):
             name = request.FILES["xlsfile"].name
             temppath = save_to_temp(request.FILES["xlsfile"])
             validator = getattr(validators, form.cleaned_data["xlstype"])()
-            validator.validate(temppath)
+            cache.validate(validator, temppath)
             # bail out if we get an error
             if validator.errors:
                 context.update(errors=validator.errors, validator=validator)
                 os.unlink(temppath)
                 return render(request, template, context)
-            async = tasks.ImportXLSTask.delay(validator.__class__.__name__, temppath)
+            # the task imports the rows we've just validated rather
+            # than parsing the file all over again
+            async = tasks.ImportXLSTask.delay(validator.__class__.__name__, temppath,
+                    rowsfile=validator.rows.path)
             return redirect("xls_progress", task_id=async.task_id)
     context.update(form=form)
     return render(request, template, context)
 
 
+def percent_done(status, info):
+    """Work out how far through an import is."""
+    if status == "PROGRESS" and info["total"] > 0:
+        return round(float(info["current"]) / float(info["total"]) * 100)
+    return 100 if status == "SUCCESS" else 0
+
+
+def timing(info, now):
+    """Fill in how long a fanned-out import has been going, and how
+    fast, from when it started.  These are left out of its progress
+    JSON, which would otherwise change on every poll."""
+    if info is not None and "started" in info:
+        elapsed = now - info["started"]
+        rate = info["current"] / elapsed \
+                if info["current"] and elapsed > 0 else None
+        info = dict(info, elapsed=elapsed, rate=rate,
+                eta=max(info["total"] - info["current"], 0) / rate if rate else None)
+    return info
+
+
 def progress(request, task_id):
     """Show progress for a running import."""
     template = "xlsimport/progress.html" if not request.is_ajax() \
             else "xlsimport/_progress.html"
-    async = result.AsyncResult(task_id)
+    async = tasks.ImportResult(task_id)
     context = dict(async=async)
-    progress = 0
-    if async.status == "PROGRESS":
-        info = async.info
-        progress = round(float(info["current"]) / float(info["total"]) * 100)
-    elif async.successful():
-        progress = 100
-    context.update(progress=progress)
+    info = async.info if async.status == "PROGRESS" else None
+    context.update(info=timing(info, time.time()),
+            progress=percent_done(async.status, info))
     return render(request, template, context)
 
 
+def task_state(task_id):
+    """Get the state of a task as JSON-able data, along with an
+    ETag for it.  States are cached for a second or so, so however
+    many people are watching an import the result backend is only
+    asked about it once in a while."""
+    key = "xlsimport-progress-%s" % task_id
+    state = state_cache.get(key)
+    if state is None:
+        async = tasks.ImportResult(task_id)
+        info = async.info if async.status == "PROGRESS" else None
+        data = dict(state=async.status, info=info,
+                progress=percent_done(async.status, info),
+                finished=async.ready())
+        body = json.dumps(data, sort_keys=True)
+        state = (body, '"%s"' % hashlib.md5(body).hexdigest(), data["finished"])
+        state_cache.set(key, state, FINISHED_TTL if data["finished"] else PROGRESS_TTL)
+    return state
+
+
+def progress_json(request, task_id):
+    """Progress for a running import as JSON.  Responds with a 304
+    if it hasn't changed since the ETag in If-None-Match, or, when
+    given a `wait` parameter, holds on to the request until it has
+    changed or LONGPOLL_TIMEOUT seconds have passed."""
+    etag = request.META.get("HTTP_IF_NONE_MATCH")
+    body, newtag, finished = task_state(task_id)
+    if request.GET.get("wait") and etag is not None:
+        deadline = time.time() + LONGPOLL_TIMEOUT
+        while newtag == etag and not finished and time.time() < deadline:
+            time.sleep(PROGRESS_TTL)
+            body, newtag, finished = task_state(task_id)
+    if newtag == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type="application/json")
+    response["ETag"] = newtag
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
 def help(request):
     """Show help about import spreadsheet format."""
     template = "xlsimport/help.html"
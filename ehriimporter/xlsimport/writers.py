@@ -0,0 +1,233 @@
+"""Ways of writing the leaf records which hang off imported
+objects: notes, other names, properties, slugs, statuses and
+term relations.  The importer builds the object hierarchy itself
+and hands these off to a writer."""
+
+import datetime
+import threading
+
+import phpserialize
+from sqlalchemy import bindparam, text
+from sqlalchemy.orm import class_mapper
+from sqlaqubit import models
+
+from xlsimport import registry
+
+# most bound parameters in one statement, which SQLite limits
+MAX_PARAMS = 999
+# engine -> whether a multi-row INSERT gets consecutive ids
+CONSECUTIVE = {}
+LOCK = threading.Lock()
+
+
+def table_row(model, **values):
+    """Translate mapped attribute values for a model into a dict
+    keyed on column, suitable for a Core insert."""
+    mapper = class_mapper(model)
+    return dict((mapper.get_property(key).columns[0].key, value) \
+            for key, value in values.iteritems())
+
+
+def consecutive_ids(connection):
+    """Whether the rows of a multi-row INSERT are given consecutive
+    autoincrement ids, so they can be worked out from the first or
+    last.  SQLite always does; MySQL does unless InnoDB is set to
+    interleave ids between concurrent inserts."""
+    engine = connection.engine
+    with LOCK:
+        if engine not in CONSECUTIVE:
+            name = engine.dialect.name
+            if name == "mysql":
+                mode = connection.execute(
+                        text("SELECT @@innodb_autoinc_lock_mode")).scalar()
+                CONSECUTIVE[engine] = int(mode) != 2
+            else:
+                CONSECUTIVE[engine] = name == "sqlite"
+        return CONSECUTIVE[engine]
+
+
+def insert_rows(connection, table, rows):
+    """Insert rows, i.e. dicts with the same keys, into a table with
+    an autoincrement id and return their ids, in order.  Where ids
+    are consecutive they go in as few multi-row INSERTs as we can,
+    each one's ids following on from the first, which MySQL's
+    LAST_INSERT_ID() gives, or back from the last, which SQLite's
+    last_insert_rowid() does.  Otherwise they go a row at a time."""
+    if not rows:
+        return []
+    if not consecutive_ids(connection):
+        return [connection.execute(table.insert(), row).inserted_primary_key[0] \
+                for row in rows]
+    preparer = connection.dialect.identifier_preparer
+    columns = sorted(rows[0])
+    ids = []
+    for chunk in registry.chunked(rows, min(registry.CHUNK_SIZE,
+                MAX_PARAMS // len(columns))):
+        params = []
+        values = []
+        for i, row in enumerate(chunk):
+            names = ["p%d_%d" % (i, j) for j in range(len(columns))]
+            params.extend(bindparam(name, row[column], type_=table.c[column].type) \
+                    for name, column in zip(names, columns))
+            values.append("(%s)" % ", ".join(":" + name for name in names))
+        result = connection.execute(text("INSERT INTO %s (%s) VALUES %s" % (
+                preparer.format_table(table),
+                ", ".join(preparer.format_column(table.c[column]) \
+                    for column in columns),
+                ", ".join(values)), bindparams=params))
+        if result.rowcount != len(chunk):
+            raise ValueError("Inserted %d rows into %s, expected %d" % (
+                    result.rowcount, table.name, len(chunk)))
+        if connection.engine.dialect.name == "mysql":
+            first = connection.execute(text("SELECT LAST_INSERT_ID()")).scalar()
+        else:
+            first = connection.execute(
+                    text("SELECT last_insert_rowid()")).scalar() - len(chunk) + 1
+        ids.extend(range(first, first + len(chunk)))
+    return ids
+
+
+class ORMWriter(object):
+    """Write leaf records through the ORM, as relationship
+    appends on the parent object."""
+    def __init__(self, session):
+        self.session = session
+
+    def note(self, item, typeid, scope, text, user, lang="en"):
+        note = models.Note(
+                object_id=item.id,
+                type_id=typeid,
+                user=user,
+                source_culture=lang,
+                scope=scope
+        )
+        item.notes.append(note)
+        note.set_i18n(dict(content=text), lang)
+
+    def other_name(self, item, typeid, name, lang="en"):
+        othername = models.OtherName(
+                object_id=item.id,
+                type_id=typeid,
+                source_culture=lang
+        )
+        item.other_names.append(othername)
+        othername.set_i18n(dict(
+            name=name
+        ), lang)
+
+    def property(self, item, name, value, lang="en"):
+        prop = models.Property(name=name, source_culture=lang)
+        item.properties.append(prop)
+        prop.set_i18n(dict(value=phpserialize.dumps(value)), lang)
+
+    def slug(self, item, slug):
+        item.slug.append(models.Slug(slug=slug))
+
+    def status(self, item, typeid, statusid):
+        status = models.Status(object=item,
+                type_id=typeid, status_id=statusid)
+        self.session.add(status)
+
+    def term_relation(self, item, term):
+        relation = models.ObjectTermRelation(
+                object=item, term=term)
+        self.session.add(relation)
+
+    def flush(self, connection):
+        """Nothing to do, the session flush takes care of it."""
+        pass
+
+
+class CoreWriter(ORMWriter):
+    """Buffer leaf records in memory and write them with Core
+    inserts once the session has been flushed and their parent
+    ids are known.  Records with an i18n table, and the object
+    rows of term relations, need their own autoincrement ids, so
+    those go in by `insert_rows`, and their i18n rows, along with
+    everything else, are sent as a single executemany per table."""
+    def __init__(self, session):
+        super(CoreWriter, self).__init__(session)
+        self.clear()
+
+    def clear(self):
+        # (model, i18n model, parent, values, i18n values)
+        self.i18n_rows = []
+        # (model, parent, values)
+        self.rows = []
+        # (object, term)
+        self.relations = []
+
+    def note(self, item, typeid, scope, text, user, lang="en"):
+        self.i18n_rows.append((models.Note, models.NoteI18N, item,
+                dict(type_id=typeid, user_id=user.id, source_culture=lang, scope=scope),
+                dict(content=text, culture=lang)))
+
+    def other_name(self, item, typeid, name, lang="en"):
+        self.i18n_rows.append((models.OtherName, models.OtherNameI18N, item,
+                dict(type_id=typeid, source_culture=lang),
+                dict(name=name, culture=lang)))
+
+    def property(self, item, name, value, lang="en"):
+        self.i18n_rows.append((models.Property, models.PropertyI18N, item,
+                dict(name=name, source_culture=lang),
+                dict(value=phpserialize.dumps(value), culture=lang)))
+
+    def slug(self, item, slug):
+        self.rows.append((models.Slug, item, dict(slug=slug)))
+
+    def status(self, item, typeid, statusid):
+        self.rows.append((models.Status, item,
+                dict(type_id=typeid, status_id=statusid)))
+
+    def term_relation(self, item, term):
+        self.relations.append((item, term))
+
+    def _executemany(self, connection, pending):
+        """Insert rows grouped by model, one statement per table."""
+        for model, rows in pending.iteritems():
+            if rows:
+                table = class_mapper(model).local_table
+                connection.execute(table.insert(), rows)
+
+    def flush(self, connection):
+        """Write all the buffered records.  The session must have
+        been flushed first so parent objects have ids."""
+        pending = {}
+        # model -> [(i18n model, parent row, i18n values)]
+        parents = {}
+        for model, i18nmodel, item, values, i18nvalues in self.i18n_rows:
+            values.update(object_id=item.id)
+            parents.setdefault(model, []).append(
+                    (i18nmodel, table_row(model, **values), i18nvalues))
+        for model, records in parents.iteritems():
+            ids = insert_rows(connection, class_mapper(model).local_table,
+                    [row for _, row, _ in records])
+            for (i18nmodel, _, i18nvalues), rowid in zip(records, ids):
+                i18nvalues.update(id=rowid)
+                pending.setdefault(i18nmodel, []).append(
+                        table_row(i18nmodel, **i18nvalues))
+        for model, item, values in self.rows:
+            values.update(object_id=item.id)
+            pending.setdefault(model, []).append(table_row(model, **values))
+        if self.relations:
+            # term relations are objects in their own right, so
+            # each needs a row in the object table first
+            mapper = class_mapper(models.ObjectTermRelation)
+            objtable = mapper.base_mapper.local_table
+            now = datetime.datetime.now()
+            objrow = {}
+            if mapper.polymorphic_on is not None:
+                objrow[mapper.polymorphic_on.key] = mapper.polymorphic_identity
+            for col in ("created_at", "updated_at"):
+                if col in objtable.c:
+                    objrow[col] = now
+            ids = insert_rows(connection, objtable, [objrow] * len(self.relations))
+            for (item, term), rowid in zip(self.relations, ids):
+                pending.setdefault(models.ObjectTermRelation, []).append(
+                        table_row(models.ObjectTermRelation,
+                            id=rowid, object_id=item.id, term_id=term.id))
+        self._executemany(connection, pending)
+        self.clear()
+
+
+WRITERS = dict(orm=ORMWriter, core=CoreWriter)